@@ -8,3 +8,12 @@ class TextExtractionFailed(Exception):
 
     def __str__(self):
         return f'{self.message}'
+
+
+class PdfHeaderUnsupported(Exception):
+    def __init__(self, message=ExceptionMessage.PDF_HEADER_UNSUPPORTED_MESSAGE):
+        self.message = message
+        super().__init__(self.message)
+
+    def __str__(self):
+        return f'{self.message}'
@@ -0,0 +1,46 @@
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+
+from app.constant import AWS
+
+clients = {}
+clients_lock = threading.Lock()
+kubernetes_config_loaded = False
+
+
+def get_client_config(service_name):
+    max_pool_connections = AWS.S3.MAX_POOL_CONNECTIONS if service_name == 's3' else AWS.BotoClient.MAX_POOL_CONNECTIONS
+    return Config(max_pool_connections=max_pool_connections, tcp_keepalive=True)
+
+
+def get_client(service_name):
+    """ Process-wide boto3 client per service, created on first use.
+
+    boto3 clients are thread-safe once built but creating them through the default session is not, and
+    each build costs several milliseconds, so every caller shares one client and its connection pool.
+    """
+    client = clients.get(service_name)
+    if client is None:
+        with clients_lock:
+            client = clients.get(service_name)
+            if client is None:
+                client = clients[service_name] = boto3.client(service_name, region_name=AWS.BotoClient.AWS_DEFAULT_REGION,
+                                                              config=get_client_config(service_name))
+    return client
+
+
+def load_kubernetes_config():
+    """ Loads the cluster credentials once, on the first Kubernetes call rather than at import.
+    Set KUBERNETES_CONFIG=local to use ~/.kube/config while testing locally. """
+    global kubernetes_config_loaded
+    with clients_lock:
+        if not kubernetes_config_loaded:
+            from kubernetes import config
+            if os.getenv('KUBERNETES_CONFIG') == 'local':
+                config.load_kube_config()
+            else:
+                config.load_incluster_config()
+            kubernetes_config_loaded = True
@@ -1,67 +1,171 @@
+import atexit
+import contextvars
 import logging
 import os
+import queue
 import sys
+import threading
 import watchtower
 
-from app import logs_client
+from logging.handlers import QueueHandler, QueueListener
+
+from app.common.clients import get_client
 from app.constant import AWS
 from logging_utilities.log_record import LogRecordIgnoreMissing
 
+# Project and document of the message being processed. Each message runs in its own task, so setting it
+# in one message never leaks into another.
+log_context = contextvars.ContextVar('log_context', default=None)
+
+CONTEXT_FORMAT = ('[ProjectID: %(project_id)s] - '
+                  '[Document: %(document_name)s] - '
+                  '[Level: %(levelname)s] - '
+                  '[Module: %(pathname)s] - '
+                  '[Function: %(funcName)s] - '
+                  '%(message)s')
+DEFAULT_FORMAT = ('[Level: %(levelname)s] - '
+                  '[Module: %(pathname)s] - '
+                  '[Function: %(funcName)s] - '
+                  '%(message)s')
+
 
 class PackagePathFilter(logging.Filter):
+    """ Rewrites record.pathname as a dotted module path, using a prefix table built once from sys.path """
+
+    def __init__(self):
+        super().__init__()
+        prefixes = {os.path.join(os.path.abspath(path), '') for path in sys.path}
+        self.prefixes = sorted(prefixes, key=len, reverse=True)  # longer paths first
+        self.module_paths = {}
+
+    def get_module_path(self, pathname):
+        module_path = self.module_paths.get(pathname)
+        if module_path is None:
+            module_path = pathname
+            for path in self.prefixes:
+                if pathname.startswith(path):
+                    module_path = os.path.relpath(pathname, path).replace('/', '.').replace('\\', '.')
+                    break
+            self.module_paths[pathname] = module_path
+        return module_path
+
     def filter(self, record):
-        pathname = record.pathname
-        abs_sys_paths = map(os.path.abspath, sys.path)
-        for path in sorted(abs_sys_paths, key=len, reverse=True):  # longer paths first
-            if not path.endswith(os.sep):
-                path += os.sep
-            if pathname.startswith(path):
-                record.pathname = os.path.relpath(pathname, path).replace('/', '.').replace('\\', '.')
-                break
+        record.pathname = self.get_module_path(record.pathname)
         return True
 
 
-def get_cloudwatch_handler(log_stream_name):
-    return watchtower.CloudWatchLogHandler(
-        log_group=AWS.CloudWatch.LOG_GROUP,
-        stream_name=log_stream_name,
-        boto3_client=logs_client
-    )
+class LogContextFilter(logging.Filter):
+    """ Copies the current log_context onto the record; runs in the caller, before the queue """
+
+    def filter(self, record):
+        context = log_context.get()
+        if context:
+            record.project_id, record.document_name = context
+        return True
+
+
+class ContextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__(DEFAULT_FORMAT)
+        self.context_formatter = logging.Formatter(CONTEXT_FORMAT)
+
+    def format(self, record):
+        if getattr(record, 'project_id', None) and getattr(record, 'document_name', None):
+            return self.context_formatter.format(record)
+        return super().format(record)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """ Never blocks the caller: records that do not fit in the bounded queue are counted and dropped """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Formatting and path rewriting happen on the listener thread, only the arguments are resolved here
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogPipeline:
+    """ One long-lived pipeline per process: callers enqueue, a single listener thread formats and ships.
+
+    The CloudWatch handler (which batches PutLogEvents itself) and the console handler are created once;
+    per-message project and document fields come from log_context instead of new handlers.
+    """
+
+    def __init__(self, log_stream_name):
+        self.log_stream_name = log_stream_name
+        self.queue = queue.Queue(maxsize=AWS.CloudWatch.LOG_QUEUE_SIZE)
+        self.queue_handler = DroppingQueueHandler(self.queue)
+        self.queue_handler.addFilter(LogContextFilter())
+
+        formatter = ContextFormatter()
+        path_filter = PackagePathFilter()
+        cloudwatch_handler = watchtower.CloudWatchLogHandler(
+            log_group=AWS.CloudWatch.LOG_GROUP,
+            stream_name=log_stream_name,
+            boto3_client=get_client('logs')
+        )
+        console_handler = logging.StreamHandler()
+        for handler in (cloudwatch_handler, console_handler):
+            handler.setFormatter(formatter)
+            handler.addFilter(path_filter)
+        self.handlers = [cloudwatch_handler, console_handler]
+        self.listener = QueueListener(self.queue, *self.handlers, respect_handler_level=True)
+        self.running = False
+
+    def start(self):
+        logging.setLogRecordFactory(LogRecordIgnoreMissing)
+        logger = logging.getLogger()
+        logger.setLevel(logging.INFO)
+        for handler in logger.handlers[:]:
+            logger.removeHandler(handler)
+        logger.addHandler(self.queue_handler)
+        self.listener.start()
+        self.running = True
+        atexit.register(self.stop)
+
+    def stop(self):
+        """ Drains the queue into the handlers, called at exit """
+        if not self.running:
+            return
+        self.running = False
+        self.listener.stop()
+        for handler in self.handlers:
+            handler.flush()
+        if self.queue_handler.dropped:
+            sys.stderr.write(f'{self.queue_handler.dropped} log record(s) dropped, log queue was full\n')
+
+    def get_stats(self):
+        return {"queued": self.queue.qsize(), "dropped": self.queue_handler.dropped}
+
+
+log_pipeline = None
+log_pipeline_lock = threading.Lock()
+
+
+def set_log_context(project_id=None, document_name=None):
+    """ Tags every record logged from the current task with the project and document """
+    log_context.set((project_id, document_name) if project_id and document_name else None)
 
 
 def get_cloudwatch_logger(project_id=None, document_name=None, log_stream_name=None):
-    logging.setLogRecordFactory(LogRecordIgnoreMissing)
-    logger = logging.getLogger()
-    logger.setLevel(logging.INFO)
-
-    # Clear existing handlers
-    for handler in logger.handlers[:]:
-        logger.removeHandler(handler)
-
-    cloudwatch_handler = get_cloudwatch_handler(log_stream_name)
-    console_handler = logging.StreamHandler()
-
-    if project_id and document_name:
-        formatter = logging.Formatter('[ProjectID: %(project_id)s] - '
-                                      '[Document: %(document_name)s] - '
-                                      '[Level: %(levelname)s] - '
-                                      '[Module: %(pathname)s] - '
-                                      '[Function: %(funcName)s] - '
-                                      '%(message)s')
-    else:
-        formatter = logging.Formatter('[Level: %(levelname)s] - '
-                                      '[Module: %(pathname)s] - '
-                                      '[Function: %(funcName)s] - '
-                                      '%(message)s')
-
-    cloudwatch_handler.setFormatter(formatter)
-    console_handler.setFormatter(formatter)
-
-    cloudwatch_handler.addFilter(PackagePathFilter())
-    logger.addHandler(cloudwatch_handler)
-    logger.addHandler(console_handler)
-
-    if project_id and document_name:
-        logger = logging.LoggerAdapter(logger, extra={"project_id": project_id, "document_name": document_name})
-
-    return logger
+    global log_pipeline
+    with log_pipeline_lock:
+        if log_pipeline is None:
+            log_pipeline = LogPipeline(log_stream_name)
+            log_pipeline.start()
+    set_log_context(project_id, document_name)
+    return logging.getLogger()
@@ -0,0 +1,91 @@
+import os
+import shutil
+import tempfile
+import fitz
+
+from app.common.metrics import track_stage
+from app.common.pdf_header import PdfHeaderReader
+from app.common.s3_utils import S3Utils, get_content_key
+from app.constant import AWS, MedicalInsights
+
+
+class DocumentSession:
+    """ Per-message view of one S3 PDF shared by the size check, page count and splitting stages.
+
+    The document is downloaded and parsed at most once, and only when a stage actually needs the pages;
+    the size and content key come from one HEAD and the page count from the PDF header whenever possible.
+    Use it as an async context manager so the local copy is always removed.
+    """
+
+    def __init__(self, document_path, s3_utils=None, logger=None):
+        self.document_path = document_path
+        self.document_name = os.path.basename(document_path)
+        self.s3_utils = s3_utils or S3Utils()
+        self.logger = logger
+        self.head_response = None
+        self.size_mb = None
+        self.page_count = None
+        self.local_dir = None
+        self.local_path = None
+        self.pdf_document = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+    async def head(self):
+        if self.head_response is None:
+            self.head_response = await self.s3_utils.head_object(AWS.S3.S3_BUCKET, self.document_path,
+                                                                 ChecksumMode='ENABLED')
+        return self.head_response
+
+    async def get_size_mb(self):
+        if self.size_mb is None:
+            self.size_mb = (await self.head())['ContentLength'] / (1024 * 1024)
+        return self.size_mb
+
+    async def get_content_key(self):
+        return get_content_key(await self.head())
+
+    async def get_page_count(self):
+        if self.page_count is None:
+            with track_stage('page_count'):
+                self.page_count = await self.read_page_count()
+        return self.page_count
+
+    async def read_page_count(self):
+        if self.pdf_document is None:
+            reader = PdfHeaderReader(self.s3_utils, AWS.S3.S3_BUCKET, self.document_path)
+            try:
+                page_count = await reader.get_page_count()
+                if self.logger:
+                    self.logger.info(f"Page count read from PDF header ({reader.bytes_transferred} bytes, "
+                                     f"{reader.request_count} requests).")
+                return page_count
+            except Exception as e:
+                if self.logger:
+                    self.logger.info(f"Page count from PDF header unavailable ({e}), opening the full document.")
+
+        pdf_document = await self.open()
+        return pdf_document.page_count
+
+    async def open(self):
+        """ Downloads the document into a session-private directory and opens it once """
+        if self.pdf_document is None:
+            os.makedirs(MedicalInsights.STATIC_FOLDER_PATH, exist_ok=True)
+            self.local_dir = tempfile.mkdtemp(dir=MedicalInsights.STATIC_FOLDER_PATH)
+            self.local_path = os.path.join(self.local_dir, self.document_name)
+            await self.s3_utils.download_object(AWS.S3.S3_BUCKET, self.document_path, self.local_path)
+            self.pdf_document = fitz.open(self.local_path)
+        return self.pdf_document
+
+    def close(self):
+        if self.pdf_document is not None:
+            self.pdf_document.close()
+            self.pdf_document = None
+        if self.local_dir and os.path.exists(self.local_dir):
+            shutil.rmtree(self.local_dir, ignore_errors=True)
+        self.local_dir = None
+        self.local_path = None
@@ -0,0 +1,183 @@
+import asyncio
+import time
+import traceback
+from collections import deque
+
+from app.common.message_pool import MessageWorkerPool
+from app.common.metrics import MESSAGES, MESSAGES_IN_FLIGHT
+from app.constant import Runner, Scheduler
+
+
+def parse_project_weights(value):
+    """ 'project_a:3,project_b:1' -> {'project_a': 3.0, 'project_b': 1.0} """
+    weights = {}
+    for item in filter(None, (item.strip() for item in (value or '').split(','))):
+        project_id, _, weight = item.partition(':')
+        weights[project_id.strip()] = float(weight or 1)
+    return weights
+
+
+class HeldMessage:
+    def __init__(self, message_body, receipt_handle, project_id, fast_lane):
+        self.message_body = message_body
+        self.receipt_handle = receipt_handle
+        self.project_id = project_id
+        self.fast_lane = fast_lane
+        self.received_at = time.monotonic()
+
+
+class FairSchedulingWorkerPool(MessageWorkerPool):
+    """ Worker pool that holds received messages in per-project queues and dispatches them fairly.
+
+    classify(message_body) returns (project_id, fast_lane). Fast-lane (small) documents are dispatched
+    first; otherwise the eligible project with the lowest virtual time runs next and advances by 1/weight
+    (stride scheduling), so a project's share of dispatches follows its weight. No project runs more than
+    Scheduler.PROJECT_MAX_CONCURRENCY messages at once. Held messages are leased through lease_manager
+    (a MessageLeaseManager) as soon as they are received, so its heartbeat keeps them invisible to other
+    consumers until they are handled, and they are made visible again on shutdown.
+    """
+
+    def __init__(self, sqs_helper, queue_url, handler, logger, classify, lease_manager,
+                 max_concurrency=Runner.MAX_CONCURRENT_MESSAGES,
+                 batch_size=Runner.SQS_BATCH_SIZE, max_held=Scheduler.MAX_HELD_MESSAGES,
+                 project_weights=None, project_max_concurrency=Scheduler.PROJECT_MAX_CONCURRENCY):
+        super().__init__(sqs_helper, queue_url, handler, logger, max_concurrency, batch_size)
+        self.classify = classify
+        self.lease_manager = lease_manager
+        self.max_held = max(max_held, self.max_concurrency)
+        self.project_weights = project_weights if project_weights is not None else parse_project_weights(Scheduler.PROJECT_WEIGHTS)
+        self.project_max_concurrency = max(1, project_max_concurrency)
+        self.fast_lane = deque()
+        self.project_queues = {}
+        self.virtual_times = {}
+        self.running = {}
+        self.held_count = 0
+        self.active = 0
+        self.changed = asyncio.Condition()
+
+    def get_weight(self, project_id):
+        return self.project_weights.get(project_id, 1.0)
+
+    async def hold(self, message_body, receipt_handle):
+        try:
+            project_id, fast_lane = await self.classify(message_body)
+        except Exception as e:
+            self.logger.error('%s -> %s' % (e, traceback.format_exc()))
+            project_id, fast_lane = None, False
+
+        held = HeldMessage(message_body, receipt_handle, project_id, fast_lane)
+        async with self.changed:
+            if fast_lane:
+                self.fast_lane.append(held)
+            else:
+                if project_id not in self.project_queues or not self.project_queues[project_id]:
+                    # A project that was idle joins at the current minimum so it cannot bank credit
+                    active = [self.virtual_times[p] for p, queue in self.project_queues.items() if queue]
+                    self.virtual_times[project_id] = max(self.virtual_times.get(project_id, 0.0), min(active, default=0.0))
+                self.project_queues.setdefault(project_id, deque()).append(held)
+            self.held_count += 1
+            self.changed.notify_all()
+
+    def can_run(self, project_id):
+        return self.running.get(project_id, 0) < self.project_max_concurrency
+
+    def pick_next(self):
+        for held in self.fast_lane:
+            if self.can_run(held.project_id):
+                self.fast_lane.remove(held)
+                return held
+
+        eligible = [project_id for project_id, queue in self.project_queues.items() if queue and self.can_run(project_id)]
+        if not eligible:
+            return None
+        project_id = min(eligible, key=lambda project: self.virtual_times.get(project, 0.0))
+        self.virtual_times[project_id] = self.virtual_times.get(project_id, 0.0) + 1.0 / self.get_weight(project_id)
+        return self.project_queues[project_id].popleft()
+
+    async def process_held(self, held):
+        MESSAGES_IN_FLIGHT.inc()
+        try:
+            await self.handler(held.message_body, held.receipt_handle)
+            MESSAGES.labels('handled').inc()
+        except Exception as e:
+            MESSAGES.labels('error').inc()
+            self.logger.error('%s -> %s' % (e, traceback.format_exc()))
+        finally:
+            MESSAGES_IN_FLIGHT.dec()
+            self.processed += 1
+            async with self.changed:
+                self.active -= 1
+                self.running[held.project_id] -= 1
+                self.changed.notify_all()
+
+    async def dispatcher(self):
+        while True:
+            async with self.changed:
+                held = None
+                while held is None:
+                    if self.stopping.is_set():
+                        return
+                    if self.active < self.max_concurrency:
+                        held = self.pick_next()
+                    if held is None:
+                        await self.changed.wait()
+                self.held_count -= 1
+                self.active += 1
+                self.running[held.project_id] = self.running.get(held.project_id, 0) + 1
+                self.changed.notify_all()
+
+            task = asyncio.create_task(self.process_held(held))
+            self.in_flight.add(task)
+            task.add_done_callback(self.in_flight.discard)
+
+    async def receiver(self):
+        while not self.stopping.is_set():
+            async with self.changed:
+                while self.held_count >= self.max_held and not self.stopping.is_set():
+                    await self.changed.wait()
+                capacity = self.max_held - self.held_count
+            if self.stopping.is_set():
+                return
+
+            messages = await self.sqs_helper.consume_messages(self.queue_url, min(self.batch_size, capacity))
+            if not messages:
+                try:
+                    await asyncio.wait_for(self.stopping.wait(), timeout=Runner.EMPTY_QUEUE_WAIT_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self.logger.info(f'{len(messages)} message(s) received from queue: {self.queue_url.split("/")[-1]}')
+            self.lease_manager.lease_many([receipt_handle for _, receipt_handle in messages])
+            await asyncio.gather(*[self.hold(message_body, receipt_handle) for message_body, receipt_handle in messages])
+            self.report_throughput()
+
+    def get_held_messages(self):
+        held = list(self.fast_lane)
+        for queue in self.project_queues.values():
+            held.extend(queue)
+        return held
+
+    async def release_held(self):
+        async with self.changed:
+            held = self.get_held_messages()
+            self.fast_lane.clear()
+            self.project_queues.clear()
+            self.held_count = 0
+        if held:
+            self.logger.info(f'Returning {len(held)} held message(s) to the queue')
+            await self.lease_manager.return_to_queue([message.receipt_handle for message in held])
+
+    async def wake_on_stop(self):
+        await self.stopping.wait()
+        async with self.changed:
+            self.changed.notify_all()
+
+    async def run(self):
+        self.install_signal_handlers()
+        self.started_at = self.last_report_at = time.monotonic()
+
+        await asyncio.gather(self.receiver(), self.dispatcher(), self.wake_on_stop())
+
+        await self.release_held()
+        await self.drain()
@@ -0,0 +1,105 @@
+import asyncio
+import copy
+import json
+import random
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from app.common.clients import load_kubernetes_config
+from app.common.metrics import JOBS_IN_FLIGHT, track_stage
+from app.constant import Kubernetes
+
+
+class JobLauncher:
+    """ Creates Kubernetes Jobs from a job manifest template parsed once per runner.
+
+    All jobs go through one pooled BatchV1Api. The blocking create call runs on a dedicated thread pool with
+    at most JOB_SUBMIT_CONCURRENCY submissions in flight. 429 and 5xx responses are retried with jittered
+    backoff (honouring Retry-After). A 409 on the first attempt gets a fresh job name, and a 409 on a retry
+    means the earlier attempt already created the job.
+    """
+
+    def __init__(self, manifest_path, name_prefix, image, namespace, logger, batch_api=None):
+        with open(manifest_path, 'r') as file:
+            self.template = json.load(file)
+        self.name_prefix = name_prefix
+        self.image = image
+        self.namespace = namespace
+        self.logger = logger
+        self.batch_api = batch_api
+        self.semaphore = None
+        self.executor = ThreadPoolExecutor(max_workers=Kubernetes.JOB_SUBMIT_CONCURRENCY,
+                                           thread_name_prefix=f'{name_prefix}-launcher')
+
+    def build_job(self, env_values, completions=None):
+        """ With completions, builds an Indexed Job: each pod reads its index from JOB_COMPLETION_INDEX """
+        job_manifest = copy.deepcopy(self.template)
+        job_manifest['metadata']['name'] = f"{self.name_prefix}-{uuid.uuid1()}"
+        if completions:
+            job_manifest['spec']['completionMode'] = 'Indexed'
+            job_manifest['spec']['completions'] = completions
+            job_manifest['spec']['parallelism'] = min(completions, Kubernetes.INDEXED_JOB_PARALLELISM)
+        container = job_manifest['spec']['template']['spec']['containers'][0]
+        container['image'] = self.image
+
+        for env_variable in container['env']:
+            if env_variable['name'] in env_values:
+                env_variable['value'] = env_values[env_variable['name']]
+        return job_manifest
+
+    def get_batch_api(self):
+        if self.batch_api is None:
+            from kubernetes import client
+            self.batch_api = client.BatchV1Api(get_api_client())
+        return self.batch_api
+
+    async def submit(self, job_manifest):
+        from kubernetes.client.rest import ApiException
+
+        batch_api = self.get_batch_api()
+        loop = asyncio.get_running_loop()
+        for attempt in range(Kubernetes.JOB_SUBMIT_MAX_RETRIES + 1):
+            try:
+                await loop.run_in_executor(self.executor, lambda: batch_api.create_namespaced_job(
+                    namespace=self.namespace, body=job_manifest))
+                return job_manifest['metadata']['name']
+            except ApiException as e:
+                if e.status == 409 and attempt > 0:
+                    return job_manifest['metadata']['name']
+                if attempt == Kubernetes.JOB_SUBMIT_MAX_RETRIES or not (e.status in (409, 429) or e.status >= 500):
+                    raise
+                if e.status == 409:
+                    job_manifest['metadata']['name'] = f"{self.name_prefix}-{uuid.uuid1()}"
+                    continue
+                retry_after = (e.headers or {}).get('Retry-After')
+                delay = float(retry_after) if retry_after and retry_after.isdigit() else \
+                    random.uniform(0, min(Kubernetes.BACKOFF_MAX_SECONDS, Kubernetes.BACKOFF_BASE_SECONDS * 2 ** attempt))
+                self.logger.info(f"Job creation returned {e.status}, retrying in {delay:.2f} seconds.")
+                await asyncio.sleep(delay)
+
+    async def create_job(self, env_values, logger=None, completions=None):
+        if self.semaphore is None:
+            # Created on first use so it binds to the running event loop
+            self.semaphore = asyncio.Semaphore(Kubernetes.JOB_SUBMIT_CONCURRENCY)
+        async with self.semaphore:
+            with JOBS_IN_FLIGHT.track_inprogress(), track_stage('job_creation'):
+                job_name = await self.submit(self.build_job(env_values, completions))
+        (logger or self.logger).info(f'Job {job_name} created in namespace: {self.namespace}')
+        return job_name
+
+
+api_client = None
+
+
+def get_api_client():
+    """ Pooled ApiClient shared by every launcher. The kubernetes package (about 130 ms to import) and the
+    cluster config are only loaded here, when the first Job is submitted. """
+    global api_client
+    if api_client is None:
+        from kubernetes import client
+
+        load_kubernetes_config()
+        configuration = client.Configuration.get_default_copy()
+        configuration.connection_pool_maxsize = Kubernetes.CONNECTION_POOL_MAXSIZE
+        api_client = client.ApiClient(configuration)
+    return api_client
@@ -0,0 +1,118 @@
+import asyncio
+import signal
+import time
+import traceback
+
+from app.common.metrics import MESSAGES, MESSAGES_IN_FLIGHT
+from app.constant import Runner
+
+
+class MessageWorkerPool:
+    """ Bounded pool that keeps up to max_concurrency SQS messages in flight.
+
+    Receives are batched (at most 10 per call) and never ask for more messages than there are free slots,
+    so a full pool stops pulling from the queue instead of letting messages sit invisible in memory.
+    SIGTERM/SIGINT stop the receive loop and let in-flight messages finish before run() returns.
+    """
+
+    def __init__(self, sqs_helper, queue_url, handler, logger, max_concurrency=Runner.MAX_CONCURRENT_MESSAGES,
+                 batch_size=Runner.SQS_BATCH_SIZE):
+        self.sqs_helper = sqs_helper
+        self.queue_url = queue_url
+        self.handler = handler
+        self.logger = logger
+        self.max_concurrency = max(1, max_concurrency)
+        self.batch_size = max(1, min(batch_size, 10))
+        self.slots = asyncio.Semaphore(self.max_concurrency)
+        self.in_flight = set()
+        self.stopping = asyncio.Event()
+        self.processed = 0
+        self.started_at = None
+        self.last_report_at = None
+
+    def stop(self):
+        if not self.stopping.is_set():
+            self.logger.info('Shutdown requested, draining in-flight messages...')
+            self.stopping.set()
+
+    def install_signal_handlers(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+    def free_slots(self):
+        return self.max_concurrency - len(self.in_flight)
+
+    def messages_per_second(self):
+        if not self.started_at:
+            return 0.0
+        elapsed = time.monotonic() - self.started_at
+        return self.processed / elapsed if elapsed > 0 else 0.0
+
+    def report_throughput(self, force=False):
+        now = time.monotonic()
+        if force or now - self.last_report_at >= Runner.THROUGHPUT_LOG_INTERVAL_SECONDS:
+            self.last_report_at = now
+            self.logger.info(f'Processed {self.processed} messages at {self.messages_per_second():.2f} messages/sec, '
+                             f'{len(self.in_flight)} in flight')
+
+    async def process(self, message_body, receipt_handle):
+        MESSAGES_IN_FLIGHT.inc()
+        try:
+            await self.handler(message_body, receipt_handle)
+            MESSAGES.labels('handled').inc()
+        except Exception as e:
+            MESSAGES.labels('error').inc()
+            self.logger.error('%s -> %s' % (e, traceback.format_exc()))
+        finally:
+            MESSAGES_IN_FLIGHT.dec()
+            self.processed += 1
+            self.slots.release()
+
+    async def wait_for_slot(self):
+        """ Back-pressure: block until at least one slot is free or shutdown is requested """
+        acquire = asyncio.ensure_future(self.slots.acquire())
+        stop = asyncio.ensure_future(self.stopping.wait())
+        done, pending = await asyncio.wait({acquire, stop}, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        if acquire in done:
+            self.slots.release()
+            return True
+        return False
+
+    async def run(self):
+        self.install_signal_handlers()
+        self.started_at = self.last_report_at = time.monotonic()
+
+        while not self.stopping.is_set():
+            if not await self.wait_for_slot():
+                break
+
+            messages = await self.sqs_helper.consume_messages(self.queue_url, min(self.batch_size, self.free_slots()))
+            if not messages:
+                try:
+                    await asyncio.wait_for(self.stopping.wait(), timeout=Runner.EMPTY_QUEUE_WAIT_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self.logger.info(f'{len(messages)} message(s) received from queue: {self.queue_url.split("/")[-1]}')
+            for message_body, receipt_handle in messages:
+                await self.slots.acquire()
+                task = asyncio.create_task(self.process(message_body, receipt_handle))
+                self.in_flight.add(task)
+                task.add_done_callback(self.in_flight.discard)
+
+            self.report_throughput()
+
+        await self.drain()
+
+    async def drain(self):
+        if self.in_flight:
+            self.logger.info(f'Waiting for {len(self.in_flight)} in-flight message(s) to complete')
+            await asyncio.gather(*self.in_flight, return_exceptions=True)
+        self.report_throughput(force=True)
@@ -0,0 +1,63 @@
+import time
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+from app.constant import Metrics
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, float('inf'))
+
+STAGE_DURATION = Histogram('runner_stage_duration_seconds', 'Duration of each processing stage',
+                           ['stage'], buckets=STAGE_BUCKETS)
+STAGE_FAILURES = Counter('runner_stage_failures_total', 'Stages that raised', ['stage'])
+S3_BYTES = Counter('runner_s3_bytes_total', 'Bytes moved to and from S3', ['direction'])
+PAGES = Counter('runner_pages_total', 'Pages handled', ['stage'])
+SPLIT_PARTS = Counter('runner_split_parts_total', 'Split parts uploaded')
+MESSAGES = Counter('runner_messages_total', 'Queue messages processed', ['outcome'])
+MESSAGES_IN_FLIGHT = Gauge('runner_messages_in_flight', 'Queue messages being processed')
+JOBS_IN_FLIGHT = Gauge('runner_job_submissions_in_flight', 'Kubernetes Job submissions in progress')
+
+# Label lookups take a lock, children are resolved once per label value
+stage_durations = {}
+
+
+def observe_stage(stage, seconds):
+    histogram = stage_durations.get(stage)
+    if histogram is None:
+        histogram = stage_durations[stage] = STAGE_DURATION.labels(stage)
+    histogram.observe(seconds)
+
+
+class track_stage:
+    """ Times a block into STAGE_DURATION, usable as `with track_stage('split') as stage:` in sync or async code.
+
+    stage.elapsed holds the duration once the block exits, for the existing log lines.
+    """
+
+    __slots__ = ('stage', 'start_time', 'elapsed')
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.start_time = None
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.elapsed = time.perf_counter() - self.start_time
+        observe_stage(self.stage, self.elapsed)
+        if exc_type is not None:
+            STAGE_FAILURES.labels(self.stage).inc()
+        return False
+
+
+metrics_server_started = False
+
+
+def start_metrics_server():
+    """ Serves every metric in Prometheus text format on METRICS_PORT from a daemon thread """
+    global metrics_server_started
+    if Metrics.ENABLED and not metrics_server_started:
+        start_http_server(Metrics.PORT)
+        metrics_server_started = True
@@ -0,0 +1,143 @@
+import re
+
+from app.business_rule_exception import PdfHeaderUnsupported
+from app.constant import PdfHeader
+
+LINEARIZED_PATTERN = re.compile(rb'/Linearized\s')
+LINEARIZED_LENGTH_PATTERN = re.compile(rb'/L\s+(\d+)')
+LINEARIZED_PAGES_PATTERN = re.compile(rb'/N\s+(\d+)')
+STARTXREF_PATTERN = re.compile(rb'startxref\s+(\d+)\s+%%EOF')
+TRAILER_PATTERN = re.compile(rb'trailer\s*<<(.*?)>>\s*startxref', re.S)
+SUBSECTION_PATTERN = re.compile(rb'\s*(\d+)\s+(\d+)\s*?(\r\n|\r|\n)')
+ROOT_PATTERN = re.compile(rb'/Root\s+(\d+)\s+(\d+)\s+R')
+PREV_PATTERN = re.compile(rb'/Prev\s+(\d+)')
+PAGES_PATTERN = re.compile(rb'/Pages\s+(\d+)\s+(\d+)\s+R')
+COUNT_PATTERN = re.compile(rb'/Count\s+(\d+)\b(?!\s+\d+\s+R)')
+
+
+class PdfHeaderReader:
+    """ Reads the page count of a PDF on S3 through ranged GETs of the trailer, xref table and page tree root.
+
+    Only classic xref tables are walked. Cross-reference streams, objects stored in object streams and
+    indirect /Count values raise PdfHeaderUnsupported so the caller can fall back to a full download.
+    """
+
+    def __init__(self, s3_utils, bucket, key):
+        self.s3_utils = s3_utils
+        self.bucket = bucket
+        self.key = key
+        self.bytes_transferred = 0
+        self.request_count = 0
+
+    async def read(self, byte_range):
+        body, content_range = await self.s3_utils.get_object_range(self.bucket, self.key, byte_range)
+        self.bytes_transferred += len(body)
+        self.request_count += 1
+        return body, content_range
+
+    async def read_at(self, offset, length):
+        body, _ = await self.read(f'bytes={offset}-{offset + length - 1}')
+        return body
+
+    async def get_linearized_page_count(self):
+        """ Uses /N of the linearization dictionary, which is only trusted while /L still matches the file length """
+        head, content_range = await self.read(f'bytes=0-{PdfHeader.LINEARIZED_HEADER_BYTES - 1}')
+        first_object = head.split(b'endobj', 1)[0]
+        if not LINEARIZED_PATTERN.search(first_object):
+            return None
+
+        length = LINEARIZED_LENGTH_PATTERN.search(first_object)
+        pages = LINEARIZED_PAGES_PATTERN.search(first_object)
+        file_size = content_range.rsplit('/', 1)[-1]
+        if length and pages and file_size.isdigit() and int(length.group(1)) == int(file_size):
+            return int(pages.group(1))
+        return None
+
+    async def find_xref_entry(self, xref_offset, object_number):
+        """ Walks the subsections of one xref section, returns (entry or None, trailer dictionary bytes) """
+        position = xref_offset
+        header = await self.read_at(position, PdfHeader.XREF_HEADER_BYTES)
+        if not header.lstrip().startswith(b'xref'):
+            raise PdfHeaderUnsupported('Cross-reference stream found instead of a classic xref table')
+        position += header.index(b'xref') + len(b'xref')
+        entry = None
+
+        for _ in range(PdfHeader.MAX_XREF_SECTIONS):
+            chunk = await self.read_at(position, PdfHeader.XREF_HEADER_BYTES)
+            if chunk.lstrip().startswith(b'trailer'):
+                trailer = await self.read_at(position, PdfHeader.OBJECT_READ_BYTES)
+                match = re.search(rb'trailer\s*<<(.*?)>>', trailer, re.S)
+                if not match:
+                    raise PdfHeaderUnsupported('Trailer dictionary is not readable')
+                return entry, match.group(1)
+
+            match = SUBSECTION_PATTERN.match(chunk)
+            if not match:
+                raise PdfHeaderUnsupported('Malformed xref subsection header')
+            start, count = int(match.group(1)), int(match.group(2))
+            entries_offset = position + match.end()
+
+            if entry is None and start <= object_number < start + count:
+                raw = await self.read_at(entries_offset + (object_number - start) * PdfHeader.XREF_ENTRY_BYTES,
+                                         PdfHeader.XREF_ENTRY_BYTES)
+                fields = raw.split()
+                if len(fields) < 3:
+                    raise PdfHeaderUnsupported('Malformed xref entry')
+                entry = (int(fields[0]), fields[2])
+
+            position = entries_offset + count * PdfHeader.XREF_ENTRY_BYTES
+
+        raise PdfHeaderUnsupported('Too many xref subsections')
+
+    async def get_object_offset(self, xref_offset, object_number):
+        """ Resolves an object offset following /Prev through incremental updates, newest section first """
+        for _ in range(PdfHeader.MAX_XREF_SECTIONS):
+            entry, trailer = await self.find_xref_entry(xref_offset, object_number)
+            if entry is not None:
+                offset, kind = entry
+                if kind != b'n':
+                    raise PdfHeaderUnsupported(f'Object {object_number} is free in the xref table')
+                return offset
+            previous = PREV_PATTERN.search(trailer)
+            if not previous:
+                break
+            xref_offset = int(previous.group(1))
+        raise PdfHeaderUnsupported(f'Object {object_number} is not in the xref table')
+
+    async def read_object(self, xref_offset, object_number, generation):
+        offset = await self.get_object_offset(xref_offset, object_number)
+        body = await self.read_at(offset, PdfHeader.OBJECT_READ_BYTES)
+        if not re.match(rb'\s*%d\s+%d\s+obj' % (object_number, generation), body):
+            raise PdfHeaderUnsupported(f'Object {object_number} not found at its xref offset')
+        return body.split(b'endobj', 1)[0]
+
+    async def get_page_count(self):
+        page_count = await self.get_linearized_page_count()
+        if page_count:
+            return page_count
+
+        tail, _ = await self.read(f'bytes=-{PdfHeader.TAIL_BYTES}')
+        startxref = STARTXREF_PATTERN.findall(tail)
+        if not startxref:
+            raise PdfHeaderUnsupported('startxref not found in the file tail')
+        xref_offset = int(startxref[-1])
+
+        trailers = TRAILER_PATTERN.findall(tail)
+        trailer = trailers[-1] if trailers else None
+        if trailer is None:
+            _, trailer = await self.find_xref_entry(xref_offset, -1)
+
+        root = ROOT_PATTERN.search(trailer)
+        if not root:
+            raise PdfHeaderUnsupported('/Root not found in the trailer')
+        catalog = await self.read_object(xref_offset, int(root.group(1)), int(root.group(2)))
+
+        pages = PAGES_PATTERN.search(catalog)
+        if not pages:
+            raise PdfHeaderUnsupported('/Pages not found in the document catalog')
+        page_tree = await self.read_object(xref_offset, int(pages.group(1)), int(pages.group(2)))
+
+        count = COUNT_PATTERN.search(page_tree)
+        if not count:
+            raise PdfHeaderUnsupported('/Count not found in the page tree root')
+        return int(count.group(1))
@@ -1,70 +1,194 @@
 import io
-import boto3
+import asyncio
+import base64
+import functools
+import logging
+import time
 import os
-from app.constant import MedicalInsights
+from concurrent.futures import ThreadPoolExecutor
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from app.common.clients import get_client
+from app.common.metrics import S3_BYTES, track_stage
 from app.constant import AWS
 
+# boto3 clients are thread-safe, blocking calls are dispatched here so they never stall the event loop
+s3_executor = ThreadPoolExecutor(max_workers=AWS.S3.MAX_WORKERS, thread_name_prefix='s3-utils')
 
-class S3Utils:
-    def __init__(self):
-        self.client = boto3.client(service_name='s3', region_name=AWS.BotoClient.AWS_DEFAULT_REGION)
-
-    async def download_object(self, bucket, key, download_path):
-        bytes_buffer = io.BytesIO()
-        self.client.download_fileobj(Bucket=bucket, Key=key, Fileobj=bytes_buffer)
-        file_object = bytes_buffer.getvalue()
-
-        with open(download_path, 'wb') as file:
-            file.write(file_object)
+MB = 1024 * 1024
+transfer_config = TransferConfig(
+    multipart_threshold=AWS.S3.MULTIPART_THRESHOLD_MB * MB,
+    multipart_chunksize=AWS.S3.MULTIPART_CHUNKSIZE_MB * MB,
+    max_concurrency=AWS.S3.TRANSFER_MAX_CONCURRENCY,
+    use_threads=True
+)
 
-    async def download_multiple_files(self, bucket, key):
-        response = self.client.list_objects_v2(Bucket=bucket, Prefix=key)
-        local_json_path = MedicalInsights.LOCAL_JSON_PATH
 
-        if 'Contents' not in response:
-            return
-
-        for obj in response['Contents']:
-            file_key = obj['Key']
-            file_name = os.path.basename(file_key)
+class S3Utils:
+    @property
+    def client(self):
+        return get_client('s3')
 
-            if not file_name:
-                continue
-            local_file_path = os.path.join(local_json_path, file_name)
+    async def run_blocking(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(s3_executor, functools.partial(func, *args, **kwargs))
 
-            bytes_buffer = io.BytesIO()
-            self.client.download_fileobj(Bucket=bucket, Key=file_key, Fileobj=bytes_buffer)
-            bytes_buffer.seek(0)
+    def log_throughput(self, operation, key, size_bytes, start_time):
+        elapsed = time.time() - start_time
+        throughput = (size_bytes / MB) / elapsed if elapsed > 0 else 0.0
+        logging.getLogger().info(f"S3 {operation} of {key}: {size_bytes / MB:.2f} MB in {elapsed:.2f} seconds "
+                                 f"({throughput:.2f} MB/s)")
+        return throughput
 
-            with open(local_file_path, 'wb') as file:
-                file.write(bytes_buffer.read())
+    async def download_object(self, bucket, key, download_path):
+        """ Streams the object straight to disk using ranged, parallel part downloads """
+        start_time = time.time()
+        with track_stage('s3_download'):
+            await self.run_blocking(self.client.download_file, bucket, key, download_path, Config=transfer_config)
+        size_bytes = os.path.getsize(download_path)
+        S3_BYTES.labels('download').inc(size_bytes)
+        self.log_throughput('download', key, size_bytes, start_time)
 
     async def upload_object(self, bucket, key, file_object):
+        S3_BYTES.labels('upload').inc(len(file_object))
         file_object = io.BytesIO(file_object)
-        self.client.upload_fileobj(file_object, bucket, key)
+        with track_stage('s3_upload'):
+            await self.run_blocking(self.client.upload_fileobj, file_object, bucket, key, Config=transfer_config)
+        url = f's3://{bucket}/{key}'
+        return url
+
+    async def upload_file(self, bucket, key, file_path):
+        """ Streams a local file to S3 as a parallel multipart upload without reading it into memory """
+        start_time = time.time()
+        with track_stage('s3_upload'):
+            await self.run_blocking(self.client.upload_file, file_path, bucket, key, Config=transfer_config)
+        size_bytes = os.path.getsize(file_path)
+        S3_BYTES.labels('upload').inc(size_bytes)
+        self.log_throughput('upload', key, size_bytes, start_time)
         url = f's3://{bucket}/{key}'
         return url
 
     async def delete_object(self, bucket, key):
-        self.client.delete_object(Bucket=bucket, Key=key)
+        await self.run_blocking(self.client.delete_object, Bucket=bucket, Key=key)
 
     async def check_s3_path_exists(self, bucket, key):
-        response = self.client.list_objects_v2(Bucket=bucket, Prefix=key)
+        response = await self.run_blocking(self.client.list_objects_v2, Bucket=bucket, Prefix=key)
         if 'Contents' not in response or len(response['Contents']) < 1:
             return []
         else:
             return response
 
-    async def get_s3_path_object_count(self, bucket, key):
-        response = self.client.list_objects_v2(Bucket=bucket, Prefix=key)
-        if 'Contents' in response:
-            object_count = len(response['Contents'])
-            return object_count
-        else:
-            return []
+    async def read_object(self, bucket, key):
+        with track_stage('s3_download'):
+            response = await self.run_blocking(self.client.get_object, Bucket=bucket, Key=key)
+            body = await self.run_blocking(response['Body'].read)
+        S3_BYTES.labels('download').inc(len(body))
+        return body
+
+    async def get_object_range(self, bucket, key, byte_range):
+        """ Fetches part of an object, byte_range uses HTTP syntax: 'bytes=0-1023' or 'bytes=-1024' for the tail """
+        response = await self.run_blocking(self.client.get_object, Bucket=bucket, Key=key, Range=byte_range)
+        body = await self.run_blocking(response['Body'].read)
+        S3_BYTES.labels('download').inc(len(body))
+        return body, response.get('ContentRange', '')
+
+    async def head_object(self, bucket, key, **kwargs):
+        with track_stage('s3_head'):
+            return await self.run_blocking(self.client.head_object, Bucket=bucket, Key=key, **kwargs)
+
+    async def object_exists(self, bucket, key):
+        try:
+            await self.head_object(bucket, key)
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
 
     async def get_file_size(self, bucket, key):
-        response = self.client.head_object(Bucket=bucket, Key=key)
+        response = await self.head_object(bucket, key)
         file_size = response['ContentLength']
         file_size_mb = file_size / (1024 * 1024)
         return file_size_mb
+
+
+def get_content_key(head_response):
+    """ Content identity of an object from its HEAD: SHA-256 checksum when it has one, otherwise ETag and size """
+    checksum = head_response.get('ChecksumSHA256')
+    if checksum and '-' not in checksum:
+        return f"sha256-{base64.b64decode(checksum).hex()}"
+    return f"etag-{head_response['ETag'].strip(chr(34)).replace('-', '_')}-{head_response['ContentLength']}"
+
+
+class S3MultipartWriter:
+    """ Buffers written bytes into parts of MULTIPART_CHUNKSIZE_MB and uploads them as a single multipart object.
+
+    At most one part is buffered while the previous one uploads, so memory stays at about two parts.
+    """
+
+    def __init__(self, s3_utils, bucket, key, part_size=AWS.S3.MULTIPART_CHUNKSIZE_MB * MB):
+        self.s3_utils = s3_utils
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, 5 * MB)
+        self.buffer = io.BytesIO()
+        self.upload_id = None
+        self.parts = []
+        self.part_number = 0
+        self.pending_upload = None
+        self.bytes_written = 0
+        self.start_time = time.time()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.close()
+        else:
+            await self.abort()
+
+    async def write(self, data):
+        self.buffer.write(data)
+        self.bytes_written += len(data)
+        if self.buffer.tell() >= self.part_size:
+            await self.flush_part()
+
+    async def upload_part(self, part_number, body):
+        response = await self.s3_utils.run_blocking(self.s3_utils.client.upload_part, Bucket=self.bucket, Key=self.key,
+                                                    UploadId=self.upload_id, PartNumber=part_number, Body=body)
+        self.parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+
+    async def flush_part(self):
+        if self.upload_id is None:
+            response = await self.s3_utils.run_blocking(self.s3_utils.client.create_multipart_upload,
+                                                        Bucket=self.bucket, Key=self.key)
+            self.upload_id = response['UploadId']
+        if self.pending_upload:
+            await self.pending_upload
+        body = self.buffer.getvalue()
+        self.buffer = io.BytesIO()
+        self.part_number += 1
+        self.pending_upload = asyncio.ensure_future(self.upload_part(self.part_number, body))
+
+    async def close(self):
+        if self.upload_id is None:
+            # Everything fits in one part, a plain PUT is cheaper than a multipart upload
+            await self.s3_utils.run_blocking(self.s3_utils.client.put_object, Bucket=self.bucket, Key=self.key,
+                                             Body=self.buffer.getvalue())
+        else:
+            if self.buffer.tell():
+                await self.flush_part()
+            await self.pending_upload
+            await self.s3_utils.run_blocking(self.s3_utils.client.complete_multipart_upload, Bucket=self.bucket,
+                                             Key=self.key, UploadId=self.upload_id,
+                                             MultipartUpload={'Parts': sorted(self.parts, key=lambda part: part['PartNumber'])})
+        self.s3_utils.log_throughput('multipart upload', self.key, self.bytes_written, self.start_time)
+        return f's3://{self.bucket}/{self.key}'
+
+    async def abort(self):
+        if self.upload_id is not None:
+            if self.pending_upload:
+                await asyncio.gather(self.pending_upload, return_exceptions=True)
+            await self.s3_utils.run_blocking(self.s3_utils.client.abort_multipart_upload, Bucket=self.bucket,
+                                             Key=self.key, UploadId=self.upload_id)
@@ -1,37 +1,190 @@
 import asyncio
 import json
-import boto3
+import random
+import time
+import traceback
 
+from app.common.clients import get_client
 from app.constant import AWS
 
 
 class SQSHelper:
     def __init__(self):
         self.aws_region = AWS.BotoClient.AWS_DEFAULT_REGION
-        self.sqs = boto3.client('sqs', region_name=self.aws_region)
+        # ApproximateReceiveCount of received messages by receipt handle, used by MessageLeaseManager
+        self.receive_counts = {}
 
-    async def consume_message(self, queue_url):
-        response = self.sqs.receive_message(
+    @property
+    def sqs(self):
+        return get_client('sqs')
+
+    async def consume_messages(self, queue_url, max_messages=10):
+        """ Receives up to max_messages (SQS caps this at 10) without blocking the event loop """
+        response = await asyncio.to_thread(
+            self.sqs.receive_message,
             QueueUrl=queue_url,
-            AttributeNames=['SentTimestamp'],
-            MaxNumberOfMessages=1,
+            AttributeNames=['SentTimestamp', 'ApproximateReceiveCount'],
+            MaxNumberOfMessages=max(1, min(max_messages, 10)),
             MessageAttributeNames=['All'],
             WaitTimeSeconds=20
         )
-        try:
-            message = response['Messages'][0]
-            receipt_handle = message['ReceiptHandle']
-            message_body = json.loads(message['Body'])
-        except KeyError:
-            message_body, receipt_handle = None, None
-        return message_body, receipt_handle
+        messages = []
+        for message in response.get('Messages', []):
+            receive_count = message.get('Attributes', {}).get('ApproximateReceiveCount', 1)
+            self.receive_counts[message['ReceiptHandle']] = int(receive_count)
+            messages.append((json.loads(message['Body']), message['ReceiptHandle']))
+        return messages
 
     async def publish_message(self, queue_url, message_body):
-        response = self.sqs.send_message(QueueUrl=queue_url, MessageBody=message_body)
+        response = await asyncio.to_thread(self.sqs.send_message, QueueUrl=queue_url, MessageBody=message_body)
         return response
 
     async def delete_message(self, queue_url, receipt_handle):
-        self.sqs.delete_message(
+        await asyncio.to_thread(
+            self.sqs.delete_message,
             QueueUrl=queue_url,
             ReceiptHandle=receipt_handle
         )
+
+    async def change_message_visibility(self, queue_url, receipt_handle, visibility_timeout):
+        await asyncio.to_thread(
+            self.sqs.change_message_visibility,
+            QueueUrl=queue_url,
+            ReceiptHandle=receipt_handle,
+            VisibilityTimeout=visibility_timeout
+        )
+
+    async def change_message_visibility_batch(self, queue_url, receipt_handles, visibility_timeout):
+        for start in range(0, len(receipt_handles), 10):
+            entries = [{'Id': str(index), 'ReceiptHandle': receipt_handle, 'VisibilityTimeout': visibility_timeout}
+                       for index, receipt_handle in enumerate(receipt_handles[start:start + 10])]
+            await asyncio.to_thread(self.sqs.change_message_visibility_batch, QueueUrl=queue_url, Entries=entries)
+
+    async def delete_message_batch(self, queue_url, receipt_handles):
+        failed = []
+        for start in range(0, len(receipt_handles), 10):
+            batch = receipt_handles[start:start + 10]
+            entries = [{'Id': str(index), 'ReceiptHandle': receipt_handle} for index, receipt_handle in enumerate(batch)]
+            response = await asyncio.to_thread(self.sqs.delete_message_batch, QueueUrl=queue_url, Entries=entries)
+            failed.extend(batch[int(entry['Id'])] for entry in response.get('Failed', []))
+        return failed
+
+
+class MessageLeaseManager:
+    """ At-least-once message handling for a runner queue.
+
+    A message's visibility is extended to LEASE_VISIBILITY_TIMEOUT_SECONDS as soon as it is leased, then
+    every HEARTBEAT_INTERVAL_SECONDS while it stays leased, so long work is not redelivered to another pod.
+    Leasing a message that is already leased does nothing, so a scheduler can lease messages on receipt
+    and the handler lease them again when they run.
+    ack() queues the message for DeleteMessageBatch. fail() makes it visible again after an exponential
+    backoff, or gives up once it has been received MAX_RECEIVE_COUNT times (or immediately for
+    non-retryable failures): the message moves to the dead-letter queue, or is logged and deleted when
+    the queue has none.
+    """
+
+    def __init__(self, sqs_helper, queue_url, logger, dead_letter_queue_url=None):
+        self.sqs_helper = sqs_helper
+        self.queue_url = queue_url
+        self.logger = logger
+        self.dead_letter_queue_url = dead_letter_queue_url
+        self.leases = {}
+        self.pending_acks = []
+        self.heartbeat_task = None
+        self.flush_task = None
+        self.extend_tasks = set()
+
+    def lease(self, receipt_handle):
+        self.lease_many([receipt_handle])
+
+    def lease_many(self, receipt_handles):
+        """ Leases the messages not leased yet, extending their visibility in one batch """
+        receipt_handles = [receipt_handle for receipt_handle in receipt_handles if receipt_handle not in self.leases]
+        if not receipt_handles:
+            return
+        for receipt_handle in receipt_handles:
+            self.leases[receipt_handle] = time.monotonic()
+        if self.heartbeat_task is None:
+            self.heartbeat_task = asyncio.ensure_future(self.heartbeat())
+        # The queue's own visibility timeout may be shorter than the first heartbeat
+        extend_task = asyncio.ensure_future(self.extend(receipt_handles))
+        self.extend_tasks.add(extend_task)
+        extend_task.add_done_callback(self.extend_tasks.discard)
+
+    def release_lease(self, receipt_handle):
+        self.leases.pop(receipt_handle, None)
+        return self.sqs_helper.receive_counts.pop(receipt_handle, 1)
+
+    async def extend(self, receipt_handles):
+        receipt_handles = [receipt_handle for receipt_handle in receipt_handles if receipt_handle in self.leases]
+        if not receipt_handles:
+            return
+        try:
+            await self.sqs_helper.change_message_visibility_batch(self.queue_url, receipt_handles,
+                                                                  AWS.SQS.LEASE_VISIBILITY_TIMEOUT_SECONDS)
+        except Exception as e:
+            self.logger.error('%s -> %s' % (e, traceback.format_exc()))
+
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(AWS.SQS.HEARTBEAT_INTERVAL_SECONDS)
+            await self.extend(list(self.leases))
+
+    async def ack(self, receipt_handle):
+        self.release_lease(receipt_handle)
+        self.pending_acks.append(receipt_handle)
+        if len(self.pending_acks) >= 10:
+            await self.flush()
+        elif self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.ensure_future(self.delayed_flush())
+
+    async def delayed_flush(self):
+        await asyncio.sleep(AWS.SQS.ACK_FLUSH_INTERVAL_SECONDS)
+        await self.flush()
+
+    async def flush(self):
+        receipt_handles, self.pending_acks = self.pending_acks, []
+        if not receipt_handles:
+            return
+        try:
+            failed = await self.sqs_helper.delete_message_batch(self.queue_url, receipt_handles)
+            for receipt_handle in failed:
+                await self.sqs_helper.delete_message(self.queue_url, receipt_handle)
+        except Exception as e:
+            self.logger.error('%s -> %s' % (e, traceback.format_exc()))
+
+    async def fail(self, receipt_handle, message_body, retryable=True):
+        receive_count = self.release_lease(receipt_handle)
+        try:
+            if not retryable or receive_count >= AWS.SQS.MAX_RECEIVE_COUNT:
+                if self.dead_letter_queue_url:
+                    self.logger.info(f'Moving message to dead-letter queue after {receive_count} attempt(s)')
+                    await self.sqs_helper.publish_message(self.dead_letter_queue_url, json.dumps(message_body))
+                else:
+                    self.logger.error(f'Deleting message after {receive_count} attempt(s), no dead-letter queue '
+                                      f'configured: {json.dumps(message_body)}')
+                await self.sqs_helper.delete_message(self.queue_url, receipt_handle)
+                return
+
+            delay = min(AWS.SQS.RETRY_BACKOFF_MAX_SECONDS, AWS.SQS.RETRY_BACKOFF_BASE_SECONDS * 2 ** (receive_count - 1))
+            delay = int(random.uniform(delay / 2, delay))
+            self.logger.info(f'Message failed on attempt {receive_count}, retrying in {delay} seconds')
+            await self.sqs_helper.change_message_visibility(self.queue_url, receipt_handle, delay)
+        except Exception as e:
+            self.logger.error('%s -> %s' % (e, traceback.format_exc()))
+
+    async def return_to_queue(self, receipt_handles):
+        """ Ends the leases of messages that were never handled and makes them visible again at once """
+        for receipt_handle in receipt_handles:
+            self.release_lease(receipt_handle)
+        try:
+            await self.sqs_helper.change_message_visibility_batch(self.queue_url, receipt_handles, 0)
+        except Exception as e:
+            self.logger.error('%s -> %s' % (e, traceback.format_exc()))
+
+    async def close(self):
+        if self.heartbeat_task:
+            self.heartbeat_task.cancel()
+        for extend_task in list(self.extend_tasks):
+            extend_task.cancel()
+        await self.flush()
@@ -1,30 +1,166 @@
+import math
 import os
 
 
+def get_cpu_limit():
+    """ CPUs this container may use: its cgroup CPU quota rounded up, else the host CPU count """
+    quota_files = [('/sys/fs/cgroup/cpu.max', None),
+                   ('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', '/sys/fs/cgroup/cpu/cpu.cfs_period_us')]
+    for quota_path, period_path in quota_files:
+        try:
+            with open(quota_path) as file:
+                values = file.read().split()
+            if period_path:
+                with open(period_path) as file:
+                    values.append(file.read().strip())
+            quota, period = values[0], values[1]
+            if quota not in ('max', '-1'):
+                return max(1, math.ceil(int(quota) / int(period)))
+        except (OSError, ValueError, IndexError):
+            continue
+    return os.cpu_count() or 1
+
+
 class AWS:
     class S3:
         S3_BUCKET = 'ds-medical-insights-extractor'
+        MAX_WORKERS = int(os.getenv('S3_MAX_WORKERS', 16))
+        MAX_POOL_CONNECTIONS = int(os.getenv('S3_MAX_POOL_CONNECTIONS', 32))
+        MULTIPART_THRESHOLD_MB = int(os.getenv('S3_MULTIPART_THRESHOLD_MB', 16))
+        MULTIPART_CHUNKSIZE_MB = int(os.getenv('S3_MULTIPART_CHUNKSIZE_MB', 16))
+        TRANSFER_MAX_CONCURRENCY = int(os.getenv('S3_TRANSFER_MAX_CONCURRENCY', 8))
 
     class BotoClient:
         AWS_DEFAULT_REGION = os.getenv('AWS_DEFAULT_REGION', 'ap-south-1')
+        MAX_POOL_CONNECTIONS = int(os.getenv('BOTO_MAX_POOL_CONNECTIONS', 20))
+
+    class SQS:
+        LEASE_VISIBILITY_TIMEOUT_SECONDS = int(os.getenv('SQS_LEASE_VISIBILITY_TIMEOUT_SECONDS', 300))
+        # Leases are renewed three times per visibility timeout, so one failed heartbeat does not lose them
+        HEARTBEAT_INTERVAL_SECONDS = max(1, LEASE_VISIBILITY_TIMEOUT_SECONDS // 3)
+        ACK_FLUSH_INTERVAL_SECONDS = 1
+        MAX_RECEIVE_COUNT = int(os.getenv('SQS_MAX_RECEIVE_COUNT', 5))
+        RETRY_BACKOFF_BASE_SECONDS = 30
+        RETRY_BACKOFF_MAX_SECONDS = 900
+
+    class Textract:
+        MAX_RESULTS = 1000
+        MAX_RETRIES = int(os.getenv('TEXTRACT_MAX_RETRIES', 8))
+        BACKOFF_BASE_SECONDS = 0.5
+        BACKOFF_MAX_SECONDS = 20
+        THROTTLING_ERROR_CODES = ('ThrottlingException', 'ProvisionedThroughputExceededException',
+                                  'LimitExceededException', 'InternalServerError')
+
+    class TextractCache:
+        PREFIX = os.getenv('TEXTRACT_CACHE_PREFIX', 'textract_cache')
+        LRU_MAX_MB = int(os.getenv('TEXTRACT_CACHE_LRU_MB', 64))
+        GZIP_LEVEL = 6
 
     class CloudWatch:
         LOG_GROUP = os.getenv('LOG_GROUP', 'ds-mrs-logs')
         TEXTRACT_RUNNER_STREAM = os.getenv('TEXTRACT_RUNNER_STREAM', 'textract-runner-service')
         LLM_RUNNER_STREAM = os.getenv('LLM_RUNNER_STREAM', 'llm-runner-service')
+        LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
 
 
 class MedicalInsights:
     MAX_PAGE_LIMIT = 3000
     MAX_SIZE_MB = 500
+    # Every split worker imports fitz and opens the source document, so memory bounds this as much as CPU does
+    SPLIT_WORKERS = int(os.getenv('SPLIT_WORKERS', min(get_cpu_limit(), 2)))
+    SPLIT_SIZE_SAFETY_FACTOR = 0.95
+    SPLIT_PAGE_OVERHEAD_BYTES = 2048
     TEXTRACT_FOLDER_NAME = "textract_response"
     SPLIT_DOCUMENT_JSON_FOLDER = "split_documents_json"
-    LOCAL_JSON_PATH = 'static/json_files/'
     STATIC_FOLDER_PATH = 'static/'
-    SPLIT_FILES_LOCAL_PATH = 'static/split_files'
+    SPLIT_MANIFEST_FOLDER = 'split_manifests'
+    MERGE_PREFETCH_PARTS = int(os.getenv('MERGE_PREFETCH_PARTS', 4))
     JSON_PATH_REPLACE_OLD = '/request/split_documents/'
     JSON_PATH_REPLACE_NEW = '/textract_response/split_documents_json/'
 
 
+class CompletionTracker:
+    BACKEND = os.getenv('COMPLETION_TRACKER_BACKEND', 's3')
+    SQLITE_PATH = os.getenv('COMPLETION_TRACKER_SQLITE_PATH', 'static/completion_tracker.db')
+    MAX_CONFLICT_RETRIES = 20
+
+
+class Idempotency:
+    ENABLED = os.getenv('IDEMPOTENCY_ENABLED', 'true').lower() == 'true'
+    BACKEND = os.getenv('IDEMPOTENCY_BACKEND', 's3')
+    SQLITE_PATH = os.getenv('IDEMPOTENCY_SQLITE_PATH', 'static/idempotency.db')
+    PREFIX = os.getenv('IDEMPOTENCY_PREFIX', 'idempotency')
+    # Job and Textract submissions are only trusted for this long, a run that failed later can be redone
+    SUBMISSION_TTL_SECONDS = int(os.getenv('IDEMPOTENCY_SUBMISSION_TTL_SECONDS', 6 * 60 * 60))
+
+
+class Metrics:
+    ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+    PORT = int(os.getenv('METRICS_PORT', 9100))
+
+
+class TextLayer:
+    ENABLED = os.getenv('TEXT_LAYER_DETECTION', 'false').lower() == 'true'
+    # Smaller documents keep the in-process or single Job path instead of being split around their text layer
+    MIN_DOCUMENT_PAGES = int(os.getenv('TEXT_LAYER_MIN_DOCUMENT_PAGES', 20))
+    MIN_CHARS = int(os.getenv('TEXT_LAYER_MIN_CHARS', 50))
+    MAX_IMAGE_COVERAGE = float(os.getenv('TEXT_LAYER_MAX_IMAGE_COVERAGE', 0.5))
+    MAX_UNMAPPED_RATIO = 0.05
+    CLASSIFY_BATCH_PAGES = 100
+    FILE_SUFFIX = '_text_layer.json'
+
+
+class TokenIndex:
+    ENABLED = os.getenv('TOKEN_INDEX_ENABLED', 'false').lower() == 'true'
+    # Hugging Face Hub name, recorded in the token index; downloaded on first use unless TOKENIZER_PATH exists
+    TOKENIZER = os.getenv('TOKEN_INDEX_TOKENIZER', 'bert-base-uncased')
+    # tokenizer.json of TOKENIZER as bundled in the LLM runner image
+    TOKENIZER_PATH = os.getenv('TOKEN_INDEX_TOKENIZER_PATH')
+    CHUNK_TOKEN_BUDGET = int(os.getenv('TOKEN_INDEX_CHUNK_TOKENS', 4000))
+    BATCH_SIZE = 64
+
+
+class PdfHeader:
+    TAIL_BYTES = 2048
+    LINEARIZED_HEADER_BYTES = 1024
+    OBJECT_READ_BYTES = 4096
+    XREF_HEADER_BYTES = 64
+    XREF_ENTRY_BYTES = 20
+    MAX_XREF_SECTIONS = 32
+
+
 class ExceptionMessage:
     TEXTRACT_FAILED_MESSAGE = 'Text extraction using Textract Async failed'
+    PDF_HEADER_UNSUPPORTED_MESSAGE = 'Page count could not be read from the PDF header'
+
+
+class Kubernetes:
+    JOB_SUBMIT_CONCURRENCY = int(os.getenv('JOB_SUBMIT_CONCURRENCY', 8))
+    JOB_SUBMIT_MAX_RETRIES = 5
+    CONNECTION_POOL_MAXSIZE = int(os.getenv('K8S_CONNECTION_POOL_MAXSIZE', 16))
+    BACKOFF_BASE_SECONDS = 0.5
+    BACKOFF_MAX_SECONDS = 10
+    INDEXED_JOB_FANOUT = os.getenv('INDEXED_JOB_FANOUT', 'false').lower() == 'true'
+    INDEXED_JOB_PARALLELISM = int(os.getenv('INDEXED_JOB_PARALLELISM', 10))
+
+
+class Scheduler:
+    ENABLED = os.getenv('FAIR_SCHEDULING', 'false').lower() == 'true'
+    MAX_HELD_MESSAGES = int(os.getenv('SCHEDULER_MAX_HELD_MESSAGES', 50))
+    PROJECT_WEIGHTS = os.getenv('SCHEDULER_PROJECT_WEIGHTS', '')
+    PROJECT_MAX_CONCURRENCY = int(os.getenv('SCHEDULER_PROJECT_MAX_CONCURRENCY', 2))
+    FAST_LANE_MAX_MB = float(os.getenv('SCHEDULER_FAST_LANE_MAX_MB', 20))
+
+
+class InProcess:
+    ENABLED = os.getenv('IN_PROCESS_EXECUTION', 'false').lower() == 'true'
+    MAX_PAGES = int(os.getenv('IN_PROCESS_MAX_PAGES', 50))
+    MAX_SIZE_MB = float(os.getenv('IN_PROCESS_MAX_SIZE_MB', 20))
+    MAX_WORKERS = int(os.getenv('IN_PROCESS_MAX_WORKERS', 4))
+
+
+class Runner:
+    MAX_CONCURRENT_MESSAGES = int(os.getenv('MAX_CONCURRENT_MESSAGES', 1))
+    SQS_BATCH_SIZE = 10
+    EMPTY_QUEUE_WAIT_SECONDS = 10
+    THROUGHPUT_LOG_INTERVAL_SECONDS = 60
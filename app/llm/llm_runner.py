@@ -2,23 +2,22 @@ import asyncio
 import json
 import os
 import sys
-import time
 import re
 import traceback
-import uuid
-import shutil
-from kubernetes import client, config
 from app.business_rule_exception import TextExtractionFailed
-from app.common.cloudwatch_helper import get_cloudwatch_logger
-from app.common.sqs_helper import SQSHelper
+from app.common.cloudwatch_helper import get_cloudwatch_logger, set_log_context
+from app.common.k8s_job_launcher import JobLauncher
+from app.common.message_pool import MessageWorkerPool
+from app.common.metrics import start_metrics_server, track_stage
+from app.common.sqs_helper import MessageLeaseManager, SQSHelper
 from app.common.utils import get_project_id_and_document
 from app.constant import AWS, MedicalInsights
 from app.service.helper.textract_helper import TextractHelper
 from app.common.s3_utils import S3Utils
 from app.service.helper.json_merger import merged_json_file
-
-# config.load_kube_config()   # Uncomment this line while testing in local
-config.load_incluster_config()
+from app.service.helper.completion_tracker import get_completion_tracker
+from app.service.helper.split_manifest import build_manifest_from_part_keys, get_manifest_path, load_manifest
+from app.service.helper.token_index import get_token_index_builder
 
 
 class LLMRunner:
@@ -30,29 +29,28 @@ class LLMRunner:
         self.logger = get_cloudwatch_logger(log_stream_name=AWS.CloudWatch.LLM_RUNNER_STREAM)
         self.textract_helper = None
         self.sqs_helper = SQSHelper()
+        self.lease_manager = MessageLeaseManager(self.sqs_helper, self.COMPLETED_TEXTRACT_QUEUE_URL, self.logger,
+                                                 os.getenv('COMPLETED_TEXTRACT_DLQ_URL'))
+        self.completion_tracker = get_completion_tracker(self.s3_utils)
+        self.job_launcher = JobLauncher('app/llm/job_manifest.json', 'llm-job', self.LLM_IMAGE_NAME, self.NAMESPACE,
+                                        self.logger)
 
     async def create_job(self, s3_json_path):
-        batch_v1 = client.BatchV1Api()
-
-        job_manifest = json.load(open('app/llm/job_manifest.json', 'r'))
-
-        job_name = f"llm-job-{uuid.uuid1()}"
-        job_manifest['metadata']['name'] = job_name
-
-        job_manifest['spec']['template']['spec']['containers'][0]['image'] = self.LLM_IMAGE_NAME
-
-        for env_variable in job_manifest['spec']['template']['spec']['containers'][0]['env']:
-            if env_variable['name'] == 'LLM_OUTPUT_QUEUE_URL':
-                env_variable['value'] = os.getenv('LLM_OUTPUT_QUEUE_URL')
-            elif env_variable['name'] == 'INPUT_MESSAGE':
-                env_variable['value'] = s3_json_path
-
-        batch_v1.create_namespaced_job(namespace=self.NAMESPACE, body=job_manifest)
-        self.logger.info(f'Job {job_name} created in namespace: {self.NAMESPACE}')
+        await self.job_launcher.create_job({
+            'LLM_OUTPUT_QUEUE_URL': os.getenv('LLM_OUTPUT_QUEUE_URL'),
+            'INPUT_MESSAGE': s3_json_path
+        }, self.logger)
+
+    async def add_token_index(self, textract_json_path, token_index_builder):
+        """ Uploads the token index sidecar and points the LLM job at it; the job works without one """
+        if token_index_builder is None:
+            return
+        with track_stage('token_index') as stage:
+            textract_json_path['token_index_path'] = await token_index_builder.upload(self.s3_utils, textract_json_path['textract_json_path'])
+        self.logger.info(f"Token index is written in {stage.elapsed} seconds.")
 
     async def process_splitted_pdf(self, message_body, file_path):
         self.logger.info("Processing started..")
-        original_file_path = '/'.join(file_path.split('/')[:-3]) + '/' + file_path.split('/')[-2].rsplit('_', 1)[0] + '.pdf'
         project_id_path = os.path.join(*file_path.split('/')[:3])
         pdf_name_without_extension = os.path.splitext(os.path.basename(file_path))[0]
         pdf_name = re.sub(r'_\d+_to_\d+$', '', pdf_name_without_extension)
@@ -61,42 +59,118 @@ class LLMRunner:
 
         pdf_path = os.path.dirname(message_body['DocumentLocation']['S3ObjectName'])
         json_path = pdf_path.replace(MedicalInsights.JSON_PATH_REPLACE_OLD, MedicalInsights.JSON_PATH_REPLACE_NEW)
-        local_json_path = MedicalInsights.LOCAL_JSON_PATH
-
-        self.logger.info("S3 download started")
-        pdf_count = await self.s3_utils.get_s3_path_object_count(AWS.S3.S3_BUCKET, pdf_path)
-        json_count = await self.s3_utils.get_s3_path_object_count(AWS.S3.S3_BUCKET, json_path)
-        self.logger.info("S3 download completed")
 
-        if pdf_count == json_count:
-            os.makedirs(local_json_path, exist_ok=True)
-            await self.s3_utils.download_multiple_files(AWS.S3.S3_BUCKET, json_path)
+        manifest = await load_manifest(self.s3_utils, file_path)
+        if manifest is None:
+            # Document split before manifests were written, rebuild the page offsets from the part names
+            original_file_path = '/'.join(file_path.split('/')[:-3]) + '/' + file_path.split('/')[-2].rsplit('_', 1)[0] + '.pdf'
+            response = await self.s3_utils.check_s3_path_exists(AWS.S3.S3_BUCKET, f'{pdf_path}/')
+            part_keys = [obj['Key'] for obj in response['Contents']] if response else []
+            manifest = build_manifest_from_part_keys(original_file_path, part_keys)
+
+        part_index = next((index for index, part in enumerate(manifest['parts'])
+                           if part['name'] == pdf_name_without_extension), None)
+        if part_index is None:
+            raise ValueError(f'{pdf_name_without_extension} is not listed in the split manifest')
+
+        document_key = get_manifest_path(manifest['document_path'])
+        claimed, completed = await self.completion_tracker.mark_complete(document_key, part_index, manifest['part_count'],
+                                                                         manifest.get('split_id'))
+
+        if claimed:
+            try:
+                await self.merge_and_create_job(json_path, manifest)
+            except Exception:
+                await self.completion_tracker.release(document_key, manifest.get('split_id'))
+                raise
+        else:
+            self.logger.info(f"{completed}/{manifest['part_count']} documents processed by Textract.")
 
-            start_time = time.time()
-            self.logger.info("Merging JSON file is started...")
+    async def merge_and_create_job(self, json_path, manifest):
+        self.logger.info("Merging JSON file is started...")
 
-            merged_s3_json_path = await merged_json_file(local_json_path, json_path)
-            self.logger.info(f"Merging JSON file is completed in {time.time() - start_time} seconds.")
+        token_index_builder = await get_token_index_builder()
+        try:
+            with track_stage('merge') as stage:
+                merged_s3_json_path = await merged_json_file(json_path, manifest, token_index_builder)
+        except Exception:
+            if token_index_builder:
+                token_index_builder.cancel()
+            raise
+        self.logger.info(f"Merging JSON file is completed in {stage.elapsed} seconds.")
+
+        textract_json_path = {"textract_json_path": merged_s3_json_path, "document_path": manifest['document_path']}
+        await self.add_token_index(textract_json_path, token_index_builder)
+        json_data = json.dumps(textract_json_path)
 
-            if os.path.exists(local_json_path):
-                shutil.rmtree(local_json_path)
+        await self.create_job(json_data)
 
-            textract_json_path = {"textract_json_path": merged_s3_json_path, "document_path": original_file_path}
-            json_data = json.dumps(textract_json_path)
+    async def process_text_layer_pdf(self, message_body):
+        """ Document whose every page was read from its text layer by the Textract runner, nothing to wait for.
+        It is claimed through the completion tracker as a single part, so a redelivered message is not merged twice. """
+        document_key = message_body['split_manifest_path']
+        manifest = json.loads(await self.s3_utils.read_object(AWS.S3.S3_BUCKET, document_key))
+        claimed, _ = await self.completion_tracker.mark_complete(document_key, 0, 1, manifest.get('split_id'))
+        if not claimed:
+            self.logger.info(f"{manifest['document_path']} already merged, skipping.")
+            return
 
-            await self.create_job(json_data)
-        else:
-            self.logger.info(f"{json_count}/{pdf_count} documents processed by Textract.")
+        try:
+            await self.merge_and_create_job(os.path.dirname(manifest['text_layer']['key']), manifest)
+        except Exception:
+            await self.completion_tracker.release(document_key, manifest.get('split_id'))
+            raise
 
     async def process_single_pdf(self, message_body, file_path, pdf_name):
         s3_textract_path = os.path.join(os.path.dirname(os.path.dirname(file_path)), MedicalInsights.TEXTRACT_FOLDER_NAME, f'{pdf_name}_text.json')
-        await self.textract_helper.get_page_wise_text(message_body, s3_textract_path)
+        page_wise_text = await self.textract_helper.get_page_wise_text(message_body, s3_textract_path)
 
         textract_json_path = {"textract_json_path": s3_textract_path, "document_path": file_path}
+        token_index_builder = await get_token_index_builder()
+        if token_index_builder:
+            token_index_builder.add_pages({int(key.split('_')[1]): text for key, text in page_wise_text.items()})
+        await self.add_token_index(textract_json_path, token_index_builder)
         json_data = json.dumps(textract_json_path)
 
         await self.create_job(json_data)
 
+    async def process_message(self, message_body, receipt_handle):
+        self.logger.info(f"Message body from Queue: {message_body}")
+        if receipt_handle:
+            self.lease_manager.lease(receipt_handle)
+        try:
+            project_id, document_name = await get_project_id_and_document(message_body['DocumentLocation']['S3ObjectName'])
+            set_log_context(project_id=project_id, document_name=document_name)
+            self.textract_helper = TextractHelper(self.logger)
+
+            if message_body['Status'] != "SUCCEEDED":
+                raise TextExtractionFailed
+
+            file_path = message_body['DocumentLocation']['S3ObjectName']
+            pdf_name = os.path.basename(file_path)
+
+            if 'split_manifest_path' in message_body:
+                self.logger.info("Processing text layer PDF")
+                await self.process_text_layer_pdf(message_body)
+            elif '/split_documents/' in file_path:
+                self.logger.info("Processing split PDF")
+                await self.process_splitted_pdf(message_body, file_path)
+            else:
+                self.logger.info("Processing single PDF")
+                await self.process_single_pdf(message_body, file_path, pdf_name)
+            if receipt_handle:
+                await self.lease_manager.ack(receipt_handle)
+        except Exception as e:
+            self.logger.error('%s -> %s' % (e, traceback.format_exc()))
+            if receipt_handle:
+                # A failed Textract job will not succeed on retry
+                await self.lease_manager.fail(receipt_handle, message_body, retryable=not isinstance(e, TextExtractionFailed))
+        finally:
+            sys.stdout.flush()
+
+    def create_worker_pool(self):
+        return MessageWorkerPool(self.sqs_helper, self.COMPLETED_TEXTRACT_QUEUE_URL, self.process_message, self.logger)
+
     async def runner(self):
         try:
             if not self.NAMESPACE:
@@ -109,38 +183,11 @@ class LLMRunner:
                 self.logger.info('Configuration incomplete. Please configure COMPLETED_TEXTRACT_QUEUE_URL variable.')
                 exit(0)
 
+            start_metrics_server()
             self.logger.info(f'Reading messages from queue: {self.COMPLETED_TEXTRACT_QUEUE_URL.split("/")[-1]}')
-            while True:
-                message_body, receipt_handle = await self.sqs_helper.consume_message(self.COMPLETED_TEXTRACT_QUEUE_URL)
-                if not (message_body and receipt_handle):
-                    time.sleep(10)
-                    continue
-
-                self.logger.info(f'Message received from queue: {self.COMPLETED_TEXTRACT_QUEUE_URL.split("/")[-1]}')
-                self.logger.info(f"Message body from Queue: {message_body}")
-                try:
-                    project_id, document_name = await get_project_id_and_document(message_body['DocumentLocation']['S3ObjectName'])
-                    self.logger = get_cloudwatch_logger(project_id=project_id, document_name=document_name, log_stream_name=AWS.CloudWatch.LLM_RUNNER_STREAM)
-                    self.textract_helper = TextractHelper(self.logger)
-
-                    if message_body['Status'] != "SUCCEEDED":
-                        raise TextExtractionFailed
-
-                    file_path = message_body['DocumentLocation']['S3ObjectName']
-                    pdf_name = os.path.basename(file_path)
-
-                    if '/split_documents/' in file_path:
-                        self.logger.info("Processing split PDF")
-                        await self.process_splitted_pdf(message_body, file_path)
-                    else:
-                        self.logger.info("Processing single PDF")
-                        await self.process_single_pdf(message_body, file_path, pdf_name)
-                except Exception as e:
-                    self.logger.error('%s -> %s' % (e, traceback.format_exc()))
-                finally:
-                    if receipt_handle:
-                        await self.sqs_helper.delete_message(self.COMPLETED_TEXTRACT_QUEUE_URL, receipt_handle)
-                    sys.stdout.flush()
+            pool = self.create_worker_pool()
+            await pool.run()
+            await self.lease_manager.close()
         except Exception as e:
             self.logger.error('%s -> %s' % (e, traceback.format_exc()))
 
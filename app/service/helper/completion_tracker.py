@@ -0,0 +1,153 @@
+import asyncio
+import json
+import os
+import random
+import sqlite3
+
+from botocore.exceptions import ClientError
+
+from app.constant import AWS, CompletionTracker as CompletionTrackerConfig
+
+
+class SQLiteCompletionBackend:
+    """ Local backend, one SQLite file shared by every process on the host. Used for tests and local runs. """
+
+    def __init__(self, db_path=CompletionTrackerConfig.SQLITE_PATH):
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db_path = db_path
+        with self.connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS completed_parts '
+                               '(document_key TEXT, part_index INTEGER, PRIMARY KEY (document_key, part_index))')
+            connection.execute('CREATE TABLE IF NOT EXISTS merge_claims (document_key TEXT PRIMARY KEY)')
+
+    def connect(self):
+        return sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+
+    @staticmethod
+    def get_split_key(document_key, split_id):
+        return f'{document_key}#{split_id}' if split_id else document_key
+
+    def mark_complete_sync(self, document_key, part_index, part_count, split_id=None):
+        document_key = self.get_split_key(document_key, split_id)
+        connection = self.connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute('INSERT OR IGNORE INTO completed_parts VALUES (?, ?)', (document_key, part_index))
+            completed = connection.execute('SELECT COUNT(*) FROM completed_parts WHERE document_key = ?',
+                                           (document_key,)).fetchone()[0]
+            claimed = False
+            if completed >= part_count:
+                claimed = connection.execute('INSERT OR IGNORE INTO merge_claims VALUES (?)', (document_key,)).rowcount == 1
+            connection.execute('COMMIT')
+            return claimed, completed
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        finally:
+            connection.close()
+
+    def release_sync(self, document_key, split_id=None):
+        document_key = self.get_split_key(document_key, split_id)
+        connection = self.connect()
+        try:
+            connection.execute('DELETE FROM merge_claims WHERE document_key = ?', (document_key,))
+        finally:
+            connection.close()
+
+    async def mark_complete(self, document_key, part_index, part_count, split_id=None):
+        return await asyncio.to_thread(self.mark_complete_sync, document_key, part_index, part_count, split_id)
+
+    async def release(self, document_key, split_id=None):
+        await asyncio.to_thread(self.release_sync, document_key, split_id)
+
+
+class S3CompletionBackend:
+    """ Production backend: one small JSON state object per document, updated with S3 conditional writes.
+
+    Every update is a read followed by a PUT guarded by If-Match (or If-None-Match for the first write),
+    so concurrent completions of different parts retry instead of overwriting each other.
+    The state belongs to one split of the document: a completion from a newer split starts it over.
+    """
+
+    def __init__(self, s3_utils):
+        self.s3_utils = s3_utils
+
+    def get_state_path(self, document_key):
+        return f'{os.path.splitext(document_key)[0]}.progress.json'
+
+    async def read_state(self, state_path):
+        try:
+            response = await self.s3_utils.run_blocking(self.s3_utils.client.get_object, Bucket=AWS.S3.S3_BUCKET,
+                                                        Key=state_path)
+        except self.s3_utils.client.exceptions.NoSuchKey:
+            return {"completed": [], "claimed": False}, None
+        body = await self.s3_utils.run_blocking(response['Body'].read)
+        return json.loads(body), response['ETag']
+
+    async def update(self, document_key, change):
+        """ Applies change(state) -> result atomically, retrying on a lost race """
+        state_path = self.get_state_path(document_key)
+        for attempt in range(CompletionTrackerConfig.MAX_CONFLICT_RETRIES):
+            state, etag = await self.read_state(state_path)
+            result = change(state)
+            condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+            try:
+                await self.s3_utils.run_blocking(self.s3_utils.client.put_object, Bucket=AWS.S3.S3_BUCKET,
+                                                 Key=state_path, Body=json.dumps(state).encode('utf-8'), **condition)
+                return result
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                    raise
+                await asyncio.sleep(random.uniform(0, 0.05 * 2 ** min(attempt, 6)))
+        raise RuntimeError(f'Could not update completion state of {document_key}, too many concurrent writers')
+
+    @staticmethod
+    def reset_for_split(state, split_id):
+        if state.get('split_id') != split_id:
+            state.update({"split_id": split_id, "completed": [], "claimed": False})
+
+    async def mark_complete(self, document_key, part_index, part_count, split_id=None):
+        def change(state):
+            self.reset_for_split(state, split_id)
+            if part_index not in state['completed']:
+                state['completed'].append(part_index)
+            completed = len(state['completed'])
+            claimed = completed >= part_count and not state['claimed']
+            if claimed:
+                state['claimed'] = True
+            return claimed, completed
+
+        return await self.update(document_key, change)
+
+    async def release(self, document_key, split_id=None):
+        def change(state):
+            if state.get('split_id') == split_id:
+                state['claimed'] = False
+
+        await self.update(document_key, change)
+
+
+class CompletionTracker:
+    """ Records split part completions and reports the single completion that makes a document whole.
+
+    mark_complete returns (claimed, completed_parts); claimed is True for exactly one caller per document,
+    the one whose part completes the set. If the merge it triggers fails, release() lets a redelivery retry it.
+    Completions are counted per split_id of the manifest, so splitting the same document again starts over.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    async def mark_complete(self, document_key, part_index, part_count, split_id=None):
+        return await self.backend.mark_complete(document_key, part_index, part_count, split_id)
+
+    async def release(self, document_key, split_id=None):
+        await self.backend.release(document_key, split_id)
+
+
+def get_completion_tracker(s3_utils):
+    if CompletionTrackerConfig.BACKEND == 'sqlite':
+        return CompletionTracker(SQLiteCompletionBackend())
+    return CompletionTracker(S3CompletionBackend(s3_utils))
@@ -0,0 +1,106 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+from app.constant import AWS, Idempotency
+
+
+def get_record_id(content_key, stage, document_path):
+    """ Outputs are written under the document's own prefix, so records are scoped to the document path too """
+    document_hash = hashlib.sha1(document_path.encode('utf-8')).hexdigest()
+    return f'{content_key}/{stage}/{document_hash}'
+
+
+class SQLiteIdempotencyBackend:
+    """ Local backend, one SQLite file shared by every process on the host. Used for tests and local runs. """
+
+    def __init__(self, db_path=Idempotency.SQLITE_PATH):
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db_path = db_path
+        with self.connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS completed_stages (record_id TEXT PRIMARY KEY, result TEXT)')
+
+    def connect(self):
+        return sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+
+    def get_sync(self, record_id):
+        connection = self.connect()
+        try:
+            row = connection.execute('SELECT result FROM completed_stages WHERE record_id = ?', (record_id,)).fetchone()
+            return json.loads(row[0]) if row else None
+        finally:
+            connection.close()
+
+    def put_sync(self, record_id, result):
+        connection = self.connect()
+        try:
+            connection.execute('INSERT OR REPLACE INTO completed_stages VALUES (?, ?)', (record_id, json.dumps(result)))
+        finally:
+            connection.close()
+
+    async def get(self, record_id):
+        return await asyncio.to_thread(self.get_sync, record_id)
+
+    async def put(self, record_id, result):
+        await asyncio.to_thread(self.put_sync, record_id, result)
+
+
+class S3IdempotencyBackend:
+    """ Production backend: one small JSON object per completed stage under IDEMPOTENCY_PREFIX """
+
+    def __init__(self, s3_utils):
+        self.s3_utils = s3_utils
+
+    def get_record_path(self, record_id):
+        return f'{Idempotency.PREFIX}/{record_id}.json'
+
+    async def get(self, record_id):
+        try:
+            return json.loads(await self.s3_utils.read_object(AWS.S3.S3_BUCKET, self.get_record_path(record_id)))
+        except self.s3_utils.client.exceptions.NoSuchKey:
+            return None
+
+    async def put(self, record_id, result):
+        await self.s3_utils.upload_object(AWS.S3.S3_BUCKET, self.get_record_path(record_id),
+                                          json.dumps(result).encode('utf-8'))
+
+
+class IdempotencyStore:
+    """ Remembers processing stages already completed for a document's content.
+
+    Records are keyed by the source content key (see s3_utils.get_content_key) and a stage name, so a
+    redelivered or resubmitted message for unchanged content can skip the stage and reuse its result,
+    while a re-uploaded document with new content is processed again. A stage is recorded only after
+    it succeeds, so a failure part way through is simply redone. Stages that only submit work (a Job, a
+    Textract run) are read with max_age, so a submission that later failed is not skipped forever.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    async def get(self, content_key, stage, document_path, max_age=None):
+        """ The recorded result, or None when there is none or it is older than max_age seconds """
+        if not content_key:
+            return None
+        result = await self.backend.get(get_record_id(content_key, stage, document_path))
+        if result and max_age is not None and time.time() - result.get('recorded_at', 0) > max_age:
+            return None
+        return result
+
+    async def put(self, content_key, stage, document_path, result):
+        if content_key:
+            await self.backend.put(get_record_id(content_key, stage, document_path),
+                                   dict(result, recorded_at=time.time()))
+
+
+def get_idempotency_store(s3_utils):
+    if not Idempotency.ENABLED:
+        return None
+    if Idempotency.BACKEND == 'sqlite':
+        return IdempotencyStore(SQLiteIdempotencyBackend())
+    return IdempotencyStore(S3IdempotencyBackend(s3_utils))
@@ -1,45 +1,92 @@
+import asyncio
+import bisect
 import os
 import json
-from app.constant import AWS
-from app.common.s3_utils import S3Utils
+from app.constant import AWS, MedicalInsights
+from app.common.s3_utils import S3Utils, S3MultipartWriter
+from app.service.helper.split_manifest import load_text_layer
 
 s3_utils = S3Utils()
 
 
-async def merged_json_file(local_json_path, json_path):
-    sorted_paths = sorted(os.listdir(local_json_path))
+def encode_entry(key, value, first):
+    """ Encodes one key/value pair exactly as json.dump would inside the merged object """
+    separator = '' if first else ', '
+    return f'{separator}{json.dumps(key)}: {json.dumps(value)}'.encode('utf-8')
 
-    file_path = os.path.join(local_json_path, sorted_paths[0])
-    with open(file_path, 'r') as file:
-        merged_json = json.load(file)
 
-    page_counter = len(merged_json)
+async def load_part(json_path, part):
+    body = await s3_utils.read_object(AWS.S3.S3_BUCKET, os.path.join(json_path, f"{part['name']}_text.json"))
+    return await asyncio.to_thread(json.loads, body)
 
-    for file_idx in range(1, len(sorted_paths)):
-        filename = sorted_paths[file_idx]
 
-        if filename.endswith('.json'):
-            file_path = os.path.join(local_json_path, filename)
-            with open(file_path, 'r') as file:
-                data = json.load(file)
+def get_page_number(page_key):
+    return int(page_key[len('page_'):])
 
-            for key in data.keys():
-                if key.startswith('page_'):
-                    page_counter += 1
-                    new_page_key = f'page_{page_counter}'
-                    merged_json[new_page_key] = data[key]
 
+def get_part_pages(part, data):
+    """ {absolute page number: text} of a part's Textract JSON, in page order """
+    page_keys = sorted((key for key in data if key.startswith('page_')), key=get_page_number)
+    if 'pages' in part:
+        # Part compacted from the pages without a text layer
+        return {part['pages'][get_page_number(key) - 1]: data[key] for key in page_keys}
+    return {part['start_page'] + get_page_number(key) - 1: data[key] for key in page_keys}
+
+
+async def merged_json_file(json_path, manifest, token_index_builder=None):
+    """ Streams the pages of every split part straight into a multipart S3 upload.
+
+    Parts come from the split manifest rather than a directory listing, and each page_N of a part is
+    written as page_<start_page + N - 1>, so pages land at their absolute position even when a part has
+    blank pages without Textract lines. Part JSONs are fetched from S3 into memory and parsed concurrently,
+    a few parts ahead of the writer, so nothing touches local disk and concurrent merges cannot collide.
+    Pages the Textract runner read from the document's text layer are stitched in between the parts' pages.
+    With a token_index_builder, each part's pages are handed to it for tokenizing while the merge goes on.
+    """
     document_name = os.path.basename(json_path)
     output_json_filename = f'{document_name}_text.json'
-    output_json_path = os.path.join(local_json_path, output_json_filename)
+    upload_json_path = os.path.join(json_path.split('textract_response')[0], 'textract_response', output_json_filename)
 
-    with open(output_json_path, 'w') as outfile:
-        json.dump(merged_json, outfile)
+    parts = sorted(manifest['parts'], key=lambda part: part['start_page'])
+    text_layer_pages = await load_text_layer(s3_utils, manifest)
+    text_layer_page_numbers = sorted(text_layer_pages)
+    loads = {}
 
-    with open(output_json_path, 'rb') as f:
-        file_data = f.read()
+    def prefetch(index):
+        if index < len(parts) and index not in loads:
+            loads[index] = asyncio.ensure_future(load_part(json_path, parts[index]))
 
-    upload_json_path = os.path.join(json_path.split('textract_response')[0], 'textract_response', output_json_filename)
-    await s3_utils.upload_object(AWS.S3.S3_BUCKET, upload_json_path, file_data)
+    for index in range(MedicalInsights.MERGE_PREFETCH_PARTS):
+        prefetch(index)
+
+    try:
+        async with S3MultipartWriter(s3_utils, AWS.S3.S3_BUCKET, upload_json_path) as writer:
+            await writer.write(b'{')
+
+            async def write_pages(pages):
+                if token_index_builder:
+                    token_index_builder.add_pages(pages)
+                for page_number, text in pages.items():
+                    await writer.write(encode_entry(f'page_{page_number}', text, writer.bytes_written == 1))
+
+            next_text_layer_index = 0
+            for index, part in enumerate(parts):
+                prefetch(index + MedicalInsights.MERGE_PREFETCH_PARTS)
+                pages = get_part_pages(part, await loads.pop(index))
+
+                end_index = bisect.bisect_right(text_layer_page_numbers, part['end_page'])
+                if end_index > next_text_layer_index:
+                    pages.update((page_number, text_layer_pages[page_number])
+                                 for page_number in text_layer_page_numbers[next_text_layer_index:end_index])
+                    pages = dict(sorted(pages.items()))
+                    next_text_layer_index = end_index
+                await write_pages(pages)
+
+            await write_pages({page_number: text_layer_pages[page_number]
+                               for page_number in text_layer_page_numbers[next_text_layer_index:]})
+            await writer.write(b'}')
+    finally:
+        for load in loads.values():
+            load.cancel()
 
     return upload_json_path
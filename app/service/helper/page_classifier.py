@@ -0,0 +1,41 @@
+import fitz
+
+UNMAPPED_CHARACTER = '\ufffd'
+
+
+def get_page_text(page):
+    """ Native text of a page in the page_N format of the Textract JSON: its lines joined by spaces """
+    lines = [line.strip() for line in page.get_text('text').splitlines()]
+    lines = [line for line in lines if line]
+    return ' '.join(lines) + ' ' if lines else ''
+
+
+def get_image_coverage(page):
+    """ Fraction of the page area drawn over by images """
+    page_area = abs(page.rect)
+    if not page_area:
+        return 0.0
+    covered_area = sum(abs(rect & page.rect) for image in page.get_images(full=True)
+                       for rect in page.get_image_rects(image[0]))
+    return min(covered_area / page_area, 1.0)
+
+
+def classify_pages(source_path, start_page, end_page, min_chars, max_image_coverage, max_unmapped_ratio):
+    """ Runs in a split worker process: for every page in [start_page, end_page) returns its native text when
+    the text layer is usable, or None when the page needs OCR.
+
+    A text layer is usable when it has at least min_chars visible characters, fonts without a unicode
+    mapping did not garble it, and images cover at most max_image_coverage of the page (scans with a
+    partial OCR layer or a typed header over a scanned body go to Textract).
+    """
+    texts = []
+    with fitz.open(source_path) as pdf_document:
+        for page_number in range(start_page, end_page):
+            page = pdf_document[page_number]
+            text = get_page_text(page)
+            char_count = sum(not char.isspace() for char in text)
+            usable = (char_count >= min_chars
+                      and text.count(UNMAPPED_CHARACTER) <= char_count * max_unmapped_ratio
+                      and get_image_coverage(page) <= max_image_coverage)
+            texts.append(text if usable else None)
+    return texts
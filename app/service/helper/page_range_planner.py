@@ -0,0 +1,97 @@
+import re
+
+import fitz
+
+from app.constant import MedicalInsights
+
+PARENT_PATTERN = re.compile(r'/Parent\s+\d+\s+\d+\s+R')
+REFERENCE_PATTERN = re.compile(r'(\d+)\s+\d+\s+R\b')
+PAGE_TYPE_PATTERN = re.compile(r'/Type\s*/Page\b')
+
+
+def get_stream_length(pdf_document, xref):
+    value_type, value = pdf_document.xref_get_key(xref, 'Length')
+    if value_type == 'int':
+        return int(value)
+    # Indirect or missing /Length, read the raw stream once
+    return len(pdf_document.xref_stream_raw(xref) or b'')
+
+
+def read_object(pdf_document, xref, cache):
+    """ (byte size, referenced xrefs, is a page) of one object, read once per xref """
+    if xref not in cache:
+        source = pdf_document.xref_object(xref, compressed=True)
+        size = len(source)
+        if pdf_document.xref_is_stream(xref):
+            size += get_stream_length(pdf_document, xref)
+        references = {int(match) for match in REFERENCE_PATTERN.findall(PARENT_PATTERN.sub('', source))}
+        cache[xref] = (size, references, bool(PAGE_TYPE_PATTERN.search(source)))
+    return cache[xref]
+
+
+def measure_page_sizes(pdf_document):
+    """ Returns, for every page, the byte size of each object it needs keyed by xref.
+
+    Every object reachable from the page is measured: contents, fonts and their font files, images and
+    their soft masks, annotations and their appearance streams, ExtGStates, patterns and shadings. The
+    walk stops at other pages (link destinations, the page tree). Objects are measured once per xref, so
+    resources shared between pages can be counted once per part by the planner.
+    """
+    cache = {}
+    xref_count = pdf_document.xref_length()
+    page_sizes = []
+
+    for page in pdf_document:
+        page_objects = {}
+        pending = [page.xref]
+        while pending:
+            xref = pending.pop()
+            if xref in page_objects or not 0 < xref < xref_count:
+                continue
+            size, references, is_page = read_object(pdf_document, xref, cache)
+            if is_page and xref != page.xref:
+                continue
+            page_objects[xref] = size
+            pending.extend(references)
+        page_sizes.append(page_objects)
+
+    return page_sizes
+
+
+def measure_document_page_sizes(source_path):
+    """ Runs in a split worker process: measure_page_sizes of the PDF at source_path, opened read-only """
+    with fitz.open(source_path) as pdf_document:
+        return measure_page_sizes(pdf_document)
+
+
+def plan_page_ranges(page_sizes, max_pages=None, max_bytes=None):
+    """ Greedily packs contiguous pages into [start, end) ranges under both the page and the size limit.
+
+    A part's size only grows when pages are appended, so filling every part as far as it goes yields the
+    minimal number of parts. A single page that is larger than max_bytes on its own becomes its own part.
+    """
+    max_pages = max_pages or MedicalInsights.MAX_PAGE_LIMIT
+    max_bytes = max_bytes or MedicalInsights.MAX_SIZE_MB * 1024 * 1024 * MedicalInsights.SPLIT_SIZE_SAFETY_FACTOR
+    page_ranges = []
+    start_page = 0
+    part_bytes = 0
+    part_xrefs = set()
+
+    for page_number, page_objects in enumerate(page_sizes):
+        new_xrefs = page_objects.keys() - part_xrefs
+        page_bytes = MedicalInsights.SPLIT_PAGE_OVERHEAD_BYTES + sum(page_objects[xref] for xref in new_xrefs)
+        page_count = page_number - start_page
+
+        if page_count and (page_count >= max_pages or part_bytes + page_bytes > max_bytes):
+            page_ranges.append((start_page, page_number))
+            start_page = page_number
+            part_xrefs = set(page_objects)
+            part_bytes = MedicalInsights.SPLIT_PAGE_OVERHEAD_BYTES + sum(page_objects.values())
+        else:
+            part_xrefs.update(new_xrefs)
+            part_bytes += page_bytes
+
+    if start_page < len(page_sizes):
+        page_ranges.append((start_page, len(page_sizes)))
+
+    return page_ranges
@@ -0,0 +1,23 @@
+import fitz
+
+
+def get_page_runs(page_numbers):
+    """ Groups sorted 0-based page numbers into (first, last) runs of consecutive pages """
+    runs = []
+    for page_number in page_numbers:
+        if runs and runs[-1][1] == page_number - 1:
+            runs[-1][1] = page_number
+        else:
+            runs.append([page_number, page_number])
+    return runs
+
+
+def write_pages(source_path, page_numbers, output_path):
+    """ Runs in a split worker process: copies the given 0-based pages of the source, in order, into output_path """
+    with fitz.open(source_path) as pdf_document:
+        writer = fitz.open()
+        for first_page, last_page in get_page_runs(page_numbers):
+            writer.insert_pdf(pdf_document, from_page=first_page, to_page=last_page)
+        writer.save(output_path)
+        writer.close()
+    return output_path
@@ -1,121 +1,151 @@
+import asyncio
+import logging
+import multiprocessing
 import os
-import fitz
-from app.constant import AWS, MedicalInsights
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from app.common.metrics import PAGES, SPLIT_PARTS
+from app.constant import AWS, MedicalInsights, TextLayer
 from app.common.s3_utils import S3Utils
+from app.service.helper.page_classifier import classify_pages
+from app.service.helper.page_range_planner import measure_document_page_sizes, plan_page_ranges
+from app.service.helper.pdf_part_writer import write_pages
+from app.service.helper.split_manifest import build_manifest, upload_manifest, upload_text_layer
 
 s3_utils = S3Utils()
-
-
-async def split_pdf(document_path, document_size, document_pages):
-    document_name = os.path.basename(document_path)
-    document_name_without_extension = os.path.splitext(document_name)[0]
-    local_pdf_path = os.path.join(MedicalInsights.STATIC_FOLDER_PATH, document_name)
-    await s3_utils.download_object(AWS.S3.S3_BUCKET, document_path, local_pdf_path)
-
-    with fitz.open(local_pdf_path) as pdf_document:
-        pdf_document = fitz.open(pdf_document)
-
-    avg_page_size = document_size / document_pages
-    max_pages_per_part = document_pages
-
-    while max_pages_per_part > MedicalInsights.MAX_PAGE_LIMIT or (max_pages_per_part * avg_page_size) >= MedicalInsights.MAX_SIZE_MB:
-        max_pages_per_part = max_pages_per_part // 2
-
-    part_num = 1
-    start_page = 0
-    output_dir = MedicalInsights.SPLIT_FILES_LOCAL_PATH
-
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-
-    temp_files = []
-    s3_paths = []
-
-    while start_page < document_pages:
-        remaining_pages = document_pages - start_page
-
-        if remaining_pages <= max_pages_per_part + 1:
-            max_pages_per_part = remaining_pages
-
-        writer = fitz.open()
-
-        end_page = min(start_page + max_pages_per_part, document_pages)
-
-        writer.insert_pdf(pdf_document, from_page=start_page, to_page=end_page - 1)
-
-        temp_output = os.path.join(output_dir, f"{document_name_without_extension}_{start_page + 1}_to_{end_page}.pdf")
-        writer.save(temp_output)
-        temp_files.append(temp_output)
-
-        part_num += 1
-        start_page = end_page
-
-    pdf_document.close()
-
-    for temp_file in temp_files:
-        part_size_mb = os.path.getsize(temp_file) / (1024 * 1024)
-
-        if part_size_mb > MedicalInsights.MAX_SIZE_MB:
-            reduce_pdf_size(temp_file, output_dir, MedicalInsights.MAX_SIZE_MB)
-
-        # Upload files to s3
-        directory_path = os.path.dirname(document_path)
-        s3_folder_path = os.path.join(directory_path, 'split_documents', document_name_without_extension)
-        s3_path = os.path.join(s3_folder_path, os.path.basename(temp_file))
-        with open(temp_file, 'rb') as f:
-            file_object = f.read()
-        await s3_utils.upload_object(AWS.S3.S3_BUCKET, s3_path, file_object)
-        s3_paths.append(s3_path)
-
-    for temp_file in temp_files:
-        if os.path.exists(temp_file):
-            os.remove(temp_file)
-    return s3_paths
-
-
-def reduce_pdf_size(temp_file, output_dir, max_size_mb):
-    """ Reduces the size of a PDF by splitting it further until it's under max_size_mb """
-    pdf_document = fitz.open(temp_file)
-    total_pages = pdf_document.page_count
-    part_num = 1
-    start_page = 0
-    temp_files = []
-
-    avg_page_size = os.path.getsize(temp_file) / (1024 * 1024) / total_pages
-    max_pages_per_part = int((max_size_mb / avg_page_size))
-
-    while max_pages_per_part > MedicalInsights.MAX_PAGE_LIMIT or (max_pages_per_part * avg_page_size) > max_size_mb:
-        max_pages_per_part = max_pages_per_part // 2
-
-    while start_page < total_pages:
-        remaining_pages = total_pages - start_page
-
-        if remaining_pages <= max_pages_per_part + 1:
-            max_pages_per_part = remaining_pages
-
-        writer = fitz.open()
-
-        end_page = min(start_page + MedicalInsights.MAX_PAGE_LIMIT, total_pages)
-
-        writer.insert_pdf(pdf_document, from_page=start_page, to_page=end_page - 1)
-
-        temp_output = os.path.join(output_dir, f"reduced_part_{part_num}.pdf")
-        writer.save(temp_output)
-        temp_files.append(temp_output)
-
-        part_size_mb = os.path.getsize(temp_output) / (1024 * 1024)
-
-        if part_size_mb > max_size_mb:
-            reduce_pdf_size(temp_output, output_dir, max_size_mb)
-        else:
-            final_output = os.path.join(output_dir, temp_file.replace("temp_", "part_"))
-            os.rename(temp_output, final_output)
-
-        start_page = end_page
-        part_num += 1
-
-    pdf_document.close()
-
-    for temp_file in temp_files:
-        if os.path.exists(temp_file):
-            os.remove(temp_file)
+split_executor = None
+
+
+def get_split_executor():
+    global split_executor
+    if split_executor is None:
+        split_executor = ProcessPoolExecutor(max_workers=MedicalInsights.SPLIT_WORKERS,
+                                             mp_context=multiprocessing.get_context('spawn'))
+    return split_executor
+
+
+async def detect_text_layer(document_session):
+    """ Returns {page_number: text} for the pages whose embedded text layer can be used instead of OCR.
+
+    Pages are classified in batches across the split worker pool, each worker opening the local copy
+    read-only, so born-digital pages of large documents are read in parallel.
+    """
+    pdf_document = await document_session.open()
+    page_count = pdf_document.page_count
+    batches = [(start_page, min(start_page + TextLayer.CLASSIFY_BATCH_PAGES, page_count))
+               for start_page in range(0, page_count, TextLayer.CLASSIFY_BATCH_PAGES)]
+
+    loop = asyncio.get_running_loop()
+    results = await asyncio.gather(*(
+        loop.run_in_executor(get_split_executor(), classify_pages, document_session.local_path, start_page, end_page,
+                             TextLayer.MIN_CHARS, TextLayer.MAX_IMAGE_COVERAGE, TextLayer.MAX_UNMAPPED_RATIO)
+        for start_page, end_page in batches))
+
+    text_pages = {}
+    for (start_page, _), texts in zip(batches, results):
+        for offset, text in enumerate(texts):
+            if text is not None:
+                text_pages[start_page + offset + 1] = text
+    PAGES.labels('text_layer').inc(len(text_pages))
+    return text_pages
+
+
+def make_part(s3_folder_path, document_name_without_extension, part_pages, compacted):
+    """ A manifest part holding the given 1-based pages; a compacted part lists them as they are not contiguous """
+    part_name = f"{document_name_without_extension}_{part_pages[0]}_to_{part_pages[-1]}"
+    part = {"name": part_name, "key": os.path.join(s3_folder_path, f"{part_name}.pdf"),
+            "start_page": part_pages[0], "end_page": part_pages[-1]}
+    if compacted:
+        part['pages'] = part_pages
+    return part
+
+
+def get_part_pages(part):
+    return part['pages'] if 'pages' in part else list(range(part['start_page'], part['end_page'] + 1))
+
+
+async def build_and_upload_part(source_path, part, output_path):
+    loop = asyncio.get_running_loop()
+    part_pages = get_part_pages(part)
+    await loop.run_in_executor(get_split_executor(), write_pages, source_path, [page - 1 for page in part_pages],
+                               output_path)
+
+    part_size_mb = os.path.getsize(output_path) / (1024 * 1024)
+    if part_size_mb > MedicalInsights.MAX_SIZE_MB:
+        logging.getLogger().warning(f"{os.path.basename(output_path)} is {part_size_mb:.2f} MB, above the "
+                                    f"{MedicalInsights.MAX_SIZE_MB} MB limit.")
+
+    try:
+        await s3_utils.upload_file(AWS.S3.S3_BUCKET, part['key'], output_path)
+        SPLIT_PARTS.inc()
+        PAGES.labels('split').inc(len(part_pages))
+    finally:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+    return part['key']
+
+
+async def split_pdf(document_session, idempotency_store=None, text_pages=None):
+    """ Yields the S3 path of each part as soon as it is uploaded.
+
+    Parts are planned from measured page sizes, and the split manifest (page offsets and expected part count)
+    is uploaded before any part is written. Parts are then written by a process pool that opens the local
+    source read-only, and each part's upload starts as soon as its file is saved, so callers can start jobs
+    for early parts while later ones are built.
+    With an idempotency store, a document whose content was already split yields the recorded parts
+    without being downloaded again, as long as its manifest is still in S3.
+
+    With text_pages ({page_number: text} from detect_text_layer), those pages are written to the manifest's
+    text layer JSON instead, and the parts hold only the remaining pages: each part lists the original
+    pages it holds so the merge can put Textract's pages back in place. A document without such pages
+    yields no parts.
+    """
+    document_path = document_session.document_path
+    document_name_without_extension = os.path.splitext(document_session.document_name)[0]
+
+    stage = 'text_layer_split' if text_pages else 'split'
+    content_key = await document_session.get_content_key() if idempotency_store else None
+    if content_key:
+        split_result = await idempotency_store.get(content_key, stage, document_path)
+        if split_result and await s3_utils.object_exists(AWS.S3.S3_BUCKET, split_result['manifest_path']):
+            logging.getLogger().info(f"{document_session.document_name} already split into "
+                                     f"{len(split_result['part_keys'])} parts, reusing them.")
+            for part_key in split_result['part_keys']:
+                yield part_key
+            return
+
+    pdf_document = await document_session.open()
+    # PyMuPDF is not thread-safe, so the measuring pass opens its own copy in the split pool
+    page_sizes = await asyncio.get_running_loop().run_in_executor(get_split_executor(), measure_document_page_sizes,
+                                                                  document_session.local_path)
+    page_numbers = [page for page in range(1, pdf_document.page_count + 1) if not text_pages or page not in text_pages]
+    page_ranges = plan_page_ranges([page_sizes[page - 1] for page in page_numbers])
+    output_dir = os.path.join(document_session.local_dir, 'split_files')
+    os.makedirs(output_dir, exist_ok=True)
+
+    directory_path = os.path.dirname(document_path)
+    s3_folder_path = os.path.join(directory_path, 'split_documents', document_name_without_extension)
+
+    parts = [make_part(s3_folder_path, document_name_without_extension, page_numbers[start_index:end_index],
+                       bool(text_pages))
+             for start_index, end_index in page_ranges]
+
+    manifest = build_manifest(document_path, pdf_document.page_count, parts, uuid.uuid4().hex)
+    if text_pages:
+        await upload_text_layer(s3_utils, manifest, text_pages)
+    manifest_path = await upload_manifest(s3_utils, manifest)
+
+    tasks = [asyncio.create_task(build_and_upload_part(document_session.local_path, part,
+                                                       os.path.join(output_dir, f"{part['name']}.pdf")))
+             for part in parts]
+
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    if content_key:
+        await idempotency_store.put(content_key, stage, document_path,
+                                    {"manifest_path": manifest_path, "part_keys": [part['key'] for part in parts]})
@@ -0,0 +1,90 @@
+import json
+import os
+import re
+
+from app.constant import AWS, MedicalInsights, TextLayer
+
+PART_NAME_PATTERN = re.compile(r'_(\d+)_to_(\d+)$')
+
+
+def get_manifest_path(document_path):
+    """ Manifest key for an original document: <dir>/split_manifests/<document name>.json """
+    directory_path = os.path.dirname(document_path)
+    document_name_without_extension = os.path.splitext(os.path.basename(document_path))[0]
+    return os.path.join(directory_path, MedicalInsights.SPLIT_MANIFEST_FOLDER, f'{document_name_without_extension}.json')
+
+
+def get_manifest_path_for_part(part_path):
+    """ Manifest key from a split part key: <dir>/split_documents/<document name>/<part name>.pdf """
+    path_parts = part_path.split('/')
+    return '/'.join(path_parts[:-3] + [MedicalInsights.SPLIT_MANIFEST_FOLDER, f'{path_parts[-2]}.json'])
+
+
+def get_text_layer_path(document_path):
+    """ Key of the native text of a document, next to the Textract JSONs of its split parts """
+    directory_path = os.path.dirname(document_path)
+    document_name_without_extension = os.path.splitext(os.path.basename(document_path))[0]
+    part_folder_path = os.path.join(directory_path, 'split_documents', document_name_without_extension, '')
+    json_folder_path = part_folder_path.replace(MedicalInsights.JSON_PATH_REPLACE_OLD, MedicalInsights.JSON_PATH_REPLACE_NEW)
+    return f'{json_folder_path}{document_name_without_extension}{TextLayer.FILE_SUFFIX}'
+
+
+def build_manifest(document_path, page_count, parts, split_id=None):
+    """ parts: list of dicts with name, key, start_page and end_page (1-based, inclusive).
+    A part holding only some pages of its range lists them, in order, under pages.
+    split_id identifies this split of the document, so completions of an earlier split are not counted. """
+    return {
+        "document_path": document_path,
+        "split_id": split_id,
+        "page_count": page_count,
+        "part_count": len(parts),
+        "parts": parts
+    }
+
+
+def build_manifest_from_part_keys(document_path, part_keys):
+    """ Rebuilds a manifest from the <name>_<start>_to_<end> part names of a split done without one """
+    parts = []
+    for key in part_keys:
+        name = os.path.splitext(os.path.basename(key))[0]
+        match = PART_NAME_PATTERN.search(name)
+        if not match:
+            continue
+        parts.append({"name": name, "key": key, "start_page": int(match.group(1)),
+                      "end_page": int(match.group(2))})
+    parts.sort(key=lambda part: part['start_page'])
+    page_count = parts[-1]['end_page'] if parts else 0
+    return build_manifest(document_path, page_count, parts)
+
+
+async def upload_text_layer(s3_utils, manifest, text_pages):
+    """ Writes the {page_number: text} pages read from the document's text layer as page_N JSON and
+    records them in the manifest """
+    text_layer_path = get_text_layer_path(manifest['document_path'])
+    body = json.dumps({f'page_{page_number}': text for page_number, text in sorted(text_pages.items())})
+    await s3_utils.upload_object(AWS.S3.S3_BUCKET, text_layer_path, body.encode('utf-8'))
+    manifest['text_layer'] = {"key": text_layer_path, "page_count": len(text_pages)}
+    return text_layer_path
+
+
+async def load_text_layer(s3_utils, manifest):
+    """ {page_number: text} of the pages read from the text layer, empty when the manifest has none """
+    if 'text_layer' not in manifest:
+        return {}
+    data = json.loads(await s3_utils.read_object(AWS.S3.S3_BUCKET, manifest['text_layer']['key']))
+    return {int(key[len('page_'):]): text for key, text in data.items()}
+
+
+async def upload_manifest(s3_utils, manifest):
+    manifest_path = get_manifest_path(manifest['document_path'])
+    await s3_utils.upload_object(AWS.S3.S3_BUCKET, manifest_path, json.dumps(manifest).encode('utf-8'))
+    return manifest_path
+
+
+async def load_manifest(s3_utils, part_path):
+    """ Returns the manifest of the document a split part belongs to, or None when it has none """
+    manifest_path = get_manifest_path_for_part(part_path)
+    try:
+        return json.loads(await s3_utils.read_object(AWS.S3.S3_BUCKET, manifest_path))
+    except s3_utils.client.exceptions.NoSuchKey:
+        return None
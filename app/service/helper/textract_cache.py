@@ -0,0 +1,72 @@
+import gzip
+import json
+import os
+import threading
+
+from cachetools import LRUCache
+
+from app.common.s3_utils import get_content_key
+from app.constant import AWS
+
+
+class TextractResultCache:
+    """ Content-addressed cache of page-wise Textract text.
+
+    Entries are keyed by the source PDF's content (S3 SHA-256 checksum when the object has one, otherwise
+    ETag and size), stored gzip-compressed under TEXTRACT_CACHE_PREFIX and looked up with HEAD. A bounded
+    in-process LRU of compressed entries sits in front of S3 and is shared by every message of the runner.
+    """
+
+    def __init__(self, max_bytes=AWS.TextractCache.LRU_MAX_MB * 1024 * 1024):
+        self.lru = LRUCache(maxsize=max_bytes, getsizeof=len)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    async def get_content_key(self, s3_utils, document_path):
+        return get_content_key(await s3_utils.head_object(AWS.S3.S3_BUCKET, document_path, ChecksumMode='ENABLED'))
+
+    def get_cache_path(self, content_key):
+        return os.path.join(AWS.TextractCache.PREFIX, f'{content_key}.json.gz')
+
+    async def get(self, s3_utils, content_key):
+        with self.lock:
+            compressed = self.lru.get(content_key)
+
+        if compressed is not None:
+            result = gzip.decompress(compressed)
+            self.record_hit(len(result))
+            return json.loads(result)
+
+        cache_path = self.get_cache_path(content_key)
+        if not await s3_utils.object_exists(AWS.S3.S3_BUCKET, cache_path):
+            self.misses += 1
+            return None
+
+        compressed = await s3_utils.read_object(AWS.S3.S3_BUCKET, cache_path)
+        result = gzip.decompress(compressed)
+        self.remember(content_key, compressed)
+        self.record_hit(len(result) - len(compressed))
+        return json.loads(result)
+
+    async def put(self, s3_utils, content_key, page_wise_text):
+        compressed = gzip.compress(json.dumps(page_wise_text).encode('utf-8'), compresslevel=AWS.TextractCache.GZIP_LEVEL)
+        await s3_utils.upload_object(AWS.S3.S3_BUCKET, self.get_cache_path(content_key), compressed)
+        self.remember(content_key, compressed)
+
+    def remember(self, content_key, compressed):
+        if len(compressed) <= self.lru.maxsize:
+            with self.lock:
+                self.lru[content_key] = compressed
+
+    def record_hit(self, bytes_saved):
+        self.hits += 1
+        self.bytes_saved += max(bytes_saved, 0)
+
+    def get_stats(self):
+        return {"hits": self.hits, "misses": self.misses, "bytes_saved": self.bytes_saved,
+                "lru_entries": len(self.lru), "lru_bytes": self.lru.currsize}
+
+
+textract_cache = TextractResultCache()
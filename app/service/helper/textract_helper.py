@@ -1,13 +1,25 @@
+import asyncio
 import json
 import os
-import tempfile
-import time
-import boto3
+import random
+from botocore.exceptions import ClientError
 
+from app.common.clients import get_client
+from app.common.metrics import PAGES, track_stage
 from app.common.s3_utils import S3Utils
+from app.service.helper.textract_cache import textract_cache
 from app.constant import AWS
 
-textract_client = boto3.client('textract', region_name=AWS.BotoClient.AWS_DEFAULT_REGION)
+
+async def start_text_detection(document_path):
+    """ Starts Textract async text detection the way the Textract job does, the completion notification
+    goes to SNS_TOPIC_ARN and reaches the LLM runner through the completed-Textract queue """
+    response = await asyncio.to_thread(
+        get_client('textract').start_document_text_detection,
+        DocumentLocation={'S3Object': {'Bucket': AWS.S3.S3_BUCKET, 'Name': document_path}},
+        NotificationChannel={'SNSTopicArn': os.getenv('SNS_TOPIC_ARN'), 'RoleArn': os.getenv('ROLE_ARN')}
+    )
+    return response['JobId']
 
 
 class TextractHelper:
@@ -15,50 +27,73 @@ class TextractHelper:
         self.logger = logger
         self.s3_utils = S3Utils()
 
+    async def get_text_detection_page(self, job_id, next_token=None):
+        """ Fetches one result page off the event loop, retrying throttling errors with full-jitter backoff """
+        kwargs = {'JobId': job_id, 'MaxResults': AWS.Textract.MAX_RESULTS}
+        if next_token:
+            kwargs['NextToken'] = next_token
+
+        for attempt in range(AWS.Textract.MAX_RETRIES + 1):
+            try:
+                return await asyncio.to_thread(get_client('textract').get_document_text_detection, **kwargs)
+            except ClientError as e:
+                if e.response['Error']['Code'] not in AWS.Textract.THROTTLING_ERROR_CODES or attempt == AWS.Textract.MAX_RETRIES:
+                    raise
+                delay = random.uniform(0, min(AWS.Textract.BACKOFF_MAX_SECONDS, AWS.Textract.BACKOFF_BASE_SECONDS * 2 ** attempt))
+                self.logger.info(f"Textract throttled ({e.response['Error']['Code']}), retrying in {delay:.2f} seconds.")
+                await asyncio.sleep(delay)
+
     async def get_text(self, job_id):
-        page_wise_text = {}
-        next_token = None
+        """ Collects LINE text per page, fetching the next result page while the current one is processed """
+        page_lines = {}
+        with track_stage('textract_pagination'):
+            await self.collect_page_lines(job_id, page_lines)
+        PAGES.labels('textract').inc(len(page_lines))
+
+        return {page_key: ' '.join(lines) + ' ' for page_key, lines in page_lines.items()}
 
-        while True:
-            if next_token:
-                textract_response = textract_client.get_document_text_detection(JobId=job_id, NextToken=next_token)
-            else:
-                textract_response = textract_client.get_document_text_detection(JobId=job_id)
+    async def collect_page_lines(self, job_id, page_lines):
+        next_page = asyncio.ensure_future(self.get_text_detection_page(job_id))
+
+        while next_page:
+            textract_response = await next_page
+            next_token = textract_response.get('NextToken')
+            next_page = asyncio.ensure_future(self.get_text_detection_page(job_id, next_token)) if next_token else None
 
             for block in textract_response['Blocks']:
                 if block['BlockType'] == 'LINE':
                     page_key = 'page_' + str(block['Page'])
-                    page_wise_text[page_key] = page_wise_text.get(page_key, '') + block['Text'] + ' '
+                    lines = page_lines.get(page_key)
+                    if lines is None:
+                        lines = page_lines[page_key] = []
+                    lines.append(block['Text'])
 
-            if 'NextToken' in textract_response:
-                next_token = textract_response['NextToken']
-            else:
-                break
+    async def get_page_wise_text(self, input_message, s3_textract_path):
+        with track_stage('textract_text') as stage:
+            page_wise_text = await self.read_page_wise_text(input_message, s3_textract_path)
+        self.logger.info(f"Get text using textract completed in {stage.elapsed} seconds.")
         return page_wise_text
 
-    async def get_page_wise_text(self, input_message, s3_textract_path):
-        start_time = time.time()
+    async def read_page_wise_text(self, input_message, s3_textract_path):
         self.logger.info("Text Extraction from document is started...")
 
         file_path = input_message['DocumentLocation']['S3ObjectName']
-        pdf_name = os.path.basename(file_path)
-        temp_dir = tempfile.TemporaryDirectory()
-        local_textract_path = os.path.join(os.path.join(temp_dir.name, f'{pdf_name}_text.json'))
-        response = await self.s3_utils.check_s3_path_exists(bucket=AWS.S3.S3_BUCKET, key=s3_textract_path)
+        content_key = await textract_cache.get_content_key(self.s3_utils, file_path)
+        page_wise_text = await textract_cache.get(self.s3_utils, content_key)
 
-        if response:
+        if page_wise_text is not None:
             self.logger.info("Reading textract response from the cache...")
-            await self.s3_utils.download_object(AWS.S3.S3_BUCKET, s3_textract_path, local_textract_path)
-            with open(local_textract_path, 'r') as file:
-                json_data = json.loads(file.read())
-            page_wise_text = json_data
+            if not await self.s3_utils.object_exists(AWS.S3.S3_BUCKET, s3_textract_path):
+                result = json.dumps(page_wise_text).encode("utf-8")
+                await self.s3_utils.upload_object(AWS.S3.S3_BUCKET, s3_textract_path, result)
         else:
             self.logger.info("Using GetDocumentTextDetection api...")
             page_wise_text = await self.get_text(input_message['JobId'])
             result = json.dumps(page_wise_text)
             result = result.encode("utf-8")
             await self.s3_utils.upload_object(AWS.S3.S3_BUCKET, s3_textract_path, result)
+            await textract_cache.put(self.s3_utils, content_key, page_wise_text)
 
-        self.logger.info(f"Get text using textract completed in {time.time() - start_time} seconds.")
+        self.logger.info(f"Textract cache stats: {textract_cache.get_stats()}")
 
         return page_wise_text
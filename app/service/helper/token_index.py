@@ -0,0 +1,109 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+
+from app.constant import AWS, TokenIndex
+
+try:
+    from tokenizers import Tokenizer
+except ImportError:
+    Tokenizer = None
+
+tokenizer = None
+tokenizer_lock = threading.Lock()
+tokenizer_unavailable = False
+
+
+def get_tokenizer():
+    """ The configured fast tokenizer, loaded once; None when the stage is disabled or cannot load it """
+    global tokenizer, tokenizer_unavailable
+    if not TokenIndex.ENABLED or tokenizer_unavailable:
+        return None
+    with tokenizer_lock:
+        if tokenizer is None and not tokenizer_unavailable:
+            try:
+                if Tokenizer is None:
+                    raise ImportError('the tokenizers package is not installed')
+                if TokenIndex.TOKENIZER_PATH and os.path.exists(TokenIndex.TOKENIZER_PATH):
+                    tokenizer = Tokenizer.from_file(TokenIndex.TOKENIZER_PATH)
+                else:
+                    tokenizer = Tokenizer.from_pretrained(TokenIndex.TOKENIZER)
+            except Exception as e:
+                tokenizer_unavailable = True
+                logging.getLogger().warning(f"Token index disabled, tokenizer {TokenIndex.TOKENIZER} unavailable: {e}")
+    return tokenizer
+
+
+def count_tokens(texts):
+    """ encode_batch tokenizes on all cores in Rust without holding the GIL """
+    return [len(encoding.ids) for encoding in get_tokenizer().encode_batch(texts, add_special_tokens=False)]
+
+
+def plan_chunks(page_tokens, token_budget):
+    """ Packs consecutive pages into [start_page, end_page, tokens] chunks of at most token_budget tokens.
+    A page larger than the budget gets a chunk of its own. """
+    chunks = []
+    for page_number, tokens in page_tokens:
+        if chunks and chunks[-1][2] + tokens <= token_budget:
+            chunks[-1][1] = page_number
+            chunks[-1][2] += tokens
+        else:
+            chunks.append([page_number, page_number, tokens])
+    return chunks
+
+
+def get_token_index_path(textract_json_path):
+    return f'{os.path.splitext(textract_json_path)[0]}_tokens.json'
+
+
+class TokenIndexBuilder:
+    """ Collects per-page token counts while pages stream past, then writes the token index sidecar.
+
+    The sidecar lists [page_number, tokens] for every page and chunk boundaries under
+    TokenIndex.CHUNK_TOKEN_BUDGET, so the LLM job can plan its chunks without tokenizing the document again.
+    """
+
+    def __init__(self):
+        self.page_tokens = {}
+        self.tasks = []
+
+    def add_pages(self, pages):
+        """ pages: {page_number: text}, tokenized in the background in batches of TokenIndex.BATCH_SIZE """
+        page_numbers = list(pages)
+        for start in range(0, len(page_numbers), TokenIndex.BATCH_SIZE):
+            batch = page_numbers[start:start + TokenIndex.BATCH_SIZE]
+            self.tasks.append(asyncio.ensure_future(self.count_batch(batch, [pages[number] for number in batch])))
+
+    async def count_batch(self, page_numbers, texts):
+        counts = await asyncio.to_thread(count_tokens, texts)
+        self.page_tokens.update(zip(page_numbers, counts))
+
+    def cancel(self):
+        for task in self.tasks:
+            task.cancel()
+
+    async def build(self):
+        await asyncio.gather(*self.tasks)
+        page_tokens = sorted(self.page_tokens.items())
+        return {
+            "tokenizer": TokenIndex.TOKENIZER,
+            "chunk_token_budget": TokenIndex.CHUNK_TOKEN_BUDGET,
+            "page_count": len(page_tokens),
+            "total_tokens": sum(tokens for _, tokens in page_tokens),
+            "pages": page_tokens,
+            "chunks": plan_chunks(page_tokens, TokenIndex.CHUNK_TOKEN_BUDGET)
+        }
+
+    async def upload(self, s3_utils, textract_json_path):
+        token_index = await self.build()
+        token_index_path = get_token_index_path(textract_json_path)
+        await s3_utils.upload_object(AWS.S3.S3_BUCKET, token_index_path,
+                                     json.dumps(token_index, separators=(',', ':')).encode('utf-8'))
+        return token_index_path
+
+
+async def get_token_index_builder():
+    """ A builder when the token index stage is enabled and its tokenizer loads (loading may download it) """
+    return TokenIndexBuilder() if await asyncio.to_thread(get_tokenizer) is not None else None
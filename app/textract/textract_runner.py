@@ -3,94 +3,227 @@ import json
 import os.path
 import sys
 import time
-import uuid
 import traceback
 
-from kubernetes import client, config
-
-from app.common.cloudwatch_helper import get_cloudwatch_logger
-from app.common.sqs_helper import SQSHelper
-from app.constant import AWS, MedicalInsights
+from app.common.cloudwatch_helper import get_cloudwatch_logger, set_log_context
+from app.common.k8s_job_launcher import JobLauncher
+from app.common.fair_scheduler import FairSchedulingWorkerPool
+from app.common.message_pool import MessageWorkerPool
+from app.common.metrics import observe_stage, start_metrics_server, track_stage
+from app.common.sqs_helper import MessageLeaseManager, SQSHelper
+from app.constant import AWS, Idempotency, InProcess, Kubernetes, MedicalInsights, Scheduler, TextLayer
 from app.common.s3_utils import S3Utils
-from app.common.utils import get_page_count
-from app.service.helper.pdf_splitter import split_pdf
-
-# config.load_kube_config()   # Uncomment this line while testing in local
-config.load_incluster_config()
+from app.common.document_session import DocumentSession
+from app.service.helper.idempotency_store import get_idempotency_store
+from app.service.helper.pdf_splitter import detect_text_layer, split_pdf
+from app.service.helper.split_manifest import get_manifest_path
+from app.service.helper.textract_helper import start_text_detection
 
 
 class TextractRunner:
     def __init__(self):
         self.s3_utils = S3Utils()
         self.START_TEXTRACT_QUEUE_URL = os.getenv('START_TEXTRACT_QUEUE_URL')
+        # Documents read entirely from their text layer are announced to the LLM runner directly
+        self.COMPLETED_TEXTRACT_QUEUE_URL = os.getenv('COMPLETED_TEXTRACT_QUEUE_URL')
         self.NAMESPACE = os.getenv('ENVIRONMENT')
         self.TEXTRACT_IMAGE_NAME = os.getenv('TEXTRACT_IMAGE_NAME')
         self.logger = get_cloudwatch_logger(log_stream_name=AWS.CloudWatch.TEXTRACT_RUNNER_STREAM)
         self.sqs_helper = SQSHelper()
-
-    async def create_job(self, message_body):
-        batch_v1 = client.BatchV1Api()
-
-        job_manifest = json.load(open('app/textract/job_manifest.json', 'r'))
-
-        job_name = f"textract-job-{uuid.uuid1()}"
-        job_manifest['metadata']['name'] = job_name
-        job_manifest['spec']['template']['spec']['containers'][0]['image'] = self.TEXTRACT_IMAGE_NAME
-
-        for env_variable in job_manifest['spec']['template']['spec']['containers'][0]['env']:
-            if env_variable['name'] == 'INPUT_MESSAGE':
-                env_variable['value'] = json.dumps(message_body)
-            elif env_variable['name'] == 'LLM_OUTPUT_QUEUE_URL':
-                env_variable['value'] = os.getenv('LLM_OUTPUT_QUEUE_URL')
-            elif env_variable['name'] == 'SNS_TOPIC_ARN':
-                env_variable['value'] = os.getenv('SNS_TOPIC_ARN')
-            elif env_variable['name'] == 'ROLE_ARN':
-                env_variable['value'] = os.getenv('ROLE_ARN')
-
-        batch_v1.create_namespaced_job(namespace=self.NAMESPACE, body=job_manifest)
-        self.logger.info(f'Job {job_name} created in namespace: {self.NAMESPACE}')
-
-    async def process_split_pdf(self, document_path, document_size, document_pages):
+        self.lease_manager = MessageLeaseManager(self.sqs_helper, self.START_TEXTRACT_QUEUE_URL, self.logger,
+                                                 os.getenv('START_TEXTRACT_DLQ_URL'))
+        self.idempotency_store = get_idempotency_store(self.s3_utils)
+        self.in_process_slots = None
+        self.path_latencies = {}
+        self.job_launcher = JobLauncher('app/textract/job_manifest.json', 'textract-job', self.TEXTRACT_IMAGE_NAME,
+                                        self.NAMESPACE, self.logger)
+
+    async def create_job(self, message_body, completions=None, content_key=None, stage='job'):
+        """ With the source content_key, a job already created for the same input is not created again """
+        input_path = message_body.get('document_path') or message_body.get('split_manifest_path')
+        if content_key:
+            created_job = await self.idempotency_store.get(content_key, stage, input_path,
+                                                           Idempotency.SUBMISSION_TTL_SECONDS)
+            if created_job:
+                self.logger.info(f"Job {created_job['job_name']} already created for {input_path}, skipping.")
+                return created_job['job_name']
+
+        job_name = await self.job_launcher.create_job({
+            'INPUT_MESSAGE': json.dumps(message_body),
+            'LLM_OUTPUT_QUEUE_URL': os.getenv('LLM_OUTPUT_QUEUE_URL'),
+            'SNS_TOPIC_ARN': os.getenv('SNS_TOPIC_ARN'),
+            'ROLE_ARN': os.getenv('ROLE_ARN')
+        }, self.logger, completions)
+        if content_key:
+            await self.idempotency_store.put(content_key, stage, input_path, {"job_name": job_name})
+        return job_name
+
+    async def process_split_pdf_indexed(self, document_session, content_key=None, text_pages=None):
+        """ Fans all parts out as one Indexed Job, pod i processes parts[i] of the split manifest """
+        idempotency_store = self.idempotency_store if content_key else None
+        with track_stage('split') as stage:
+            part_paths = [file_path async for file_path in split_pdf(document_session, idempotency_store, text_pages)]
+        self.logger.info(f"PDF Splitting is completed in {stage.elapsed} seconds.")
+        if not part_paths:
+            return 0
+        message_body = {"split_manifest_path": get_manifest_path(document_session.document_path)}
+        self.logger.info(f"Create Indexed Job for {len(part_paths)} split parts: {message_body}")
+        await self.create_job(message_body, completions=len(part_paths), content_key=content_key, stage='indexed_job')
+        return len(part_paths)
+
+    async def process_split_pdf(self, document_session, content_key=None, text_pages=None):
         """Process and split large PDFs if they exceed the size or page limits."""
-        start_time = time.time()
         self.logger.info("PDF Splitting is started...")
-
-        pdf_splitter = await split_pdf(document_path, document_size, document_pages)
-        self.logger.info(f"PDF Splitting is completed in {time.time() - start_time} seconds.")
-
-        for file_path in pdf_splitter:
-            self.logger = get_cloudwatch_logger(project_id=file_path.split('/')[2],
-                                                document_name=os.path.basename(file_path),
-                                                log_stream_name=AWS.CloudWatch.TEXTRACT_RUNNER_STREAM)
-            message_body = {"document_path": file_path}
-            self.logger.info(f"Create Job with Split PDF: {message_body}")
-            await self.create_job(message_body)
-
-    async def process_single_pdf(self, document_path, message_body):
+        return await self.split_and_create_jobs(document_session, content_key, text_pages)
+
+    async def split_and_create_jobs(self, document_session, content_key=None, text_pages=None):
+        """ Returns the number of parts sent to Textract """
+        if Kubernetes.INDEXED_JOB_FANOUT:
+            return await self.process_split_pdf_indexed(document_session, content_key, text_pages)
+
+        job_tasks = []
+        idempotency_store = self.idempotency_store if content_key else None
+        # Jobs are submitted as parts are yielded; only the split itself is timed, job_creation times the jobs
+        with track_stage('split') as stage:
+            async for file_path in split_pdf(document_session, idempotency_store, text_pages):
+                set_log_context(project_id=file_path.split('/')[2], document_name=os.path.basename(file_path))
+                message_body = {"document_path": file_path}
+                self.logger.info(f"Create Job with Split PDF: {message_body}")
+                job_tasks.append(asyncio.create_task(self.create_job(message_body, content_key=content_key)))
+        self.logger.info(f"PDF Splitting is completed in {stage.elapsed} seconds.")
+
+        await asyncio.gather(*job_tasks)
+        return len(job_tasks)
+
+    async def get_text_layer_pages(self, document_session):
+        """ {page_number: text} of the pages that can skip OCR, empty when detection is off or the document
+        is too small for splitting around its text layer to pay off """
+        if not TextLayer.ENABLED or not self.COMPLETED_TEXTRACT_QUEUE_URL:
+            return {}
+        if await document_session.get_page_count() < TextLayer.MIN_DOCUMENT_PAGES:
+            return {}
+        with track_stage('text_layer') as stage:
+            text_pages = await detect_text_layer(document_session)
+        self.logger.info(f"{len(text_pages)} of {document_session.pdf_document.page_count} pages have a usable "
+                         f"text layer, detected in {stage.elapsed} seconds.")
+        return text_pages
+
+    async def process_text_layer_pdf(self, document_session, text_pages, content_key=None):
+        """ Sends only the pages without a usable text layer to Textract, compacted into split parts.
+
+        The LLM runner stitches the text layer back in page order when it merges the parts. When every page
+        has a text layer, nothing goes to Textract and the LLM runner is told the document is ready.
+        """
+        part_count = await self.process_split_pdf(document_session, content_key, text_pages)
+        if part_count:
+            return
+
+        document_path = document_session.document_path
+        manifest_path = get_manifest_path(document_path)
+        if content_key and await self.idempotency_store.get(content_key, 'text_layer_message', document_path,
+                                                            Idempotency.SUBMISSION_TTL_SECONDS):
+            self.logger.info(f"Text layer of {document_path} already sent to the LLM runner, skipping.")
+            return
+        message_body = {"Status": "SUCCEEDED", "split_manifest_path": manifest_path,
+                        "DocumentLocation": {"S3ObjectName": document_path, "S3Bucket": AWS.S3.S3_BUCKET}}
+        await self.sqs_helper.publish_message(self.COMPLETED_TEXTRACT_QUEUE_URL, json.dumps(message_body))
+        self.logger.info(f"Every page of {document_path} has a text layer, sent to the LLM runner without Textract.")
+        if content_key:
+            await self.idempotency_store.put(content_key, 'text_layer_message', document_path,
+                                             {"manifest_path": manifest_path})
+
+    async def process_single_pdf(self, document_path, message_body, content_key=None):
         """Process single PDFs without splitting."""
-        self.logger = get_cloudwatch_logger(project_id=document_path.split('/')[2],
-                                            document_name=os.path.basename(document_path),
-                                            log_stream_name=AWS.CloudWatch.TEXTRACT_RUNNER_STREAM)
+        set_log_context(project_id=document_path.split('/')[2], document_name=os.path.basename(document_path))
 
         self.logger.info(f"Create Job without Split PDF: {message_body}")
-        await self.create_job(message_body)
+        await self.create_job(message_body, content_key=content_key)
+
+    async def process_single_pdf_in_process(self, document_path, content_key=None):
+        """Start Textract from the runner itself for small PDFs instead of spawning a Job."""
+        set_log_context(project_id=document_path.split('/')[2], document_name=os.path.basename(document_path))
+
+        if content_key:
+            started = await self.idempotency_store.get(content_key, 'textract_start', document_path,
+                                                       Idempotency.SUBMISSION_TTL_SECONDS)
+            if started:
+                self.logger.info(f"Textract already started for {document_path}, JobId: {started['job_id']}")
+                return
+
+        if self.in_process_slots is None:
+            self.in_process_slots = asyncio.Semaphore(InProcess.MAX_WORKERS)
+        async with self.in_process_slots:
+            job_id = await start_text_detection(document_path)
+        self.logger.info(f"Textract started in process for {document_path}, JobId: {job_id}")
+        if content_key:
+            await self.idempotency_store.put(content_key, 'textract_start', document_path, {"job_id": job_id})
+
+    async def get_content_key(self, document_session, message_body):
+        """ None disables stage skipping; set "reprocess": true on a message to force every stage to run again """
+        if not self.idempotency_store:
+            return None
+        if message_body.get('reprocess'):
+            self.logger.info(f"Reprocessing {document_session.document_path}, recorded stages are ignored.")
+            return None
+        return await document_session.get_content_key()
+
+    def record_latency(self, path, start_time):
+        latency = time.time() - start_time
+        observe_stage(f'document_{path}', latency)
+        count, total = self.path_latencies.get(path, (0, 0.0))
+        self.path_latencies[path] = (count + 1, total + latency)
+        self.logger.info(f"End-to-end latency for {path} path: {latency} seconds "
+                         f"(average {(total + latency) / (count + 1)} seconds over {count + 1} documents).")
 
     async def process_message(self, message_body, receipt_handle):
+        start_time = time.time()
         document_path = message_body.get('document_path', '')
-        document_size = await self.s3_utils.get_file_size(AWS.S3.S3_BUCKET, document_path)
-        document_pages = await get_page_count(document_path)
+        if receipt_handle:
+            self.lease_manager.lease(receipt_handle)
         try:
-            if document_size >= MedicalInsights.MAX_SIZE_MB or document_pages >= MedicalInsights.MAX_PAGE_LIMIT:
-                await self.process_split_pdf(document_path, document_size, document_pages)
-            else:
-                await self.process_single_pdf(document_path, message_body)
+            async with DocumentSession(document_path, self.s3_utils, self.logger) as document_session:
+                document_size = await document_session.get_size_mb()
+                document_pages = await document_session.get_page_count()
+                content_key = await self.get_content_key(document_session, message_body)
+                text_pages = await self.get_text_layer_pages(document_session)
+                if text_pages:
+                    await self.process_text_layer_pdf(document_session, text_pages, content_key)
+                    self.record_latency('text_layer', start_time)
+                elif document_size >= MedicalInsights.MAX_SIZE_MB or document_pages >= MedicalInsights.MAX_PAGE_LIMIT:
+                    await self.process_split_pdf(document_session, content_key)
+                    self.record_latency('split', start_time)
+                elif InProcess.ENABLED and document_pages <= InProcess.MAX_PAGES and document_size <= InProcess.MAX_SIZE_MB:
+                    await self.process_single_pdf_in_process(document_path, content_key)
+                    self.record_latency('in_process', start_time)
+                else:
+                    await self.process_single_pdf(document_path, message_body, content_key)
+                    self.record_latency('job', start_time)
+            if receipt_handle:
+                await self.lease_manager.ack(receipt_handle)
         except Exception as e:
             self.logger.error('%s -> %s' % (e, traceback.format_exc()))
-        finally:
             if receipt_handle:
-                await self.sqs_helper.delete_message(self.START_TEXTRACT_QUEUE_URL, receipt_handle)
+                await self.lease_manager.fail(receipt_handle, message_body)
+        finally:
             sys.stdout.flush()
 
+    async def classify_message(self, message_body):
+        """Project and fast-lane eligibility of a message for the fair scheduler."""
+        document_path = message_body.get('document_path', '')
+        project_id = document_path.split('/')[2] if document_path.count('/') >= 2 else None
+        document_size = await self.s3_utils.get_file_size(AWS.S3.S3_BUCKET, document_path)
+        return project_id, document_size <= Scheduler.FAST_LANE_MAX_MB
+
+    async def handle_message(self, message_body, receipt_handle):
+        self.logger.info(f"Message body from Queue: {message_body}")
+        await self.process_message(message_body, receipt_handle)
+
+    def create_worker_pool(self):
+        if Scheduler.ENABLED:
+            return FairSchedulingWorkerPool(self.sqs_helper, self.START_TEXTRACT_QUEUE_URL, self.handle_message,
+                                            self.logger, self.classify_message, self.lease_manager)
+        return MessageWorkerPool(self.sqs_helper, self.START_TEXTRACT_QUEUE_URL, self.handle_message, self.logger)
+
     async def runner(self):
         try:
             if not self.NAMESPACE:
@@ -103,16 +236,14 @@ class TextractRunner:
                 self.logger.info('Configuration incomplete. Please configure START_TEXTRACT_QUEUE_URL variable.')
                 exit(0)
 
+            if TextLayer.ENABLED and not self.COMPLETED_TEXTRACT_QUEUE_URL:
+                self.logger.warning('Text layer detection needs COMPLETED_TEXTRACT_QUEUE_URL, every page goes to Textract.')
+
+            start_metrics_server()
             self.logger.info(f'Reading messages from queue: {self.START_TEXTRACT_QUEUE_URL.split("/")[-1]}')
-            while True:
-                message_body, receipt_handle = await self.sqs_helper.consume_message(self.START_TEXTRACT_QUEUE_URL)
-                if not (message_body and receipt_handle):
-                    time.sleep(10)
-                    continue
-
-                self.logger.info(f'Message received from queue: {self.START_TEXTRACT_QUEUE_URL.split("/")[-1]}')
-                self.logger.info(f"Message body from Queue: {message_body}")
-                await self.process_message(message_body, receipt_handle)
+            pool = self.create_worker_pool()
+            await pool.run()
+            await self.lease_manager.close()
 
         except Exception as e:
             self.logger.error('%s -> %s' % (e, traceback.format_exc()))
@@ -0,0 +1,461 @@
+""" In-process stand-ins for S3, SQS, Textract, CloudWatch Logs and the Kubernetes Batch API.
+
+They implement only the calls the runners make, keep everything in memory, are safe to call from the
+runners' worker threads, and count every request so the harness can report them.
+"""
+import base64
+import collections
+import hashlib
+import json
+import threading
+import time
+import uuid
+
+import fitz
+from botocore.exceptions import ClientError
+
+
+def client_error(code, operation, message=''):
+    return ClientError({'Error': {'Code': code, 'Message': message or code}}, operation)
+
+
+class NoSuchKey(ClientError):
+    def __init__(self, operation='GetObject'):
+        super().__init__({'Error': {'Code': 'NoSuchKey', 'Message': 'The specified key does not exist.'}}, operation)
+
+
+class RequestCounter:
+    def __init__(self, latency_ms=0):
+        self.latency = latency_ms / 1000
+        self.requests = collections.Counter()
+        self.counter_lock = threading.Lock()
+
+    def record(self, operation):
+        with self.counter_lock:
+            self.requests[operation] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class FakeExceptions:
+    """ Mirrors client.exceptions: any modeled exception name resolves to a ClientError subclass """
+
+    def __init__(self, **known):
+        self.known = known
+
+    def __getattr__(self, name):
+        if name not in self.known:
+            self.known[name] = type(name, (ClientError,), {})
+        return self.known[name]
+
+
+class Body:
+    def __init__(self, data):
+        self.data = data
+
+    def read(self):
+        return self.data
+
+
+class FakeS3Client(RequestCounter):
+    def __init__(self, latency_ms=0, bandwidth_mbps=0):
+        super().__init__(latency_ms)
+        # MB/s per request, 0 for unlimited
+        self.bandwidth = bandwidth_mbps
+        self.objects = {}
+        self.uploads = {}
+        self.lock = threading.RLock()
+        self.exceptions = FakeExceptions(NoSuchKey=NoSuchKey)
+        # Bytes moved over the wire by direction, counted here so runs of any commit are comparable
+        self.transferred = collections.Counter()
+
+    def count_bytes(self, direction, byte_count):
+        with self.counter_lock:
+            self.transferred[direction] += byte_count
+        if self.bandwidth:
+            time.sleep(byte_count / (self.bandwidth * 1024 * 1024))
+
+    def store(self, key, data):
+        with self.lock:
+            self.objects[key] = (data, f'"{hashlib.md5(data).hexdigest()}"',
+                                 base64.b64encode(hashlib.sha256(data).digest()).decode())
+            return self.objects[key][1]
+
+    def load(self, key, operation):
+        with self.lock:
+            stored = self.objects.get(key)
+        if stored is None:
+            if operation == 'HeadObject':
+                raise client_error('404', operation, 'Not Found')
+            raise NoSuchKey(operation)
+        return stored
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None, **kwargs):
+        self.record('PutObject')
+        data = Body if isinstance(Body, bytes) else Body.read()
+        self.count_bytes('upload', len(data))
+        with self.lock:
+            current = self.objects.get(Key)
+            if (IfNoneMatch == '*' and current is not None) or (IfMatch and (current is None or current[1] != IfMatch)):
+                raise client_error('PreconditionFailed', 'PutObject')
+            return {'ETag': self.store(Key, data)}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, Config=None, **kwargs):
+        self.record('PutObject')
+        data = Fileobj.read()
+        self.count_bytes('upload', len(data))
+        self.store(Key, data)
+
+    def upload_file(self, Filename, Bucket, Key, Config=None, **kwargs):
+        self.record('PutObject')
+        with open(Filename, 'rb') as file:
+            data = file.read()
+        self.count_bytes('upload', len(data))
+        self.store(Key, data)
+
+    def download_file(self, Bucket, Key, Filename, Config=None, **kwargs):
+        self.record('GetObject')
+        data = self.load(Key, 'GetObject')[0]
+        self.count_bytes('download', len(data))
+        with open(Filename, 'wb') as file:
+            file.write(data)
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        self.record('GetObject')
+        data, etag, _ = self.load(Key, 'GetObject')
+        response = {'ETag': etag, 'ContentLength': len(data)}
+        if Range:
+            start, _, end = Range[len('bytes='):].partition('-')
+            if not start:
+                start, end = max(len(data) - int(end), 0), len(data) - 1
+            else:
+                start, end = int(start), min(int(end) if end else len(data) - 1, len(data) - 1)
+            response['ContentRange'] = f'bytes {start}-{end}/{len(data)}'
+            data = data[start:end + 1]
+        self.count_bytes('download', len(data))
+        response['Body'] = Body(data)
+        return response
+
+    def head_object(self, Bucket, Key, ChecksumMode=None, **kwargs):
+        self.record('HeadObject')
+        data, etag, checksum = self.load(Key, 'HeadObject')
+        response = {'ContentLength': len(data), 'ETag': etag}
+        if ChecksumMode == 'ENABLED':
+            response['ChecksumSHA256'] = checksum
+        return response
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self.record('DeleteObject')
+        with self.lock:
+            self.objects.pop(Key, None)
+
+    def list_objects_v2(self, Bucket, Prefix='', **kwargs):
+        self.record('ListObjectsV2')
+        with self.lock:
+            keys = sorted(key for key in self.objects if key.startswith(Prefix))
+            contents = [{'Key': key, 'Size': len(self.objects[key][0])} for key in keys[:1000]]
+        return {'Contents': contents, 'KeyCount': len(contents)} if contents else {'KeyCount': 0}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self.record('CreateMultipartUpload')
+        upload_id = uuid.uuid4().hex
+        with self.lock:
+            self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, PartNumber, UploadId, Body, **kwargs):
+        self.record('UploadPart')
+        data = Body if isinstance(Body, bytes) else Body.read()
+        self.count_bytes('upload', len(data))
+        with self.lock:
+            self.uploads[UploadId][PartNumber] = data
+        return {'ETag': f'"{hashlib.md5(data).hexdigest()}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        self.record('CompleteMultipartUpload')
+        with self.lock:
+            parts = self.uploads.pop(UploadId)
+        data = b''.join(parts[part['PartNumber']] for part in MultipartUpload['Parts'])
+        return {'ETag': self.store(Key, data)}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self.record('AbortMultipartUpload')
+        with self.lock:
+            self.uploads.pop(UploadId, None)
+
+
+class FakeQueue:
+    def __init__(self):
+        self.visible = collections.deque()
+        self.in_flight = {}
+
+
+class FakeSQSClient(RequestCounter):
+    """ Long polling blocks the calling thread until a message arrives, the wait ends or close() is called """
+
+    def __init__(self, latency_ms=0):
+        super().__init__(latency_ms)
+        self.queues = collections.defaultdict(FakeQueue)
+        self.changed = threading.Condition()
+        self.closed = False
+        self.exceptions = FakeExceptions()
+
+    def close(self):
+        with self.changed:
+            self.closed = True
+            self.changed.notify_all()
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        self.record('SendMessage')
+        message_id = uuid.uuid4().hex
+        with self.changed:
+            self.queues[QueueUrl].visible.append({'MessageId': message_id, 'Body': MessageBody, 'ReceiveCount': 0})
+            self.changed.notify_all()
+        return {'MessageId': message_id}
+
+    def requeue_expired(self, queue):
+        now = time.monotonic()
+        for receipt_handle, (message, visible_at) in list(queue.in_flight.items()):
+            if visible_at <= now:
+                del queue.in_flight[receipt_handle]
+                queue.visible.append(message)
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0, VisibilityTimeout=30, **kwargs):
+        self.record('ReceiveMessage')
+        deadline = time.monotonic() + WaitTimeSeconds
+        with self.changed:
+            queue = self.queues[QueueUrl]
+            while True:
+                self.requeue_expired(queue)
+                if queue.visible or self.closed or time.monotonic() >= deadline:
+                    break
+                self.changed.wait(min(deadline - time.monotonic(), 0.5))
+
+            messages = []
+            while queue.visible and len(messages) < MaxNumberOfMessages:
+                message = queue.visible.popleft()
+                message['ReceiveCount'] += 1
+                receipt_handle = uuid.uuid4().hex
+                queue.in_flight[receipt_handle] = (message, time.monotonic() + VisibilityTimeout)
+                messages.append({'MessageId': message['MessageId'], 'ReceiptHandle': receipt_handle,
+                                 'Body': message['Body'],
+                                 'Attributes': {'ApproximateReceiveCount': str(message['ReceiveCount'])}})
+        return {'Messages': messages} if messages else {}
+
+    def delete_message(self, QueueUrl, ReceiptHandle, **kwargs):
+        self.record('DeleteMessage')
+        with self.changed:
+            self.queues[QueueUrl].in_flight.pop(ReceiptHandle, None)
+
+    def delete_message_batch(self, QueueUrl, Entries, **kwargs):
+        self.record('DeleteMessageBatch')
+        with self.changed:
+            for entry in Entries:
+                self.queues[QueueUrl].in_flight.pop(entry['ReceiptHandle'], None)
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+    def set_visibility(self, queue_url, receipt_handle, visibility_timeout):
+        queue = self.queues[queue_url]
+        if receipt_handle in queue.in_flight:
+            message, _ = queue.in_flight[receipt_handle]
+            queue.in_flight[receipt_handle] = (message, time.monotonic() + visibility_timeout)
+        self.changed.notify_all()
+
+    def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout, **kwargs):
+        self.record('ChangeMessageVisibility')
+        with self.changed:
+            self.set_visibility(QueueUrl, ReceiptHandle, VisibilityTimeout)
+
+    def change_message_visibility_batch(self, QueueUrl, Entries, **kwargs):
+        self.record('ChangeMessageVisibilityBatch')
+        with self.changed:
+            for entry in Entries:
+                self.set_visibility(QueueUrl, entry['ReceiptHandle'], entry['VisibilityTimeout'])
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+    def pending(self, queue_url):
+        with self.changed:
+            queue = self.queues[queue_url]
+            return len(queue.visible) + len(queue.in_flight)
+
+
+def synthetic_page_blocks(page_number, lines_per_page):
+    blocks = [{'BlockType': 'PAGE', 'Page': page_number, 'Id': uuid.uuid4().hex}]
+    for line in range(lines_per_page):
+        blocks.append({'BlockType': 'LINE', 'Page': page_number, 'Id': uuid.uuid4().hex, 'Confidence': 99.0,
+                       'Text': f'Synthetic line {line + 1} of page {page_number} for benchmark runs'})
+    return blocks
+
+
+class FakeTextractClient(RequestCounter):
+    """ Async text detection over the fake S3 objects.
+
+    A started job "completes" after job_latency_ms plus page_latency_ms per page, then a completion
+    notification is sent to the completed-Textract queue, as SNS would deliver it. Results are either
+    synthetic LINE blocks or blocks replayed page by page from a recorded GetDocumentTextDetection response.
+    """
+
+    def __init__(self, s3_client, sqs_client, completed_queue_url, lines_per_page=40, recorded_blocks=None,
+                 job_latency_ms=0, page_latency_ms=0, latency_ms=0):
+        super().__init__(latency_ms)
+        self.s3_client = s3_client
+        self.sqs_client = sqs_client
+        self.completed_queue_url = completed_queue_url
+        self.lines_per_page = lines_per_page
+        self.recorded_pages = self.group_by_page(recorded_blocks) if recorded_blocks else None
+        self.job_latency = job_latency_ms / 1000
+        self.page_latency = page_latency_ms / 1000
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.timers = []
+        self.exceptions = FakeExceptions()
+
+    @staticmethod
+    def group_by_page(blocks):
+        pages = collections.defaultdict(list)
+        for block in blocks:
+            if 'Page' in block:
+                pages[block['Page']].append(block)
+        return [pages[page] for page in sorted(pages)]
+
+    def get_page_blocks(self, page_number):
+        if self.recorded_pages is None:
+            return synthetic_page_blocks(page_number, self.lines_per_page)
+        recorded = self.recorded_pages[(page_number - 1) % len(self.recorded_pages)]
+        return [dict(block, Page=page_number) for block in recorded]
+
+    def start_document_text_detection(self, DocumentLocation, NotificationChannel=None, **kwargs):
+        self.record('StartDocumentTextDetection')
+        document_path = DocumentLocation['S3Object']['Name']
+        with fitz.open(stream=self.s3_client.load(document_path, 'GetObject')[0], filetype='pdf') as pdf_document:
+            page_count = pdf_document.page_count
+
+        job_id = uuid.uuid4().hex
+        blocks = [block for page in range(1, page_count + 1) for block in self.get_page_blocks(page)]
+        with self.lock:
+            self.jobs[job_id] = blocks
+
+        notification = json.dumps({'JobId': job_id, 'Status': 'SUCCEEDED', 'API': 'StartDocumentTextDetection',
+                                   'DocumentLocation': {'S3ObjectName': document_path,
+                                                        'S3Bucket': DocumentLocation['S3Object']['Bucket']}})
+        delay = self.job_latency + self.page_latency * page_count
+        if delay:
+            timer = threading.Timer(delay, self.sqs_client.send_message, (self.completed_queue_url, notification))
+            timer.daemon = True
+            timer.start()
+            self.timers.append(timer)
+        else:
+            self.sqs_client.send_message(self.completed_queue_url, notification)
+        return {'JobId': job_id}
+
+    def get_document_text_detection(self, JobId, MaxResults=1000, NextToken=None, **kwargs):
+        self.record('GetDocumentTextDetection')
+        with self.lock:
+            blocks = self.jobs[JobId]
+        start = int(NextToken or 0)
+        response = {'JobStatus': 'SUCCEEDED', 'Blocks': blocks[start:start + MaxResults]}
+        if start + MaxResults < len(blocks):
+            response['NextToken'] = str(start + MaxResults)
+        return response
+
+
+class EmptyPaginator:
+    result_keys = []
+
+    def paginate(self, *args, **kwargs):
+        return iter([{}])
+
+
+class FakeLogsClient(RequestCounter):
+    def __init__(self):
+        super().__init__()
+        self.events = 0
+        self.exceptions = FakeExceptions()
+
+    def put_log_events(self, logEvents, **kwargs):
+        self.record('PutLogEvents')
+        with self.counter_lock:
+            self.events += len(logEvents)
+        return {'nextSequenceToken': uuid.uuid4().hex}
+
+    def get_paginator(self, operation_name):
+        self.record(operation_name)
+        return EmptyPaginator()
+
+    def __getattr__(self, name):
+        # create_log_group, create_log_stream, describe_log_streams, put_retention_policy...
+        def call(*args, **kwargs):
+            self.record(name)
+            return {}
+        return call
+
+
+class FakeBatchApi(RequestCounter):
+    """ Stands in for the Kubernetes Batch API and for the pods its Jobs would run.
+
+    A Textract Job starts text detection for its document (or for every part of its split manifest, for an
+    Indexed Job) the way the Textract job image does; an LLM Job marks its document as done.
+    """
+
+    def __init__(self, s3_client, textract_client, latency_ms=0):
+        super().__init__(latency_ms)
+        self.s3_client = s3_client
+        self.textract_client = textract_client
+        self.jobs = []
+        self.completed_documents = set()
+        self.lock = threading.Lock()
+        self.document_completed = threading.Condition(self.lock)
+
+    @staticmethod
+    def get_env(job_manifest, name):
+        for env_variable in job_manifest['spec']['template']['spec']['containers'][0]['env']:
+            if env_variable['name'] == name:
+                return env_variable['value']
+        return None
+
+    def start_text_detection(self, document_path):
+        self.textract_client.start_document_text_detection(
+            DocumentLocation={'S3Object': {'Bucket': 'benchmark', 'Name': document_path}})
+
+    def create_namespaced_job(self, namespace, body, **kwargs):
+        self.record('CreateNamespacedJob')
+        with self.lock:
+            self.jobs.append(body['metadata']['name'])
+
+        input_message = self.get_env(body, 'INPUT_MESSAGE')
+        if body['metadata']['name'].startswith('textract-job'):
+            message_body = json.loads(input_message)
+            if 'split_manifest_path' in message_body:
+                manifest = json.loads(self.s3_client.load(message_body['split_manifest_path'], 'GetObject')[0])
+                for part in manifest['parts']:
+                    self.start_text_detection(part['key'])
+            else:
+                self.start_text_detection(message_body['document_path'])
+        else:
+            with self.document_completed:
+                self.completed_documents.add(json.loads(input_message)['document_path'])
+                self.document_completed.notify_all()
+        return body
+
+    def wait_for_documents(self, count, timeout):
+        deadline = time.monotonic() + timeout
+        with self.document_completed:
+            while len(self.completed_documents) < count and time.monotonic() < deadline:
+                self.document_completed.wait(min(deadline - time.monotonic(), 0.5))
+            return len(self.completed_documents)
+
+
+class FakeAWS:
+    """ boto3.client replacement handing out one shared fake per service """
+
+    def __init__(self, completed_queue_url, s3_latency_ms=0, sqs_latency_ms=0, textract_options=None, s3_bandwidth_mbps=0):
+        self.s3 = FakeS3Client(s3_latency_ms, s3_bandwidth_mbps)
+        self.sqs = FakeSQSClient(sqs_latency_ms)
+        self.textract = FakeTextractClient(self.s3, self.sqs, completed_queue_url, **(textract_options or {}))
+        self.logs = FakeLogsClient()
+
+    def client(self, service_name, *args, **kwargs):
+        return getattr(self, service_name)
+
+    def get_request_counts(self):
+        return {service: dict(getattr(self, service).requests) for service in ('s3', 'sqs', 'textract', 'logs')}
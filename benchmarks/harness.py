@@ -0,0 +1,342 @@
+""" Offline end-to-end benchmark of the Textract and LLM runners.
+
+Both runners run in one process against the in-memory fakes in benchmarks.fakes, so no AWS account or
+cluster is needed. Every document is followed from the start-Textract queue through splitting, Textract,
+the completed-Textract queue and merging, to its LLM Job. The run reports documents/sec, per-stage latency
+from the runners' own metrics, peak RSS, request counts per service and S3 bytes moved. Results are written to
+benchmarks/results/ so runs on different commits can be compared.
+
+    python -m benchmarks.harness --documents 20 --pages 40 --size-mb 4 --concurrency 4
+    python -m benchmarks.harness --messages messages.jsonl --compare benchmarks/results/<earlier run>.json
+    python -m benchmarks.harness --log-records 200000
+
+A --messages file holds one start-Textract message per line, e.g. {"document_path": "..."}. Optional
+"pages", "size_mb" and "at_ms" fields shape the synthetic PDF created for that path and delay the message
+to replay the original arrival times.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import time
+from unittest import mock
+
+from benchmarks.fakes import FakeAWS, FakeBatchApi
+from benchmarks.synthetic import make_pdf
+
+START_TEXTRACT_QUEUE_URL = 'https://sqs.benchmark.local/000000000000/start-textract'
+COMPLETED_TEXTRACT_QUEUE_URL = 'https://sqs.benchmark.local/000000000000/completed-textract'
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+MESSAGE_SHAPE_FIELDS = ('pages', 'size_mb', 'scanned_ratio', 'at_ms')
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--documents', type=int, default=10, help='synthetic documents to generate')
+    parser.add_argument('--pages', type=int, default=20, help='pages per synthetic document')
+    parser.add_argument('--size-mb', type=float, default=1.0, help='approximate size of each synthetic document')
+    parser.add_argument('--scanned-ratio', type=float, default=0.0,
+                        help='share of synthetic pages that are scans without a text layer')
+    parser.add_argument('--projects', type=int, default=2, help='projects the synthetic documents are spread over')
+    parser.add_argument('--messages', help='JSONL file of start-Textract messages to replay instead')
+    parser.add_argument('--concurrency', type=int, default=4, help='MAX_CONCURRENT_MESSAGES of both runners')
+    parser.add_argument('--s3-latency-ms', type=float, default=0, help='added latency per S3 request')
+    parser.add_argument('--s3-mbps', type=float, default=0, help='S3 bandwidth per request in MB/s, 0 for unlimited')
+    parser.add_argument('--sqs-latency-ms', type=float, default=0, help='added latency per SQS request')
+    parser.add_argument('--textract-job-latency-ms', type=float, default=0, help='time for a Textract job to finish')
+    parser.add_argument('--textract-page-latency-ms', type=float, default=0, help='extra Textract time per page')
+    parser.add_argument('--textract-response', help='recorded GetDocumentTextDetection JSON to replay per page')
+    parser.add_argument('--lines-per-page', type=int, default=40, help='LINE blocks per synthetic Textract page')
+    parser.add_argument('--timeout', type=float, default=600, help='give up after this many seconds')
+    parser.add_argument('--log-records', type=int, help='benchmark the logging pipeline with this many records')
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help='runner setting for this run, e.g. --env INDEXED_JOB_FANOUT=true')
+    parser.add_argument('--name', help='result file name, defaults to <timestamp>-<commit>')
+    parser.add_argument('--compare', help='earlier result file to compare against')
+    parser.add_argument('--no-save', action='store_true', help='do not write the result file')
+    return parser.parse_args(argv)
+
+
+def configure_environment(args):
+    """ Runner settings are read from the environment at import time, so this runs before any app import """
+    os.environ.update({
+        'START_TEXTRACT_QUEUE_URL': START_TEXTRACT_QUEUE_URL,
+        'COMPLETED_TEXTRACT_QUEUE_URL': COMPLETED_TEXTRACT_QUEUE_URL,
+        'ENVIRONMENT': 'benchmark',
+        'TEXTRACT_IMAGE_NAME': 'benchmark/textract',
+        'LLM_IMAGE_NAME': 'benchmark/llm',
+        'MAX_CONCURRENT_MESSAGES': str(args.concurrency),
+        'METRICS_ENABLED': 'false',
+    })
+    for setting in args.env:
+        name, _, value = setting.partition('=')
+        os.environ[name] = value
+
+
+def load_messages(args):
+    if args.messages:
+        with open(args.messages) as file:
+            return [json.loads(line) for line in file if line.strip()]
+    return [{"document_path": f"benchmark/user/project-{index % args.projects}/request/document-{index}.pdf",
+             "pages": args.pages, "size_mb": args.size_mb, "scanned_ratio": args.scanned_ratio}
+            for index in range(args.documents)]
+
+
+def seed_documents(fake_aws, messages, args):
+    for message in messages:
+        document_path = message['document_path']
+        if document_path not in fake_aws.s3.objects:
+            fake_aws.s3.store(document_path, make_pdf(message.get('pages', args.pages),
+                                                      message.get('size_mb', args.size_mb), document_path,
+                                                      message.get('scanned_ratio', args.scanned_ratio)))
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def stop_split_workers():
+    """ Shuts the split pool down and waits for its workers, since RUSAGE_CHILDREN only counts reaped children """
+    from app.service.helper import pdf_splitter
+
+    if pdf_splitter.split_executor is not None:
+        pdf_splitter.split_executor.shutdown(wait=True)
+        pdf_splitter.split_executor = None
+
+
+def get_peak_rss_mb():
+    """ Peak RSS of the runner process and of the largest split worker; call stop_split_workers first """
+    return {"runner": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "split_workers": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024}
+
+
+def get_percentile(buckets, count, percentile):
+    """ Linear interpolation inside the histogram bucket holding the percentile """
+    rank = count * percentile
+    previous_bound, previous_count = 0.0, 0.0
+    for bound, cumulative in buckets:
+        if cumulative >= rank:
+            if bound == float('inf'):
+                return previous_bound
+            fraction = (rank - previous_count) / (cumulative - previous_count) if cumulative > previous_count else 0
+            return previous_bound + (bound - previous_bound) * fraction
+        previous_bound, previous_count = bound, cumulative
+    return previous_bound
+
+
+def get_stage_stats():
+    from app.common.metrics import STAGE_DURATION
+
+    stages = {}
+    for metric in STAGE_DURATION.collect():
+        for sample in metric.samples:
+            stage = stages.setdefault(sample.labels['stage'], {"buckets": []})
+            if sample.name.endswith('_bucket'):
+                stage['buckets'].append((float(sample.labels['le']), sample.value))
+            elif sample.name.endswith('_count'):
+                stage['count'] = int(sample.value)
+            elif sample.name.endswith('_sum'):
+                stage['sum'] = sample.value
+
+    stats = {}
+    for name, stage in sorted(stages.items()):
+        count = stage.get('count', 0)
+        if not count:
+            continue
+        buckets = sorted(stage['buckets'])
+        stats[name] = {"count": count, "mean_ms": stage['sum'] / count * 1000,
+                       "p50_ms": get_percentile(buckets, count, 0.5) * 1000,
+                       "p95_ms": get_percentile(buckets, count, 0.95) * 1000}
+    return stats
+
+
+def get_runner_s3_bytes():
+    """ runner_s3_bytes_total by direction, as the runners themselves report it """
+    from app.common.metrics import S3_BYTES
+
+    return {sample.labels['direction']: int(sample.value) for metric in S3_BYTES.collect()
+            for sample in metric.samples if sample.name.endswith('_total')}
+
+
+async def replay(fake_aws, messages):
+    started_at = time.perf_counter()
+    for message in sorted(messages, key=lambda message: message.get('at_ms', 0)):
+        delay = message.get('at_ms', 0) / 1000 - (time.perf_counter() - started_at)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        body = {key: value for key, value in message.items() if key not in MESSAGE_SHAPE_FIELDS}
+        await asyncio.to_thread(fake_aws.sqs.send_message, START_TEXTRACT_QUEUE_URL, json.dumps(body))
+
+
+def quiet_console():
+    """ The console handler would dominate the run, CloudWatch shipping to the fake is kept """
+    from app.common import cloudwatch_helper
+
+    if cloudwatch_helper.log_pipeline:
+        for handler in cloudwatch_helper.log_pipeline.handlers:
+            if type(handler) is logging.StreamHandler:
+                handler.setLevel(logging.WARNING)
+
+
+async def run_pipeline(fake_aws, messages, args):
+    startup_started_at = time.perf_counter()
+    from app.llm.llm_runner import LLMRunner
+    from app.textract.textract_runner import TextractRunner
+
+    textract_runner = TextractRunner()
+    llm_runner = LLMRunner()
+    startup_seconds = time.perf_counter() - startup_started_at
+    quiet_console()
+    batch_api = FakeBatchApi(fake_aws.s3, fake_aws.textract)
+    textract_runner.job_launcher.batch_api = batch_api
+    llm_runner.job_launcher.batch_api = batch_api
+
+    textract_pool = textract_runner.create_worker_pool()
+    llm_pool = llm_runner.create_worker_pool()
+    document_count = len({message['document_path'] for message in messages})
+
+    started_at = time.perf_counter()
+    pools = asyncio.gather(textract_pool.run(), llm_pool.run())
+    await replay(fake_aws, messages)
+    completed = await asyncio.to_thread(batch_api.wait_for_documents, document_count, args.timeout)
+    elapsed = time.perf_counter() - started_at
+
+    textract_pool.stop()
+    llm_pool.stop()
+    fake_aws.sqs.close()
+    await pools
+    await textract_runner.lease_manager.close()
+    await llm_runner.lease_manager.close()
+    stop_split_workers()
+
+    return {
+        "startup_seconds": startup_seconds,
+        "documents": document_count,
+        "completed_documents": completed,
+        "wall_seconds": elapsed,
+        "documents_per_second": completed / elapsed if elapsed > 0 else 0.0,
+        "pages": sum(message.get('pages', args.pages) for message in messages),
+        "jobs_created": len(batch_api.jobs),
+        "stages": get_stage_stats(),
+        "requests": dict(fake_aws.get_request_counts(), kubernetes=dict(batch_api.requests)),
+        "s3_bytes": dict(fake_aws.s3.transferred),
+        "runner_s3_bytes": get_runner_s3_bytes(),
+        "peak_rss_mb": get_peak_rss_mb(),
+    }
+
+
+async def run_logging(fake_aws, args):
+    """ Hot-loop cost of a log call, and how fast the pipeline ships records to CloudWatch """
+    from app.common import cloudwatch_helper
+
+    logger = cloudwatch_helper.get_cloudwatch_logger(log_stream_name='benchmark')
+    quiet_console()
+    cloudwatch_helper.set_log_context('benchmark-project', 'benchmark-document.pdf')
+
+    started_at = time.perf_counter()
+    for index in range(args.log_records):
+        logger.info('Benchmark record %d', index)
+    enqueue_seconds = time.perf_counter() - started_at
+
+    stats = cloudwatch_helper.log_pipeline.get_stats()
+    cloudwatch_helper.log_pipeline.stop()
+    elapsed = time.perf_counter() - started_at
+
+    return {
+        "records": args.log_records,
+        "enqueue_us_per_record": enqueue_seconds / args.log_records * 1e6,
+        "delivered_records": fake_aws.logs.events,
+        "records_per_second": fake_aws.logs.events / elapsed if elapsed > 0 else 0.0,
+        "dropped_records": stats['dropped'],
+        "requests": {"logs": dict(fake_aws.logs.requests)},
+        "peak_rss_mb": get_peak_rss_mb(),
+    }
+
+
+def print_report(result, previous=None):
+    print(f"\nBenchmark {result['name']} ({result['commit']})")
+    for key in ('startup_seconds', 'documents', 'completed_documents', 'pages', 'jobs_created', 'wall_seconds', 'documents_per_second',
+                'records', 'enqueue_us_per_record', 'delivered_records', 'records_per_second', 'dropped_records'):
+        if key in result:
+            change = ''
+            if previous and isinstance(previous.get(key), (int, float)) and previous[key]:
+                change = f'  ({(result[key] / previous[key] - 1) * 100:+.1f}% vs {previous["commit"]})'
+            print(f'  {key:<24} {result[key]:.3f}{change}' if isinstance(result[key], float) else
+                  f'  {key:<24} {result[key]}{change}')
+
+    if result.get('stages'):
+        print(f"\n  {'stage':<24} {'count':>7} {'mean ms':>10} {'p50 ms':>10} {'p95 ms':>10}")
+        for stage, stats in result['stages'].items():
+            previous_p95 = ((previous or {}).get('stages') or {}).get(stage, {}).get('p95_ms')
+            change = f"  ({(stats['p95_ms'] / previous_p95 - 1) * 100:+.1f}% p95)" if previous_p95 else ''
+            print(f"  {stage:<24} {stats['count']:>7} {stats['mean_ms']:>10.2f} {stats['p50_ms']:>10.2f} "
+                  f"{stats['p95_ms']:>10.2f}{change}")
+
+    print('\n  requests')
+    for service, counts in result['requests'].items():
+        if counts:
+            print(f"    {service:<10} {sum(counts.values()):>7}  {dict(sorted(counts.items()))}")
+    for key in ('s3_bytes', 'runner_s3_bytes'):
+        if result.get(key):
+            previous_bytes = (previous or {}).get(key) or {}
+            print(f"\n  {key}")
+            for direction, byte_count in sorted(result[key].items()):
+                change = (f"  ({(byte_count / previous_bytes[direction] - 1) * 100:+.1f}% vs {previous['commit']})"
+                          if previous_bytes.get(direction) else '')
+                print(f"    {direction:<10} {byte_count / (1024 * 1024):>10.2f} MB{change}")
+    print(f"\n  peak RSS MB: {result['peak_rss_mb']}")
+
+
+def save_result(result):
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"{result['name']}.json")
+    with open(path, 'w') as file:
+        json.dump(result, file, indent=2)
+    return path
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    configure_environment(args)
+
+    recorded_blocks = None
+    if args.textract_response:
+        with open(args.textract_response) as file:
+            recorded_blocks = json.load(file)['Blocks']
+    fake_aws = FakeAWS(COMPLETED_TEXTRACT_QUEUE_URL, args.s3_latency_ms, args.sqs_latency_ms, {
+        'lines_per_page': args.lines_per_page, 'recorded_blocks': recorded_blocks,
+        'job_latency_ms': args.textract_job_latency_ms, 'page_latency_ms': args.textract_page_latency_ms},
+        args.s3_mbps)
+
+    # Clients and the cluster config are created on first use, inside this block
+    with mock.patch('boto3.client', fake_aws.client), mock.patch('kubernetes.config.load_incluster_config'):
+        if args.log_records:
+            result = asyncio.run(run_logging(fake_aws, args))
+        else:
+            messages = load_messages(args)
+            seed_documents(fake_aws, messages, args)
+            result = asyncio.run(run_pipeline(fake_aws, messages, args))
+
+    commit = get_git_commit()
+    result.update({"commit": commit, "name": args.name or f"{time.strftime('%Y%m%d-%H%M%S')}-{commit}",
+                   "config": vars(args)})
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as file:
+            previous = json.load(file)
+    print_report(result, previous)
+    if not args.no_save:
+        print(f'\n  saved to {save_result(result)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+""" Offline micro-benchmarks of single stages against the approach they replaced.
+
+    python -m benchmarks.micro page-count --pages 3000 --size-mb 50
+    python -m benchmarks.micro s3 --requests 64
+    python -m benchmarks.micro merge-memory --pages 1000,5000,20000
+    python -m benchmarks.micro textract --pages 3000
+
+page-count reads the page count from the PDF header through ranged GETs and compares bytes and latency
+with downloading and opening the whole document. s3 compares concurrent S3Utils calls, which run on the
+S3 executor, with boto3 calls made directly on the event loop. merge-memory compares the peak Python
+memory of the streaming JSON merge with loading every part and dumping one merged dict. textract compares
+TextractHelper.get_text with the string concatenation loop it replaced, over the pages of a saved
+GetDocumentTextDetection response (--textract-response) repeated up to --pages.
+S3 requests take --s3-latency-ms plus their size at --s3-mbps.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from unittest import mock
+
+import fitz
+
+from benchmarks.fakes import FakeAWS
+from benchmarks.synthetic import make_pdf
+
+BUCKET = 'benchmark'
+MB = 1024 * 1024
+TEXTRACT_RESPONSE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'textract_response.json')
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmark', choices=('page-count', 's3', 'merge-memory', 'textract'))
+    parser.add_argument('--pages', default='3000', help='pages per document; a comma-separated list for merge-memory')
+    parser.add_argument('--size-mb', type=float, default=20.0, help='approximate size of the page-count document')
+    parser.add_argument('--requests', type=int, default=64, help='concurrent reads for the s3 benchmark')
+    parser.add_argument('--object-kb', type=int, default=256, help='object size for the s3 benchmark')
+    parser.add_argument('--part-pages', type=int, default=500, help='pages per split part for merge-memory')
+    parser.add_argument('--page-kb', type=float, default=3.0, help='Textract text per page for merge-memory')
+    parser.add_argument('--textract-response', default=TEXTRACT_RESPONSE,
+                        help='recorded GetDocumentTextDetection JSON whose pages the textract benchmark repeats')
+    parser.add_argument('--textract-latency-ms', type=float, default=0, help='added latency per Textract request')
+    parser.add_argument('--s3-latency-ms', type=float, default=20, help='added latency per S3 request')
+    parser.add_argument('--s3-mbps', type=float, default=100, help='S3 bandwidth per request in MB/s, 0 for unlimited')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per approach, the best one is reported')
+    return parser.parse_args(argv)
+
+
+async def best_of(repeat, run):
+    """ Fastest (seconds, result) of repeat runs """
+    best = None
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        result = await run()
+        elapsed = time.perf_counter() - started_at
+        if best is None or elapsed < best[0]:
+            best = (elapsed, result)
+    return best
+
+
+def print_comparison(rows):
+    print(f"\n  {'approach':<28} {'seconds':>10} {'MB moved':>10} {'requests':>9}")
+    for name, seconds, byte_count, request_count in rows:
+        print(f"  {name:<28} {seconds:>10.4f} {byte_count / MB:>10.3f} {request_count:>9}")
+    baseline, current = rows[0], rows[1]
+    if current[1]:
+        print(f"\n  speedup of {current[0]} over {baseline[0]}: {baseline[1] / current[1]:.2f}x")
+
+
+async def run_page_count(fake_aws, args):
+    from app.common.pdf_header import PdfHeaderReader
+    from app.common.s3_utils import S3Utils
+
+    s3_utils = S3Utils()
+    key = 'benchmark/user/project/request/document.pdf'
+    fake_aws.s3.store(key, make_pdf(int(args.pages), args.size_mb, key))
+
+    async def from_header():
+        reader = PdfHeaderReader(s3_utils, BUCKET, key)
+        return await reader.get_page_count(), reader.bytes_transferred, reader.request_count
+
+    async def from_download():
+        with tempfile.TemporaryDirectory() as directory:
+            local_path = os.path.join(directory, 'document.pdf')
+            await s3_utils.download_object(BUCKET, key, local_path)
+            with fitz.open(local_path) as pdf_document:
+                return pdf_document.page_count, os.path.getsize(local_path), 1
+
+    download_seconds, (download_pages, download_bytes, download_requests) = await best_of(args.repeat, from_download)
+    header_seconds, (header_pages, header_bytes, header_requests) = await best_of(args.repeat, from_header)
+    assert header_pages == download_pages, (header_pages, download_pages)
+    print(f"\nPage count of a {len(fake_aws.s3.objects[key][0]) / MB:.1f} MB, {header_pages} page PDF")
+    print_comparison([('full download and open', download_seconds, download_bytes, download_requests),
+                      ('header ranged GETs', header_seconds, header_bytes, header_requests)])
+
+
+async def run_s3(fake_aws, args):
+    from app.common.s3_utils import S3Utils
+
+    s3_utils = S3Utils()
+    keys = [f'benchmark/objects/{index}.json' for index in range(args.requests)]
+    for key in keys:
+        fake_aws.s3.store(key, os.urandom(args.object_kb * 1024))
+
+    async def on_event_loop():
+        # The calls S3Utils made before its executor: boto3 straight from the coroutine
+        async def read(key):
+            return fake_aws.s3.get_object(Bucket=BUCKET, Key=key)['Body'].read()
+        return await asyncio.gather(*(read(key) for key in keys))
+
+    async def on_executor():
+        return await asyncio.gather(*(s3_utils.read_object(BUCKET, key) for key in keys))
+
+    byte_count = args.requests * args.object_kb * 1024
+    loop_seconds, _ = await best_of(args.repeat, on_event_loop)
+    executor_seconds, _ = await best_of(args.repeat, on_executor)
+    print(f"\n{args.requests} concurrent {args.object_kb} KB reads")
+    print_comparison([('boto3 on the event loop', loop_seconds, byte_count, args.requests),
+                      ('S3Utils executor', executor_seconds, byte_count, args.requests)])
+
+
+def store_parts(fake_aws, page_count, args):
+    """ Split part JSONs of one document as the LLM runner finds them, and their manifest """
+    json_path = f'benchmark/user/project-{page_count}/textract_response/split_documents_json/document'
+    page_text = 'x' * int(args.page_kb * 1024)
+    parts = []
+    for start_page in range(1, page_count + 1, args.part_pages):
+        end_page = min(start_page + args.part_pages - 1, page_count)
+        name = f'document_{start_page}_to_{end_page}'
+        data = {f'page_{page}': page_text for page in range(1, end_page - start_page + 2)}
+        fake_aws.s3.store(f'{json_path}/{name}_text.json', json.dumps(data).encode('utf-8'))
+        parts.append({"name": name, "start_page": start_page, "end_page": end_page})
+    return json_path, {"document_path": f'{json_path}.pdf', "page_count": page_count, "parts": parts}
+
+
+async def merge_in_memory(s3_utils, json_path, manifest):
+    """ The merge before streaming: every part loaded into one dict, dumped and uploaded in one PUT """
+    merged = {}
+    for part in manifest['parts']:
+        data = json.loads(await s3_utils.read_object(BUCKET, f"{json_path}/{part['name']}_text.json"))
+        for key, text in data.items():
+            merged[f"page_{part['start_page'] + int(key[len('page_'):]) - 1}"] = text
+    await s3_utils.upload_object(BUCKET, f'{json_path}_in_memory.json', json.dumps(merged).encode('utf-8'))
+
+
+async def measure_peak(run):
+    tracemalloc.start()
+    try:
+        started_at = time.perf_counter()
+        await run()
+        elapsed = time.perf_counter() - started_at
+        return elapsed, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+async def run_merge_memory(fake_aws, args):
+    from app.common.s3_utils import S3Utils
+    from app.service.helper.json_merger import merged_json_file
+
+    s3_utils = S3Utils()
+    print(f"\n  {'pages':>7} {'in-memory s':>12} {'in-memory MB':>13} {'streaming s':>12} {'streaming MB':>13}")
+    for page_count in (int(pages) for pages in args.pages.split(',')):
+        json_path, manifest = store_parts(fake_aws, page_count, args)
+        memory_seconds, memory_peak = await measure_peak(lambda: merge_in_memory(s3_utils, json_path, manifest))
+        streaming_seconds, streaming_peak = await measure_peak(lambda: merged_json_file(json_path, manifest))
+        print(f"  {page_count:>7} {memory_seconds:>12.3f} {memory_peak / MB:>13.1f} "
+              f"{streaming_seconds:>12.3f} {streaming_peak / MB:>13.1f}")
+
+
+def get_text_by_concatenation(textract_client, job_id):
+    """ TextractHelper.get_text before it collected lines per page: one request after the other on the
+    event loop, each page's text grown one line at a time """
+    page_wise_text = {}
+    next_token = None
+    while True:
+        if next_token:
+            textract_response = textract_client.get_document_text_detection(JobId=job_id, NextToken=next_token)
+        else:
+            textract_response = textract_client.get_document_text_detection(JobId=job_id)
+
+        for block in textract_response['Blocks']:
+            if block['BlockType'] == 'LINE':
+                page_key = 'page_' + str(block['Page'])
+                page_wise_text[page_key] = page_wise_text.get(page_key, '') + block['Text'] + ' '
+
+        if 'NextToken' in textract_response:
+            next_token = textract_response['NextToken']
+        else:
+            break
+    return page_wise_text
+
+
+async def run_textract(fake_aws, args):
+    import logging
+    from app.service.helper.textract_helper import TextractHelper
+
+    with open(args.textract_response) as file:
+        recorded_pages = fake_aws.textract.group_by_page(json.load(file)['Blocks'])
+    page_count = int(args.pages)
+    blocks = [dict(block, Page=page_number) for page_number in range(1, page_count + 1)
+              for block in recorded_pages[(page_number - 1) % len(recorded_pages)]]
+    job_id = 'benchmark-job'
+    fake_aws.textract.jobs[job_id] = blocks
+    textract_helper = TextractHelper(logging.getLogger('benchmark'))
+
+    async def by_concatenation():
+        return get_text_by_concatenation(fake_aws.textract, job_id)
+
+    async def by_page_lines():
+        return await textract_helper.get_text(job_id)
+
+    byte_count = len(json.dumps(blocks))
+    request_count = -(-len(blocks) // 1000)
+    concatenation_seconds, concatenated = await best_of(args.repeat, by_concatenation)
+    page_lines_seconds, joined = await best_of(args.repeat, by_page_lines)
+    assert joined == concatenated
+    print(f"\nText of {page_count} pages, {len(blocks)} blocks from {os.path.basename(args.textract_response)}")
+    print_comparison([('concatenation loop', concatenation_seconds, byte_count, request_count),
+                      ('TextractHelper.get_text', page_lines_seconds, byte_count, request_count)])
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    os.environ.setdefault('METRICS_ENABLED', 'false')
+    fake_aws = FakeAWS('https://sqs.benchmark.local/000000000000/completed-textract', args.s3_latency_ms,
+                       textract_options={'latency_ms': args.textract_latency_ms}, s3_bandwidth_mbps=args.s3_mbps)
+
+    benchmarks = {'page-count': run_page_count, 's3': run_s3, 'merge-memory': run_merge_memory,
+                  'textract': run_textract}
+    with mock.patch('boto3.client', fake_aws.client):
+        asyncio.run(benchmarks[args.benchmark](fake_aws, args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+""" Synthetic input documents for benchmark runs """
+import math
+import os
+
+import fitz
+
+
+def make_pdf(page_count, size_mb=0.0, label='', scanned_ratio=0.0):
+    """ A PDF of page_count text pages, padded towards size_mb with one incompressible noise image per page.
+
+    label is written on every page so documents with the same shape still have distinct content.
+    A scanned_ratio share of the pages, spread evenly, are scans instead: a full-page image without a text layer.
+    """
+    pdf_document = fitz.open()
+    image_bytes = int(size_mb * 1024 * 1024 / page_count) if size_mb else 0
+    side = int(math.sqrt(image_bytes / 3)) if image_bytes else 0
+
+    for page_number in range(1, page_count + 1):
+        page = pdf_document.new_page()
+        if int(page_number * scanned_ratio) != int((page_number - 1) * scanned_ratio):
+            scan = fitz.Pixmap(fitz.csGRAY, 64, 64, os.urandom(64 * 64), False)
+            page.insert_image(page.rect, pixmap=scan)
+        else:
+            lines = [f'{label} page {page_number} of {page_count}']
+            lines.extend(f'Synthetic medical record line {line}' for line in range(1, 30))
+            page.insert_text((72, 72), lines, fontsize=10)
+        if side:
+            pixmap = fitz.Pixmap(fitz.csRGB, side, side, os.urandom(side * side * 3), False)
+            page.insert_image(fitz.Rect(72, 700, 144, 772), pixmap=pixmap)
+
+    data = pdf_document.tobytes(garbage=3, deflate=True)
+    pdf_document.close()
+    return data
@@ -0,0 +1,92 @@
+import asyncio
+import json
+
+import pytest
+
+from app.common import clients
+from app.common.s3_utils import S3Utils
+from app.service.helper.completion_tracker import (CompletionTracker, S3CompletionBackend,
+                                                   SQLiteCompletionBackend)
+from benchmarks.fakes import FakeS3Client
+
+DOCUMENT_KEY = 'user/project/request/split_manifests/document.json'
+
+
+@pytest.fixture
+def fake_s3(monkeypatch):
+    # A little latency per request so concurrent read-modify-writes overlap
+    fake_s3 = FakeS3Client(latency_ms=2)
+    monkeypatch.setattr(clients, 'clients', {'s3': fake_s3})
+    return fake_s3
+
+
+@pytest.fixture(params=['sqlite', 's3'])
+def tracker(request, tmp_path):
+    if request.param == 'sqlite':
+        return CompletionTracker(SQLiteCompletionBackend(str(tmp_path / 'completion_tracker.db')))
+    request.getfixturevalue('fake_s3')
+    return CompletionTracker(S3CompletionBackend(S3Utils()))
+
+
+async def complete_parts(tracker, part_indexes, part_count, split_id='split-1'):
+    return await asyncio.gather(*(tracker.mark_complete(DOCUMENT_KEY, part_index, part_count, split_id)
+                                  for part_index in part_indexes))
+
+
+def test_exactly_one_concurrent_completion_claims_the_merge(tracker):
+    # Every part completes at once, and the last two are delivered twice
+    results = asyncio.run(complete_parts(tracker, [0, 1, 2, 3, 4, 5, 4, 5], 6))
+
+    assert sum(claimed for claimed, _ in results) == 1
+    assert max(completed for _, completed in results) == 6
+
+
+def test_release_lets_a_redelivery_claim_again(tracker):
+    async def run():
+        first = await complete_parts(tracker, [0, 1, 2], 3)
+        redelivered_before_release = await tracker.mark_complete(DOCUMENT_KEY, 2, 3, 'split-1')
+        await tracker.release(DOCUMENT_KEY, 'split-1')
+        redelivered = await complete_parts(tracker, [2, 2, 2], 3)
+        return first, redelivered_before_release, redelivered
+
+    first, redelivered_before_release, redelivered = asyncio.run(run())
+
+    assert sum(claimed for claimed, _ in first) == 1
+    assert redelivered_before_release == (False, 3)
+    assert sum(claimed for claimed, _ in redelivered) == 1
+
+
+def test_a_new_split_starts_over(tracker):
+    async def run():
+        await complete_parts(tracker, [0, 1], 3, 'split-1')
+        # The document is split again, into two parts this time; the old split's parts no longer count
+        new_split = await complete_parts(tracker, [0], 2, 'split-2')
+        last_part = await tracker.mark_complete(DOCUMENT_KEY, 1, 2, 'split-2')
+        return new_split, last_part
+
+    new_split, last_part = asyncio.run(run())
+
+    assert new_split == [(False, 1)]
+    assert last_part == (True, 2)
+
+
+def test_s3_backend_retries_a_conditional_write_it_lost(fake_s3):
+    backend = S3CompletionBackend(S3Utils())
+    state_path = backend.get_state_path(DOCUMENT_KEY)
+    put_object = fake_s3.put_object
+    conflicts = []
+
+    def put_object_after_another_writer(**kwargs):
+        if not conflicts:
+            # Another runner completes part 1 between this runner's read and its write
+            conflicts.append(kwargs)
+            fake_s3.store(state_path, json.dumps({"split_id": 'split-1', "completed": [1], "claimed": False}).encode())
+        return put_object(**kwargs)
+
+    fake_s3.put_object = put_object_after_another_writer
+    claimed, completed = asyncio.run(backend.mark_complete(DOCUMENT_KEY, 0, 2, 'split-1'))
+
+    assert conflicts[0]['IfNoneMatch'] == '*'
+    assert (claimed, completed) == (True, 2)
+    assert fake_s3.requests['PutObject'] == 2
+    assert sorted(json.loads(fake_s3.objects[state_path][0])['completed']) == [0, 1]
@@ -0,0 +1,99 @@
+import functools
+import os
+import random
+
+import fitz
+import pytest
+
+from app.constant import MedicalInsights
+from app.service.helper.page_range_planner import measure_document_page_sizes, measure_page_sizes, plan_page_ranges
+
+
+def get_range_bytes(page_sizes, start_page, end_page):
+    """ Size the planner estimates for pages [start_page, end_page), shared objects counted once """
+    objects = {}
+    for page_objects in page_sizes[start_page:end_page]:
+        objects.update(page_objects)
+    return MedicalInsights.SPLIT_PAGE_OVERHEAD_BYTES * (end_page - start_page) + sum(objects.values())
+
+
+def fits(page_sizes, start_page, end_page, max_pages, max_bytes):
+    page_count = end_page - start_page
+    return page_count == 1 or (page_count <= max_pages and get_range_bytes(page_sizes, start_page, end_page) <= max_bytes)
+
+
+def get_minimal_part_count(page_sizes, max_pages, max_bytes):
+    @functools.lru_cache(maxsize=None)
+    def parts_from(start_page):
+        if start_page == len(page_sizes):
+            return 0
+        return min(1 + parts_from(end_page) for end_page in range(start_page + 1, len(page_sizes) + 1)
+                   if fits(page_sizes, start_page, end_page, max_pages, max_bytes))
+
+    return parts_from(0)
+
+
+def make_page_sizes(rng, page_count):
+    """ Pages with their own content streams plus fonts and images shared with other pages """
+    shared = {xref: rng.randint(1_000, 200_000) for xref in range(1, 11)}
+    page_sizes = []
+    for page_number in range(page_count):
+        page_objects = {1000 + page_number: rng.randint(100, 400_000)}
+        page_objects.update((xref, shared[xref]) for xref in rng.sample(sorted(shared), rng.randint(0, 4)))
+        page_sizes.append(page_objects)
+    return page_sizes
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_plan_page_ranges_respects_limits_with_minimal_part_count(seed):
+    rng = random.Random(seed)
+    page_sizes = make_page_sizes(rng, rng.randint(1, 40))
+    max_pages = rng.randint(1, 12)
+    max_bytes = rng.randint(100_000, 2_000_000)
+
+    page_ranges = plan_page_ranges(page_sizes, max_pages, max_bytes)
+
+    assert page_ranges[0][0] == 0 and page_ranges[-1][1] == len(page_sizes)
+    assert all(previous[1] == current[0] for previous, current in zip(page_ranges, page_ranges[1:]))
+    for start_page, end_page in page_ranges:
+        assert fits(page_sizes, start_page, end_page, max_pages, max_bytes)
+    assert len(page_ranges) == get_minimal_part_count(page_sizes, max_pages, max_bytes)
+
+
+def test_plan_page_ranges_keeps_an_oversized_page_on_its_own():
+    page_sizes = [{1: 10}, {2: 5_000}, {3: 10}]
+    assert plan_page_ranges(page_sizes, max_pages=10, max_bytes=4_000) == [(0, 1), (1, 2), (2, 3)]
+
+
+def make_pdf_with_annotations_and_alpha_images(page_count):
+    pdf_document = fitz.open()
+    for page_number in range(page_count):
+        page = pdf_document.new_page()
+        page.insert_text((72, 72), f'page {page_number}', fontsize=12)
+        side = 120
+        image = fitz.Pixmap(fitz.csRGB, side, side, os.urandom(side * side * 3), False)
+        alpha = fitz.Pixmap(fitz.csGRAY, side, side, os.urandom(side * side), False)
+        page.insert_image(fitz.Rect(72, 100, 272, 300), pixmap=fitz.Pixmap(image, alpha))
+        page.add_freetext_annot(fitz.Rect(72, 320, 400, 400), 'annotation text ' * 10)
+    return fitz.open(stream=pdf_document.tobytes(), filetype='pdf')
+
+
+@pytest.mark.parametrize('start_page, end_page', [(0, 1), (0, 6), (3, 12), (0, 12)])
+def test_measure_page_sizes_covers_what_insert_pdf_writes(start_page, end_page):
+    pdf_document = make_pdf_with_annotations_and_alpha_images(12)
+    page_sizes = measure_page_sizes(pdf_document)
+
+    writer = fitz.open()
+    writer.insert_pdf(pdf_document, from_page=start_page, to_page=end_page - 1)
+    actual_bytes = len(writer.tobytes())
+
+    estimate = get_range_bytes(page_sizes, start_page, end_page)
+    assert estimate >= actual_bytes * MedicalInsights.SPLIT_SIZE_SAFETY_FACTOR
+    assert estimate <= actual_bytes * 1.5
+
+
+def test_measure_document_page_sizes_opens_the_file(tmp_path):
+    pdf_document = make_pdf_with_annotations_and_alpha_images(3)
+    source_path = str(tmp_path / 'document.pdf')
+    pdf_document.save(source_path)
+    assert measure_document_page_sizes(source_path) == measure_page_sizes(pdf_document)
@@ -0,0 +1,79 @@
+import asyncio
+
+import fitz
+import pytest
+
+from app.business_rule_exception import PdfHeaderUnsupported
+from app.common import clients
+from app.common.document_session import DocumentSession
+from app.common.pdf_header import PdfHeaderReader
+from app.common.s3_utils import S3Utils
+from app.constant import AWS, MedicalInsights
+from benchmarks.fakes import FakeS3Client
+
+DOCUMENT_PATH = 'user/project/request/document.pdf'
+
+
+def make_pdf(page_count, **save_options):
+    pdf_document = fitz.open()
+    for page_number in range(page_count):
+        pdf_document.new_page().insert_text((72, 72), f'page {page_number + 1}')
+    data = pdf_document.tobytes(**save_options)
+    pdf_document.close()
+    return data
+
+
+def make_incrementally_updated_pdf(tmp_path, page_count, added_pages):
+    """ A PDF saved once, then with pages appended in an incremental update that has its own xref section """
+    path = str(tmp_path / 'incremental.pdf')
+    with open(path, 'wb') as file:
+        file.write(make_pdf(page_count))
+    pdf_document = fitz.open(path)
+    for _ in range(added_pages):
+        pdf_document.new_page()
+    pdf_document.saveIncr()
+    pdf_document.close()
+    with open(path, 'rb') as file:
+        return file.read()
+
+
+@pytest.fixture
+def fake_s3(tmp_path, monkeypatch):
+    fake_s3 = FakeS3Client()
+    monkeypatch.setattr(clients, 'clients', {'s3': fake_s3})
+    monkeypatch.setattr(MedicalInsights, 'STATIC_FOLDER_PATH', str(tmp_path))
+    return fake_s3
+
+
+def read_page_count(fake_s3, data):
+    fake_s3.store(DOCUMENT_PATH, data)
+    reader = PdfHeaderReader(S3Utils(), AWS.S3.S3_BUCKET, DOCUMENT_PATH)
+    return asyncio.run(reader.get_page_count())
+
+
+@pytest.mark.parametrize('save_options', [{}, {'deflate': True}, {'garbage': 3}, {'garbage': 3, 'deflate': True}],
+                         ids=['plain', 'deflated', 'garbage', 'garbage-deflated'])
+def test_page_count_from_the_header(fake_s3, save_options):
+    assert read_page_count(fake_s3, make_pdf(37, **save_options)) == 37
+
+
+def test_page_count_follows_an_incremental_update(fake_s3, tmp_path):
+    data = make_incrementally_updated_pdf(tmp_path, 12, 5)
+    assert data.count(b'startxref') == 2
+    assert read_page_count(fake_s3, data) == 17
+
+
+def test_object_streams_are_unsupported(fake_s3):
+    with pytest.raises(PdfHeaderUnsupported):
+        read_page_count(fake_s3, make_pdf(9, garbage=3, use_objstms=1))
+
+
+def test_document_session_falls_back_to_the_full_document(fake_s3):
+    fake_s3.store(DOCUMENT_PATH, make_pdf(9, garbage=3, use_objstms=1))
+
+    async def get_page_count():
+        async with DocumentSession(DOCUMENT_PATH) as document_session:
+            page_count = await document_session.get_page_count()
+            return page_count, document_session.pdf_document is not None
+
+    assert asyncio.run(get_page_count()) == (9, True)
@@ -0,0 +1,88 @@
+import asyncio
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import fitz
+import pytest
+
+from app.common import clients
+from app.common.document_session import DocumentSession
+from app.constant import MedicalInsights
+from app.service.helper import pdf_splitter
+from app.service.helper.split_manifest import get_manifest_path
+from benchmarks.fakes import FakeS3Client
+
+DOCUMENT_PATH = 'user/project/request/document.pdf'
+
+
+def make_noise_pdf(page_count, side=200):
+    pdf_document = fitz.open()
+    for _ in range(page_count):
+        page = pdf_document.new_page()
+        page.insert_image(page.rect, pixmap=fitz.Pixmap(fitz.csRGB, side, side, os.urandom(side * side * 3), False))
+    data = pdf_document.tobytes()
+    pdf_document.close()
+    return data
+
+
+@pytest.fixture
+def fake_s3(tmp_path, monkeypatch):
+    fake_s3 = FakeS3Client()
+    monkeypatch.setattr(clients, 'clients', {'s3': fake_s3})
+    monkeypatch.setattr(MedicalInsights, 'STATIC_FOLDER_PATH', str(tmp_path))
+    monkeypatch.setattr(pdf_splitter, 'get_split_executor', lambda: ThreadPoolExecutor(max_workers=2))
+    return fake_s3
+
+
+async def collect_parts(fake_s3, text_pages=None):
+    """ Part keys in the order split_pdf yields them, and the manifest as it was when the first part was yielded """
+    part_keys = []
+    manifest = None
+    async with DocumentSession(DOCUMENT_PATH) as document_session:
+        async for part_key in pdf_splitter.split_pdf(document_session, text_pages=text_pages):
+            if manifest is None:
+                manifest = json.loads(fake_s3.objects[get_manifest_path(DOCUMENT_PATH)][0])
+            part_keys.append(part_key)
+    return part_keys, manifest
+
+
+def test_split_pdf_uploads_the_planned_manifest_before_the_first_part(fake_s3, monkeypatch):
+    fake_s3.store(DOCUMENT_PATH, make_noise_pdf(10))
+    monkeypatch.setattr(MedicalInsights, 'MAX_PAGE_LIMIT', 3)
+
+    part_keys, manifest = asyncio.run(collect_parts(fake_s3))
+
+    assert manifest['part_count'] == 4
+    assert [(part['start_page'], part['end_page']) for part in manifest['parts']] == [(1, 3), (4, 6), (7, 9), (10, 10)]
+    assert sorted(part_keys) == sorted(part['key'] for part in manifest['parts'])
+    for part in manifest['parts']:
+        with fitz.open(stream=fake_s3.objects[part['key']][0], filetype='pdf') as part_document:
+            assert part_document.page_count == part['end_page'] - part['start_page'] + 1
+
+
+def test_split_pdf_keeps_an_oversize_part_as_planned(fake_s3, monkeypatch, caplog):
+    fake_s3.store(DOCUMENT_PATH, make_noise_pdf(4))
+    # An estimate that fell short: the plan keeps every page in one part that is saved over the limit
+    monkeypatch.setattr(pdf_splitter, 'plan_page_ranges', lambda page_sizes: [(0, len(page_sizes))])
+    monkeypatch.setattr(MedicalInsights, 'MAX_SIZE_MB', 0.01)
+
+    with caplog.at_level(logging.WARNING):
+        part_keys, manifest = asyncio.run(collect_parts(fake_s3))
+
+    assert part_keys == ['user/project/request/split_documents/document/document_1_to_4.pdf']
+    assert manifest['part_count'] == 1
+    assert 'document_1_to_4.pdf is' in caplog.text and 'above the 0.01 MB limit' in caplog.text
+
+
+def test_split_pdf_lists_the_pages_of_compacted_parts(fake_s3, monkeypatch):
+    fake_s3.store(DOCUMENT_PATH, make_noise_pdf(6))
+    monkeypatch.setattr(MedicalInsights, 'MAX_PAGE_LIMIT', 2)
+
+    part_keys, manifest = asyncio.run(collect_parts(fake_s3, text_pages={1: 'text', 4: 'text'}))
+
+    assert [part['pages'] for part in manifest['parts']] == [[2, 3], [5, 6]]
+    assert manifest['text_layer']['page_count'] == 2
+    assert sorted(part_keys) == ['user/project/request/split_documents/document/document_2_to_3.pdf',
+                                 'user/project/request/split_documents/document/document_5_to_6.pdf']